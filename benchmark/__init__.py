@@ -0,0 +1 @@
+"""Synthetic-data benchmark of the pipeline stages, and startup benchmark of the jobs, against a local PostgreSQL stand-in."""
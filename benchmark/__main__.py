@@ -0,0 +1,71 @@
+"""
+Times the pipeline stages on synthetic data and compares the report with a baseline.
+"""
+
+import argparse
+import json
+import sys
+import tempfile
+
+import psycopg2
+
+from benchmark.generator import SyntheticDataset
+from benchmark.harness import DEFAULT_MIN_SECONDS, DEFAULT_THRESHOLD, compare_reports, format_comparison, run_benchmark
+
+
+def main(argv=None):
+    """
+    Runs the benchmark from the command line.
+
+    Returns:
+        int: 1 when a stage regressed against the baseline report, 0 otherwise.
+    """
+    parser = argparse.ArgumentParser(prog='python -m benchmark', description=__doc__)
+    parser.add_argument('--dsn', required=True, help="PostgreSQL connection string; its pipeline tables are recreated")
+    parser.add_argument('--scale-factor', type=float, default=0.1)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--update-fraction', type=float, default=0.05)
+    parser.add_argument('--growth-fraction', type=float, default=0.02)
+    parser.add_argument('--late-fraction', type=float, default=0.02)
+    parser.add_argument('--upsert-mode', default='incremental', choices=['incremental', 'full'])
+    parser.add_argument('--no-merge', action='store_true', help="Upsert with UPDATE and INSERT instead of MERGE")
+    parser.add_argument('--fact-load-mode', default='incremental', choices=['incremental', 'full', 'batched'])
+    parser.add_argument('--watermark-column', default='OrderID', choices=['OrderID', 'OrderDate'])
+    parser.add_argument('--work-dir', help="Directory the generated files are written to")
+    parser.add_argument('--output', help="Path the JSON report is written to")
+    parser.add_argument('--baseline', help="Earlier JSON report to compare with")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--min-seconds', type=float, default=DEFAULT_MIN_SECONDS)
+    args = parser.parse_args(argv)
+
+    dataset = SyntheticDataset(args.scale_factor, args.seed, args.skew, args.update_fraction,
+                               args.growth_fraction, args.late_fraction)
+    conn = psycopg2.connect(args.dsn)
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            report = run_benchmark(conn, dataset, args.runs, args.work_dir or temp_dir, args.upsert_mode,
+                                   not args.no_merge, args.fact_load_mode, args.watermark_column)
+    finally:
+        conn.close()
+
+    print(json.dumps(report['totals'], indent=2))
+    print(f"Total: {report['total_seconds']} seconds")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            comparison = compare_reports(json.load(f), report, args.threshold, args.min_seconds)
+        print(format_comparison(comparison))
+        regressions = [row for row in comparison if row['regression']]
+        if regressions:
+            print(f"{len(regressions)} stages regressed against {args.baseline}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+import csv
+import datetime
+import os
+
+import numpy as np
+
+from pipeline import schema
+
+
+# Rows of each table at scale factor 1; order counts are per run
+BASE_ROW_COUNTS = {
+    'Customers': 10000,
+    'Products': 1000,
+    'Stores': 100,
+    'Orders': 50000
+}
+
+# Columns of the generated files, those of the source tables in the schema registry
+file_columns = {table_name: schema.column_names(table_name) for table_name in schema.source_tables}
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+               'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Daniel', 'Karen']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+              'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin']
+STREETS = ['Main St', 'Oak Ave', 'Pine Rd', 'Maple Dr', 'Cedar Ln', 'Elm St', 'Lake Rd', 'Hill St', 'Park Ave', 'River Rd']
+CITIES = [('Seattle', 'WA'), ('Portland', 'OR'), ('Austin', 'TX'), ('Denver', 'CO'), ('Boston', 'MA'),
+          ('Chicago', 'IL'), ('Atlanta', 'GA'), ('Phoenix', 'AZ'), ('Miami', 'FL'), ('Columbus', 'OH')]
+CATEGORIES = ['Electronics', 'Books', 'Clothing', 'Home', 'Garden', 'Toys', 'Sports', 'Beauty', 'Grocery', 'Office']
+
+
+class SyntheticDataset:
+    """
+    Generates the source files of successive pipeline runs.
+
+    Every run gets full snapshots of Customers, Products and Stores and the
+    orders placed since the previous run. Between runs a fraction of the
+    dimension rows change and new ones appear, and a fraction of the new
+    orders are late: they carry a date from an earlier run. Customers and
+    products are picked with a Zipf-like skew, so a few of them account for
+    most of the orders.
+    """
+
+    def __init__(self, scale_factor=1.0, seed=0, skew=1.0, update_fraction=0.05, growth_fraction=0.02,
+                 late_fraction=0.02, days_per_run=30, start_date='2024-01-01'):
+        """
+        Args:
+            scale_factor (float): Multiplies the row counts of BASE_ROW_COUNTS.
+            seed (int): Seed of the random generator; equal seeds give equal files.
+            skew (float): Exponent of the customer and product popularity, 0 for uniform.
+            update_fraction (float): Fraction of the dimension rows changed between runs.
+            growth_fraction (float): Fraction of new dimension rows added between runs.
+            late_fraction (float): Fraction of the orders of a run dated in an earlier run.
+            days_per_run (int): Number of days the orders of a run span.
+            start_date (str): The date of the first orders.
+        """
+        self.scale_factor = scale_factor
+        self.skew = skew
+        self.update_fraction = update_fraction
+        self.growth_fraction = growth_fraction
+        self.late_fraction = late_fraction
+        self.days_per_run = days_per_run
+        self.start_date = np.datetime64(start_date, 'D')
+        self.rng = np.random.default_rng(seed)
+        self.run = 0
+        self.next_order_id = 1
+        self.tables = {}
+        for table_name in ['Customers', 'Products', 'Stores']:
+            self.tables[table_name] = self._new_rows(table_name, 1, self._row_count(table_name))
+
+    def _row_count(self, table_name):
+        return max(1, int(round(BASE_ROW_COUNTS[table_name] * self.scale_factor)))
+
+    def _new_rows(self, table_name, first_id, count):
+        """
+        Generates dimension source rows with consecutive IDs.
+
+        Returns:
+            dict: One array per column of file_columns.
+        """
+        rng = self.rng
+        ids = np.arange(first_id, first_id + count)
+        cities = rng.integers(0, len(CITIES), count)
+        addresses = [f"{number} {street}" for number, street in zip(
+            rng.integers(1, 9999, count).tolist(), rng.choice(STREETS, count).tolist())]
+        zip_codes = [f"{code:05d}" for code in rng.integers(1000, 99999, count).tolist()]
+        if table_name == 'Customers':
+            first_names = rng.choice(FIRST_NAMES, count)
+            last_names = rng.choice(LAST_NAMES, count)
+            return {
+                'CustomerID': ids,
+                'FirstName': first_names,
+                'LastName': last_names,
+                'Email': np.array([f"{first.lower()}.{last.lower()}{i}@example.com"
+                                   for first, last, i in zip(first_names, last_names, ids.tolist())], dtype=object),
+                'Address': np.array(addresses, dtype=object),
+                'City': np.array([CITIES[i][0] for i in cities.tolist()], dtype=object),
+                'State': np.array([CITIES[i][1] for i in cities.tolist()], dtype=object),
+                'ZipCode': np.array(zip_codes, dtype=object)
+            }
+        if table_name == 'Products':
+            categories = rng.choice(CATEGORIES, count)
+            return {
+                'ProductID': ids,
+                'ProductName': np.array([f"{category} item {i}" for category, i in zip(categories, ids.tolist())], dtype=object),
+                'Category': categories,
+                'Description': np.array([f"{category} product" for category in categories], dtype=object),
+                'Price': np.round(rng.lognormal(3, 1, count).clip(0.5, 999999), 2)
+            }
+        return {
+            'StoreID': ids,
+            'StoreName': np.array([f"Store {i}" for i in ids.tolist()], dtype=object),
+            'Address': np.array(addresses, dtype=object),
+            'City': np.array([CITIES[i][0] for i in cities.tolist()], dtype=object),
+            'State': np.array([CITIES[i][1] for i in cities.tolist()], dtype=object),
+            'ZipCode': np.array(zip_codes, dtype=object)
+        }
+
+    def _evolve(self, table_name):
+        """
+        Changes a fraction of the rows of a dimension source and appends new ones.
+        """
+        rows = self.tables[table_name]
+        count = len(rows[file_columns[table_name][0]])
+        changed = self.rng.choice(count, int(count * self.update_fraction), replace=False)
+        if len(changed):
+            if table_name == 'Products':
+                prices = rows['Price'][changed] * self.rng.uniform(0.8, 1.2, len(changed))
+                rows['Price'][changed] = np.round(prices.clip(0.5, 999999), 2)
+            else:
+                moved = self._new_rows(table_name, 1, len(changed))
+                for column in ['Address', 'City', 'State', 'ZipCode']:
+                    rows[column][changed] = moved[column]
+
+        new_rows = self._new_rows(table_name, count + 1, int(count * self.growth_fraction))
+        for column in file_columns[table_name]:
+            rows[column] = np.concatenate([rows[column], new_rows[column]])
+
+    def _pick(self, count, size):
+        """
+        Picks IDs between 1 and count, the lowest (oldest) IDs being the most popular.
+        """
+        weights = 1.0 / np.arange(1, count + 1) ** self.skew
+        return self.rng.choice(count, size, p=weights / weights.sum()) + 1
+
+    def next_run(self):
+        """
+        Generates the source files of the next run.
+
+        Returns:
+            dict: The rows of every table of file_columns, as one array per column.
+        """
+        if self.run > 0:
+            for table_name in ['Customers', 'Products', 'Stores']:
+                self._evolve(table_name)
+
+        order_count = self._row_count('Orders')
+        order_ids = np.arange(self.next_order_id, self.next_order_id + order_count)
+        self.next_order_id += order_count
+
+        run_start = self.start_date + self.run * self.days_per_run
+        order_dates = run_start + self.rng.integers(0, self.days_per_run, order_count)
+        if self.run > 0:
+            late = self.rng.random(order_count) < self.late_fraction
+            order_dates[late] = self.start_date + self.rng.integers(0, self.run * self.days_per_run, late.sum())
+
+        products = self.tables['Products']
+        product_ids = self._pick(len(products['ProductID']), order_count)
+        orders = {
+            'OrderID': order_ids,
+            'CustomerID': self._pick(len(self.tables['Customers']['CustomerID']), order_count),
+            'StoreID': self.rng.integers(1, len(self.tables['Stores']['StoreID']) + 1, order_count),
+            'OrderDate': order_dates
+        }
+        # validate_data keys OrderDetails on OrderID, so every order has a single line
+        order_details = {
+            'OrderID': order_ids,
+            'ProductID': product_ids,
+            'Quantity': self.rng.integers(1, 10, order_count),
+            'Price': products['Price'][product_ids - 1]
+        }
+        self.run += 1
+
+        files = {
+            table_name: {column: values.copy() for column, values in self.tables[table_name].items()}
+            for table_name in ['Customers', 'Products', 'Stores']
+        }
+        files['Orders'] = orders
+        files['OrderDetails'] = order_details
+        return files
+
+    @property
+    def last_order_date(self):
+        """
+        The last date orders of the runs generated so far can have.
+        """
+        last = self.start_date + self.run * self.days_per_run - 1
+        return datetime.date.fromisoformat(str(last))
+
+
+def write_files(files, directory):
+    """
+    Writes the files of a run as CSV with a header row.
+
+    Args:
+        files (dict): The rows of every table, see SyntheticDataset.next_run.
+        directory (str): The directory the files are written to.
+
+    Returns:
+        dict: The path of the file of every table.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for table_name, rows in files.items():
+        columns = file_columns[table_name]
+        paths[table_name] = os.path.join(directory, f"{table_name.lower()}.csv")
+        with open(paths[table_name], 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(columns)
+            writer.writerows(zip(*[rows[column].astype(str).tolist() for column in columns]))
+    return paths
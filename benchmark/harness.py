@@ -0,0 +1,217 @@
+import datetime
+import json
+import platform
+import subprocess
+import time
+
+from pipeline import schema
+from pipeline.dates import populate_dim_dates
+from pipeline.fact import load_facts
+from pipeline.integrity import check_references
+from pipeline.maintenance import maintain_tables
+from pipeline.streaming import stream_copy
+from pipeline.upsert import dimension_tables, upsert_dimension
+from pipeline.validation import validate_data
+
+from benchmark.generator import file_columns, write_files
+
+
+# A stage regresses when it is this much slower than in the baseline...
+DEFAULT_THRESHOLD = 0.25
+
+# ...and at least this many seconds slower, so that noise on tiny stages is ignored
+DEFAULT_MIN_SECONDS = 0.05
+
+# Tables the pipeline creates on its own, dropped so that every benchmark starts afresh
+pipeline_tables = ['etl_watermarks', 'etl_fact_batches', 'etl_quarantine', 'etl_column_stats']
+
+
+def build_schema_statements():
+    """
+    Builds the PostgreSQL DDL of the tables of the schema registry.
+
+    Returns:
+        list: The SQL statements, dropping every table and creating the
+        non-transient ones.
+    """
+    statements = [f"DROP TABLE IF EXISTS {', '.join(list(schema.tables) + pipeline_tables)};"]
+    statements += [
+        schema.build_create_table(table_name, 'postgres')
+        for table_name, table in schema.tables.items() if not table.get('transient')
+    ]
+    return statements
+
+
+def create_schema(conn):
+    """
+    Recreates every table of the pipeline, empty.
+
+    Args:
+        conn: The connection to the PostgreSQL stand-in.
+    """
+    with conn.cursor() as cur:
+        for statement in build_schema_statements():
+            cur.execute(statement)
+    conn.commit()
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _time_stage(stages, run, stage, func):
+    """
+    Runs one stage, appending its duration and row count to stages.
+    """
+    start = time.perf_counter()
+    rows = func()
+    stages.append({'run': run, 'stage': stage, 'seconds': round(time.perf_counter() - start, 3), 'rows': rows})
+    print(json.dumps(stages[-1]))
+
+
+def _copy(conn, table_name, path):
+    with conn.cursor() as cur:
+        cur.execute(f"TRUNCATE TABLE {table_name};")
+    rows = stream_copy(conn, path, table_name, 'csv', file_columns[table_name])['rows']
+    conn.commit()
+    return rows
+
+
+def _validate(conn, table_name):
+    validate_data(conn, table_name)
+    return None
+
+
+def run_benchmark(conn, dataset, runs, work_dir, upsert_mode='incremental', use_merge=True,
+                  fact_load_mode='incremental', watermark_column='OrderID'):
+    """
+    Runs the pipeline stages over successive synthetic runs and times each of them.
+
+    Every run copies the generated files into the source tables, validates
+    them, appends dim_dates, upserts the dimensions, checks the references of
+    the order lines, populates fact_orders and vacuums and analyzes the
+    tables past the maintenance thresholds, like a workflow run does.
+
+    Args:
+        conn: The connection to the PostgreSQL stand-in. Every pipeline table
+            of its database is dropped and recreated.
+        dataset (benchmark.generator.SyntheticDataset): Generates the files.
+        runs (int): The number of runs.
+        work_dir (str): The directory the files are written to.
+        upsert_mode (str): The upsert_mode of the dimension upserts.
+        use_merge (bool): Whether incremental upserts use MERGE.
+        fact_load_mode (str): The fact_load_mode of the fact load.
+        watermark_column (str): The watermark column of incremental fact loads.
+
+    Returns:
+        dict: The report, with the benchmark settings, the environment and the
+        duration and row count of every stage of every run.
+    """
+    create_schema(conn)
+    stages = []
+    for run in range(1, runs + 1):
+        paths = write_files(dataset.next_run(), f"{work_dir}/run-{run}")
+        for table_name, path in paths.items():
+            _time_stage(stages, run, f"copy_{table_name.lower()}", lambda: _copy(conn, table_name, path))
+            _time_stage(stages, run, f"validate_{table_name.lower()}", lambda: _validate(conn, table_name))
+        _time_stage(stages, run, 'dim_dates', lambda: populate_dim_dates(
+            conn, str(dataset.start_date), dataset.last_order_date)['rows'])
+        for table_name in dimension_tables:
+            _time_stage(stages, run, f"upsert_{table_name}", lambda: upsert_dimension(
+                conn, table_name, upsert_mode, use_merge)['inserted'])
+        _time_stage(stages, run, 'check_references', lambda: sum(check_references(conn).values()))
+        # Batched loads are checkpointed per run, as every workflow run has its own run ID
+        _time_stage(stages, run, 'fact_orders', lambda: load_facts(
+            conn, fact_load_mode, watermark_column, batch_load_name=f"benchmark-run-{run}")['inserted'])
+        _time_stage(stages, run, 'maintenance', lambda: sum(bool(result['statements']) for result in maintain_tables(
+            conn, ['dim_dates'] + [f"dim_{table_name}" for table_name in dimension_tables] + ['fact_orders'])))
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT version();")
+        server_version = cur.fetchone()[0]
+
+    totals = {}
+    for stage in stages:
+        totals[stage['stage']] = round(totals.get(stage['stage'], 0) + stage['seconds'], 3)
+    return {
+        'created_at': datetime.datetime.utcnow().isoformat(sep=' ', timespec='seconds'),
+        'settings': {
+            'scale_factor': dataset.scale_factor,
+            'skew': dataset.skew,
+            'update_fraction': dataset.update_fraction,
+            'growth_fraction': dataset.growth_fraction,
+            'late_fraction': dataset.late_fraction,
+            'runs': runs,
+            'upsert_mode': upsert_mode,
+            'use_merge': use_merge,
+            'fact_load_mode': fact_load_mode,
+            'watermark_column': watermark_column
+        },
+        'environment': {
+            'git_commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server': server_version
+        },
+        'stages': stages,
+        'totals': totals,
+        'total_seconds': round(sum(stage['seconds'] for stage in stages), 3)
+    }
+
+
+def compare_reports(baseline, report, threshold=DEFAULT_THRESHOLD, min_seconds=DEFAULT_MIN_SECONDS):
+    """
+    Compares the stage durations of a report with those of a baseline report.
+
+    Args:
+        baseline (dict): The earlier report.
+        report (dict): The new report.
+        threshold (float): The relative slowdown that counts as a regression.
+        min_seconds (float): The absolute slowdown below which a stage never regresses.
+
+    Returns:
+        list: One dict per stage of both reports with both durations, the
+        relative change and whether it regressed.
+    """
+    if baseline['settings'] != report['settings']:
+        raise Exception(f"Reports with different settings cannot be compared: "
+                        f"{baseline['settings']} and {report['settings']}")
+
+    baseline_seconds = {(stage['run'], stage['stage']): stage['seconds'] for stage in baseline['stages']}
+    comparison = []
+    for stage in report['stages']:
+        before = baseline_seconds.get((stage['run'], stage['stage']))
+        if before is None:
+            continue
+        change = (stage['seconds'] - before) / before if before > 0 else None
+        comparison.append({
+            'run': stage['run'],
+            'stage': stage['stage'],
+            'baseline_seconds': before,
+            'seconds': stage['seconds'],
+            'change': None if change is None else round(change, 3),
+            'regression': stage['seconds'] - before >= min_seconds and (change is None or change > threshold)
+        })
+    return comparison
+
+
+def format_comparison(comparison):
+    """
+    Formats a comparison as a text table, regressions marked with '!'.
+
+    Args:
+        comparison (list): The result of compare_reports.
+
+    Returns:
+        str: The table.
+    """
+    lines = [f"{'run':>3}  {'stage':<24} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for row in comparison:
+        change = 'n/a' if row['change'] is None else f"{row['change']:+.0%}"
+        marker = ' !' if row['regression'] else ''
+        lines.append(f"{row['run']:>3}  {row['stage']:<24} {row['baseline_seconds']:>10.3f} "
+                     f"{row['seconds']:>10.3f} {change:>8}{marker}")
+    return '\n'.join(lines)
@@ -0,0 +1,169 @@
+"""
+Times the cold start of every Glue job: its import, and the time until its first query.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from psycopg2.extensions import parse_dsn
+
+
+# Module of every job script
+jobs = ['datespopulation', 'dynamic_upsert', 'populate_fact', 'validate_data', 'run_pipeline', 'migrate_schema']
+
+# Modules that are expensive to import and that the jobs should only import when used
+heavy_modules = ['boto3', 'awsglue', 'numpy', 'pyarrow', 'zstandard', 'asyncio']
+
+# Runs in a fresh interpreter: imports the job, then takes the path of its main() up to
+# the first query, with Secrets Manager and Glue stubbed to point at the stand-in
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {job}
+imported = time.perf_counter()
+modules = sorted(sys.modules)
+
+from pipeline import runtime
+
+class SecretsManager:
+    def get_secret_value(self, SecretId):
+        return {{'SecretString': {credentials!r}}}
+
+class Glue:
+    def get_workflow_run_properties(self, Name, RunId):
+        return {{'RunProperties': {{}}}}
+
+runtime.set_job_args(SecretName='startup', SecretRegionName='local', SecretManagerService='secretsmanager',
+                     WORKFLOW_NAME='startup', WORKFLOW_RUN_ID='startup')
+runtime.register_client('secretsmanager', SecretsManager(), 'local')
+runtime.register_client('glue', Glue())
+runtime.get_workflow_params()
+conn = runtime.get_connection()
+with conn.cursor() as cur:
+    cur.execute("SELECT 1;")
+    cur.fetchone()
+first_query = time.perf_counter()
+runtime.release_connection(conn)
+runtime.close_pool()
+print(json.dumps({{'import_seconds': imported - start, 'first_query_seconds': first_query - start,
+                  'modules': len(modules), 'heavy_modules': [name for name in {heavy_modules!r} if name in modules]}}))
+"""
+
+
+def credentials_from_dsn(dsn):
+    """
+    Builds the secret value of the Redshift credentials from a PostgreSQL connection string.
+
+    Args:
+        dsn (str): The connection string.
+
+    Returns:
+        str: The JSON of the host, port, user, password and database.
+    """
+    params = parse_dsn(dsn)
+    return json.dumps({
+        'host': params.get('host', 'localhost'),
+        'port': params.get('port', 5432),
+        'user': params.get('user', ''),
+        'password': params.get('password', ''),
+        'database': params.get('dbname', params.get('user', ''))
+    })
+
+
+def probe_job(job, credentials, repo_dir):
+    """
+    Starts one job in a fresh interpreter and times it.
+
+    Args:
+        job (str): The module of the job script.
+        credentials (str): The secret value the stubbed Secrets Manager returns.
+        repo_dir (str): The directory of the job scripts.
+
+    Returns:
+        dict: The import and first-query times in seconds, the number of
+        imported modules and the heavy modules among them.
+    """
+    code = PROBE.format(job=job, credentials=credentials, heavy_modules=heavy_modules)
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    # Job arguments come from set_job_args, so the command line must not carry any
+    completed = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, env=env,
+                               capture_output=True, text=True, check=False)
+    if completed.returncode != 0:
+        raise Exception(f"Starting {job} failed: {completed.stderr.strip()}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def run_startup_benchmark(dsn, repeat=5, repo_dir=None):
+    """
+    Times the cold start of every job, taking the median of several fresh starts.
+
+    Args:
+        dsn (str): The connection string of the PostgreSQL stand-in.
+        repeat (int): The number of starts per job.
+        repo_dir (str): The directory of the job scripts. Defaults to the
+            parent directory of the benchmark package.
+
+    Returns:
+        list: One dict per job with its median import and first-query times in
+        milliseconds, the number of imported modules and the heavy ones.
+    """
+    repo_dir = repo_dir or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    credentials = credentials_from_dsn(dsn)
+    results = []
+    for job in jobs:
+        probes = [probe_job(job, credentials, repo_dir) for _ in range(repeat)]
+        results.append({
+            'job': job,
+            'import_ms': round(statistics.median(probe['import_seconds'] for probe in probes) * 1000, 1),
+            'first_query_ms': round(statistics.median(probe['first_query_seconds'] for probe in probes) * 1000, 1),
+            'modules': probes[-1]['modules'],
+            'heavy_modules': probes[-1]['heavy_modules']
+        })
+        print(json.dumps(results[-1]))
+    return results
+
+
+def format_results(results):
+    """
+    Formats the startup times as a text table.
+
+    Args:
+        results (list): The result of run_startup_benchmark.
+
+    Returns:
+        str: The table.
+    """
+    lines = [f"{'job':<18} {'import ms':>10} {'first query ms':>15} {'modules':>8}  heavy modules"]
+    for row in results:
+        lines.append(f"{row['job']:<18} {row['import_ms']:>10.1f} {row['first_query_ms']:>15.1f} "
+                     f"{row['modules']:>8}  {', '.join(row['heavy_modules']) or '-'}")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """
+    Runs the startup benchmark from the command line.
+
+    Returns:
+        int: 0.
+    """
+    parser = argparse.ArgumentParser(prog='python -m benchmark.startup', description=__doc__)
+    parser.add_argument('--dsn', required=True, help="PostgreSQL connection string the jobs connect to")
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh starts per job, of which the median is kept")
+    parser.add_argument('--output', help="Path the JSON results are written to")
+    args = parser.parse_args(argv)
+
+    results = run_startup_benchmark(args.dsn, args.repeat)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
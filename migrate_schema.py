@@ -0,0 +1,37 @@
+import psycopg2
+from pipeline import runtime
+from pipeline.schema import migrate_schema
+
+
+def main():
+    """
+    Prints, and optionally applies, the DDL bringing the tables in line with the schema registry.
+    """
+    params = runtime.get_workflow_params()
+
+    # Only print the migration DDL unless the workflow asks for it to be applied
+    apply_migrations = params.get('apply_migrations', 'false').lower() == 'true'
+    table_names = params['migrate_tables'].split(',') if params.get('migrate_tables') else None
+
+    # Establish a connection to Redshift
+    conn = runtime.get_connection()
+
+    try:
+        statements = migrate_schema(conn, table_names, apply_migrations)
+        if not statements:
+            print("Every table matches the schema registry")
+        for statement in statements:
+            print(statement)
+        if statements and not apply_migrations:
+            print("Set the apply_migrations workflow property to true to run these statements")
+    except (Exception, psycopg2.DatabaseError) as error:
+        print("Error migrating the schema:", error)
+        raise Exception("Schema migration failed")
+
+    # Close the connection
+    finally:
+        runtime.release_connection(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+"""
+Shared building blocks of the Redshift Glue jobs.
+"""
@@ -0,0 +1,325 @@
+import csv
+import datetime
+import gzip
+import io
+
+import psycopg2
+
+from pipeline import runtime, schema
+from pipeline.s3_copy import build_copy_command
+from pipeline.streaming import stream_copy
+
+
+# First date generated when dim_dates is empty
+DEFAULT_START_DATE = '2023-01-01'
+
+# Days generated beyond today, so that new orders always find their date
+DEFAULT_HORIZON_DAYS = 365
+
+# Columns of dim_dates filled by the builder; DateKey is generated by the table
+dim_dates_columns = [(column['name'], column['type']) for column in schema.tables['dim_dates']['columns'][1:]]
+
+
+def _nth_weekday(years, month, weekday, n):
+    """
+    Returns the n-th given weekday of a month for every year.
+
+    Args:
+        years (numpy.ndarray): The years.
+        month (int): The month.
+        weekday (str): The weekday, e.g. 'Mon'.
+        n (int): The occurrence, 1 for the first, -1 for the last.
+
+    Returns:
+        numpy.ndarray: The dates.
+    """
+    import numpy as np
+
+    if n > 0:
+        first = np.array([f"{year:04d}-{month:02d}-01" for year in years], dtype='datetime64[D]')
+        return np.busday_offset(first, n - 1, roll='forward', weekmask=weekday)
+    following = np.array([f"{year + month // 12:04d}-{month % 12 + 1:02d}-01" for year in years], dtype='datetime64[D]')
+    return np.busday_offset(following, n, roll='forward', weekmask=weekday)
+
+
+def us_federal_holidays(years):
+    """
+    Returns the US federal holidays of the given years, on their actual (not observed) dates.
+
+    Args:
+        years (numpy.ndarray): The years.
+
+    Returns:
+        list: (dates, name) tuples, one per holiday.
+    """
+    import numpy as np
+
+    def fixed(month, day):
+        return np.array([f"{year:04d}-{month:02d}-{day:02d}" for year in years], dtype='datetime64[D]')
+
+    return [
+        (fixed(1, 1), "New Year's Day"),
+        (_nth_weekday(years, 1, 'Mon', 3), "Martin Luther King Jr. Day"),
+        (_nth_weekday(years, 2, 'Mon', 3), "Washington's Birthday"),
+        (_nth_weekday(years, 5, 'Mon', -1), "Memorial Day"),
+        (fixed(6, 19)[years >= 2021], "Juneteenth"),
+        (fixed(7, 4), "Independence Day"),
+        (_nth_weekday(years, 9, 'Mon', 1), "Labor Day"),
+        (_nth_weekday(years, 10, 'Mon', 2), "Columbus Day"),
+        (fixed(11, 11), "Veterans Day"),
+        (_nth_weekday(years, 11, 'Thu', 4), "Thanksgiving Day"),
+        (fixed(12, 25), "Christmas Day")
+    ]
+
+
+def build_date_attributes(start_date, end_date, fiscal_year_start_month=1, holiday_calendar=us_federal_holidays):
+    """
+    Computes every dim_dates attribute of a date range at once.
+
+    Weekday follows EXTRACT(DOW) (0 for Sunday) and Week is the ISO week, with
+    IsoYear the year it belongs to. The fiscal year is named after the calendar
+    year it ends in.
+
+    Args:
+        start_date (str): The first date, e.g. '2023-01-01'.
+        end_date (str): The last date, included.
+        fiscal_year_start_month (int): The month the fiscal year starts in.
+        holiday_calendar (callable): Returns the (dates, name) holidays of an array of years.
+
+    Returns:
+        dict: One numpy array per column of dim_dates_columns.
+    """
+    import numpy as np
+
+    dates = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    days_since_epoch = dates.astype(np.int64)
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+    days = (dates - dates.astype('datetime64[M]')).astype(np.int64) + 1
+
+    # 1970-01-01 was a Thursday
+    weekdays = (days_since_epoch + 4) % 7
+    iso_weekdays = (weekdays + 6) % 7 + 1
+
+    # The ISO week and year are those of the Thursday of the week
+    thursdays = dates + (4 - iso_weekdays)
+    iso_years = thursdays.astype('datetime64[Y]').astype(np.int64) + 1970
+    iso_weeks = (thursdays - thursdays.astype('datetime64[Y]')).astype(np.int64) // 7 + 1
+
+    fiscal_months = (months - fiscal_year_start_month) % 12 + 1
+    fiscal_years = years + ((months >= fiscal_year_start_month) & (fiscal_year_start_month > 1))
+
+    holiday_names = np.full(len(dates), '', dtype=object)
+    for holiday_dates, name in holiday_calendar(np.unique(years)):
+        holiday_names[np.isin(dates, holiday_dates)] = name
+
+    return {
+        'Date': dates,
+        'Year': years,
+        'Quarter': (months - 1) // 3 + 1,
+        'Month': months,
+        'Day': days,
+        'Weekday': weekdays,
+        'Week': iso_weeks,
+        'IsoYear': iso_years,
+        'FiscalYear': fiscal_years,
+        'FiscalQuarter': (fiscal_months - 1) // 3 + 1,
+        'FiscalMonth': fiscal_months,
+        'IsWeekend': iso_weekdays >= 6,
+        'IsHoliday': holiday_names != '',
+        'HolidayName': holiday_names
+    }
+
+
+def build_dates_csv(attributes):
+    """
+    Serializes the date attributes as CSV with a header row.
+
+    Args:
+        attributes (dict): One array per column, see build_date_attributes.
+
+    Returns:
+        bytes: The CSV file. Empty holiday names are written as NULLs.
+    """
+    import numpy as np
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow([name for name, _ in dim_dates_columns])
+    columns = []
+    for name, data_type in dim_dates_columns:
+        values = attributes[name]
+        if data_type == 'DATE':
+            values = values.astype(str)
+        elif data_type == 'BOOLEAN':
+            values = np.where(values, 'true', 'false')
+        columns.append(values.tolist())
+    writer.writerows(zip(*columns))
+    return buffer.getvalue().encode('utf-8')
+
+
+def ensure_dim_dates_columns(conn):
+    """
+    Adds the attribute columns that an older dim_dates is missing.
+
+    Args:
+        conn: The connection to the Redshift database.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'dim_dates';")
+        existing = {row[0].lower() for row in cur.fetchall()}
+        for name, data_type in dim_dates_columns:
+            if name.lower() not in existing:
+                cur.execute(f"ALTER TABLE dim_dates ADD COLUMN {name} {data_type};")
+
+
+def _copy_dates(conn, table_name, dates_csv, staging_bucket=None, staging_key=None):
+    """
+    Copies a CSV of date attributes into a table, through S3 when a staging bucket is given.
+    """
+    columns = [name for name, _ in dim_dates_columns]
+    if staging_bucket:
+        runtime.get_client('s3').put_object(Bucket=staging_bucket, Key=staging_key, Body=gzip.compress(dates_csv))
+        with conn.cursor() as cur:
+            cur.execute(build_copy_command(table_name, staging_bucket, staging_key, columns=columns))
+    else:
+        stream_copy(conn, io.BytesIO(dates_csv), table_name, 'csv', columns)
+
+
+def backfill_dim_dates(conn, fiscal_year_start_month=1, staging_bucket=None):
+    """
+    Fills in the attributes that the dates of an older dim_dates are missing.
+
+    Dates loaded before a column was added hold NULL in it. Their attributes
+    are computed like those of new dates, copied into a temporary table the
+    same way and applied with one UPDATE ... FROM.
+
+    Args:
+        conn: The connection to the Redshift database.
+        fiscal_year_start_month (int): The month the fiscal year starts in.
+        staging_bucket (str): The S3 bucket the CSV is staged in for Redshift,
+            see populate_dim_dates.
+
+    Returns:
+        int: The number of dates updated.
+    """
+    # HolidayName is NULL on every date that is not a holiday
+    filled_columns = [name for name, _ in dim_dates_columns if name != 'HolidayName']
+    missing = " OR ".join(f"{name} IS NULL" for name in filled_columns)
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT MIN(Date), MAX(Date) FROM dim_dates WHERE {missing};")
+        first_date, last_date = cur.fetchone()
+    if first_date is None:
+        return 0
+
+    dates_csv = build_dates_csv(build_date_attributes(first_date, last_date, fiscal_year_start_month))
+    definitions = ", ".join(f"{name} {data_type}" for name, data_type in dim_dates_columns)
+    with conn.cursor() as cur:
+        cur.execute(f"CREATE TEMP TABLE staging_dim_dates ({definitions});")
+    _copy_dates(conn, 'staging_dim_dates', dates_csv, staging_bucket,
+                f"staging/dim_dates/backfill_{first_date}_{last_date}.csv.gz")
+    assignments = ", ".join(f"{name} = s.{name}" for name, _ in dim_dates_columns if name != 'Date')
+    still_missing = " OR ".join(f"dim_dates.{name} IS NULL" for name in filled_columns)
+    with conn.cursor() as cur:
+        cur.execute(f"""
+            UPDATE dim_dates SET {assignments}
+            FROM staging_dim_dates s
+            WHERE dim_dates.Date = s.Date AND ({still_missing});
+        """)
+        backfilled = cur.rowcount
+        cur.execute("DROP TABLE staging_dim_dates;")
+    print(f"dim_dates attributes backfilled on {backfilled} dates from {first_date} to {last_date}")
+    return backfilled
+
+
+def get_missing_date_range(conn, start_date=None, end_date=None):
+    """
+    Works out the dates to append to dim_dates.
+
+    Only dates beyond the current maximum of dim_dates are generated, up to the
+    later of end_date (today plus DEFAULT_HORIZON_DAYS by default) and the
+    latest order date.
+
+    Args:
+        conn: The connection to the Redshift database.
+        start_date (str): The first date when dim_dates is empty.
+        end_date (str): The last date to cover.
+
+    Returns:
+        tuple: The first and last date to generate, or None when nothing is missing.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT MAX(Date) FROM dim_dates;")
+        max_date = cur.fetchone()[0]
+        cur.execute("SELECT MAX(OrderDate) FROM Orders;")
+        max_order_date = cur.fetchone()[0]
+
+    if end_date is None:
+        end_date = datetime.date.today() + datetime.timedelta(days=DEFAULT_HORIZON_DAYS)
+    else:
+        end_date = datetime.date.fromisoformat(str(end_date))
+    if max_order_date is not None:
+        end_date = max(end_date, max_order_date)
+
+    if max_date is not None:
+        start_date = max_date + datetime.timedelta(days=1)
+    else:
+        start_date = datetime.date.fromisoformat(str(start_date or DEFAULT_START_DATE))
+    if start_date > end_date:
+        return None
+    return start_date, end_date
+
+
+def populate_dim_dates(conn, start_date=None, end_date=None, fiscal_year_start_month=1,
+                       staging_bucket=None, staging_key=None):
+    """
+    Appends the dates missing from dim_dates with one COPY and updates keymap_dates.
+
+    The attributes that dates loaded before a column was added are missing
+    are backfilled first, see backfill_dim_dates.
+
+    Args:
+        conn: The connection to the Redshift database.
+        start_date (str): The first date when dim_dates is empty.
+        end_date (str): The last date to cover, see get_missing_date_range.
+        fiscal_year_start_month (int): The month the fiscal year starts in.
+        staging_bucket (str): The S3 bucket the CSV is staged in for Redshift.
+            Without it the CSV is streamed with COPY FROM STDIN, which only
+            PostgreSQL-compatible servers such as the local stand-in accept.
+        staging_key (str): The S3 key of the staged CSV.
+
+    Returns:
+        dict: The range of dates appended, their number and the number of
+        dates backfilled.
+    """
+    try:
+        ensure_dim_dates_columns(conn)
+        backfilled = backfill_dim_dates(conn, int(fiscal_year_start_month), staging_bucket)
+        date_range = get_missing_date_range(conn, start_date, end_date)
+        if date_range is None:
+            conn.commit()
+            print("dim_dates already covers the requested range")
+            return {'start_date': None, 'end_date': None, 'rows': 0, 'backfilled': backfilled}
+
+        attributes = build_date_attributes(date_range[0], date_range[1], int(fiscal_year_start_month))
+        dates_csv = build_dates_csv(attributes)
+        staging_key = staging_key or f"staging/dim_dates/{date_range[0]}_{date_range[1]}.csv.gz"
+        _copy_dates(conn, 'dim_dates', dates_csv, staging_bucket, staging_key)
+
+        with conn.cursor() as cur:
+            # Append the new dates to the date key map used by the fact load
+            cur.execute(schema.build_create_table('keymap_dates', schema.dialect_of(conn), if_not_exists=True))
+            cur.execute("""
+                INSERT INTO keymap_dates (Date, DateKey)
+                SELECT Date, DateKey
+                FROM dim_dates
+                WHERE Date > (SELECT COALESCE(MAX(Date), '1900-01-01') FROM keymap_dates);
+            """)
+        conn.commit()
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        raise
+
+    print(f"dim_dates populated from {date_range[0]} to {date_range[1]}")
+    return {'start_date': str(date_range[0]), 'end_date': str(date_range[1]), 'rows': len(attributes['Date']),
+            'backfilled': backfilled}
@@ -0,0 +1,515 @@
+import psycopg2
+import datetime
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import runtime, schema
+from pipeline.steps import StepRunner, get_run_id
+
+
+# Columns a watermark can be kept on, with their type and the query that
+# recovers the high-water mark from fact_orders when no watermark is stored yet
+watermark_columns = {
+    'OrderID': {
+        'type': 'INT',
+        'loaded_max': "SELECT MAX(OrderID) FROM fact_orders;"
+    },
+    'OrderDate': {
+        'type': 'DATE',
+        'loaded_max': "SELECT MAX(dd.Date) FROM fact_orders f JOIN dim_dates dd ON f.OrderDateID = dd.DateKey;"
+    }
+}
+
+# Batch sizes of batched loads: order IDs, or days of orders, per batch
+DEFAULT_BATCH_SIZES = {'OrderID': 1000000, 'OrderDate': 7}
+
+# Control table recording the completed batches of batched loads
+fact_batches_ddl = """
+    CREATE TABLE IF NOT EXISTS etl_fact_batches (
+      LoadName VARCHAR(128) NOT NULL,
+      BatchColumn VARCHAR(64) NOT NULL,
+      RangeStart VARCHAR(64) NOT NULL,
+      RangeEnd VARCHAR(64) NOT NULL,
+      RowsInserted BIGINT,
+      Seconds DECIMAL(12,3),
+      CompletedAt TIMESTAMP
+    );
+"""
+
+staging_fact_orders_insert = """
+    INSERT INTO staging_fact_orders (OrderID, CustomerID, StoreID, ProductID, Quantity, UnitPrice, TotalPrice, OrderDate)
+    SELECT o.OrderID, o.CustomerID, o.StoreID, od.ProductID, od.Quantity, od.Price, od.Price*od.Quantity, o.OrderDate
+    FROM Orders o
+    JOIN OrderDetails od ON o.OrderID = od.OrderID
+"""
+
+fact_orders_insert = """
+    INSERT INTO fact_orders (OrderID, CustomerID, StoreID, ProductID, Quantity, UnitPrice, TotalPrice, OrderDateID)
+    SELECT o.OrderID, dc.CustomerKey, ds.StoreKey, dp.ProductKey, o.Quantity, o.UnitPrice, o.TotalPrice, dd.DateKey
+    FROM staging_fact_orders o
+    JOIN keymap_customers dc ON o.CustomerID = dc.CustomerID
+    JOIN keymap_stores ds ON o.StoreID = ds.StoreID
+    JOIN keymap_products dp ON o.ProductID = dp.ProductID
+    JOIN keymap_dates dd ON o.OrderDate = dd.Date;
+"""
+
+# Maps from natural keys to the surrogate keys of the current dimension versions,
+# maintained by pipeline.upsert: (natural key, surrogate key, SCD2 versioned)
+key_maps = {
+    'customers': ('CustomerID', 'CustomerKey', True),
+    'stores': ('StoreID', 'StoreKey', True),
+    'products': ('ProductID', 'ProductKey', True),
+    'dates': ('Date', 'DateKey', False)
+}
+
+
+def build_key_map_refresh_statements(dialect='redshift'):
+    """
+    Builds the statements that make sure every key map exists and is filled.
+
+    A map that was never built is filled from its dimension, and dates added to
+    dim_dates since the last refresh are appended to keymap_dates.
+
+    Args:
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        list: The steps, as (name, statement) tuples in execution order.
+    """
+    statements = []
+    for dimension, (natural_key, surrogate_key, versioned) in key_maps.items():
+        current_filter = "EndDate = '9999-12-31' AND " if versioned else ""
+        statements += [
+            (f"create_keymap_{dimension}", schema.build_create_table(f"keymap_{dimension}", dialect, if_not_exists=True)),
+            (f"bootstrap_keymap_{dimension}", f"""
+            INSERT INTO keymap_{dimension} ({natural_key}, {surrogate_key})
+            SELECT {natural_key}, {surrogate_key}
+            FROM dim_{dimension}
+            WHERE {current_filter}NOT EXISTS (SELECT 1 FROM keymap_{dimension});
+            """)
+        ]
+    statements.append(('append_keymap_dates', """
+            INSERT INTO keymap_dates (Date, DateKey)
+            SELECT Date, DateKey
+            FROM dim_dates
+            WHERE Date > (SELECT MAX(Date) FROM keymap_dates);
+            """))
+    return statements
+
+
+def build_full_fact_load_statements(dialect='redshift'):
+    """
+    Builds the steps that re-join the whole order history into fact_orders.
+
+    Args:
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        list: The steps, as (name, statement) tuples in execution order.
+    """
+    return [
+        ('create_staging', schema.build_create_table('staging_fact_orders', dialect)),
+        ('insert_staging', staging_fact_orders_insert + ";"),
+        # Make sure the key maps are filled
+        *build_key_map_refresh_statements(dialect),
+        ('insert_fact_orders', fact_orders_insert),
+        ('drop_staging', "DROP TABLE staging_fact_orders;")
+    ]
+
+
+def get_watermark(cursor, source_name, watermark_column):
+    """
+    Reads the high-water mark of a source from the etl_watermarks control table.
+
+    Args:
+        cursor: The cursor to run the query with.
+        source_name (str): The name of the source table.
+        watermark_column (str): The column the watermark is kept on.
+
+    Returns:
+        str: The high-water mark, or None when nothing has been loaded yet.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS etl_watermarks (
+          SourceName VARCHAR(64) NOT NULL,
+          WatermarkColumn VARCHAR(64) NOT NULL,
+          HighWaterMark VARCHAR(64),
+          UpdatedAt TIMESTAMP
+        );
+    """)
+    # Serialize concurrent loads so that two runs never stage the same delta
+    cursor.execute("LOCK etl_watermarks;")
+    cursor.execute(
+        "SELECT HighWaterMark FROM etl_watermarks WHERE SourceName = %s AND WatermarkColumn = %s;",
+        (source_name, watermark_column)
+    )
+    row = cursor.fetchone()
+    if row is not None:
+        return row[0]
+
+    # First incremental run: continue from what earlier full loads already put in fact_orders
+    cursor.execute(watermark_columns[watermark_column]['loaded_max'])
+    loaded_max = cursor.fetchone()[0]
+    return None if loaded_max is None else str(loaded_max)
+
+
+def set_watermark(cursor, source_name, watermark_column, high_water_mark):
+    """
+    Stores the high-water mark of a source in the etl_watermarks control table.
+
+    Args:
+        cursor: The cursor to run the statements with.
+        source_name (str): The name of the source table.
+        watermark_column (str): The column the watermark is kept on.
+        high_water_mark (str): The new high-water mark.
+    """
+    cursor.execute(
+        "DELETE FROM etl_watermarks WHERE SourceName = %s AND WatermarkColumn = %s;",
+        (source_name, watermark_column)
+    )
+    cursor.execute(
+        "INSERT INTO etl_watermarks (SourceName, WatermarkColumn, HighWaterMark, UpdatedAt) VALUES (%s, %s, %s, %s);",
+        (source_name, watermark_column, high_water_mark, datetime.datetime.utcnow())
+    )
+
+
+def incremental_fact_load(conn, watermark_column='OrderID'):
+    """
+    Loads the order lines beyond the stored watermark into fact_orders.
+
+    The staging, the fact insert and the watermark update run in one
+    transaction, so a failed run neither loads facts nor advances the watermark.
+
+    Args:
+        conn: The connection to the Redshift database.
+        watermark_column (str): The Orders column the watermark is kept on.
+
+    Returns:
+        dict: The number of staged and inserted rows, and the new watermark.
+    """
+    if watermark_column not in watermark_columns:
+        raise Exception(f"Unsupported watermark column: {watermark_column}")
+    watermark_type = watermark_columns[watermark_column]['type']
+    dialect = schema.dialect_of(conn)
+
+    steps = StepRunner(conn, 'fact_orders')
+    with conn.cursor() as cur:
+        try:
+            watermark = get_watermark(cur, 'orders', watermark_column)
+            print(f"Current watermark on {watermark_column}: {watermark}")
+
+            steps.run(cur, 'create_staging', schema.build_create_table('staging_fact_orders', dialect))
+            if watermark is None:
+                staged_count = steps.run(cur, 'insert_staging', staging_fact_orders_insert + ";")
+            else:
+                staged_count = steps.run(
+                    cur,
+                    'insert_staging',
+                    staging_fact_orders_insert + f"WHERE o.{watermark_column} > CAST(%s AS {watermark_type});",
+                    (watermark,)
+                )
+
+            steps.run_all(cur, build_key_map_refresh_statements(dialect))
+            inserted_count = steps.run(cur, 'insert_fact_orders', fact_orders_insert)
+
+            cur.execute(f"SELECT MAX({watermark_column}) FROM staging_fact_orders;")
+            staged_max = cur.fetchone()[0]
+            if staged_max is not None:
+                watermark = str(staged_max)
+                set_watermark(cur, 'orders', watermark_column, watermark)
+
+            steps.run(cur, 'drop_staging', "DROP TABLE staging_fact_orders;")
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    return {'staged': staged_count, 'inserted': inserted_count, 'watermark': watermark}
+
+
+def full_fact_load(conn):
+    """
+    Re-joins the whole order history into fact_orders.
+
+    Args:
+        conn: The connection to the Redshift database.
+
+    Returns:
+        dict: The number of staged and inserted rows.
+    """
+    steps = StepRunner(conn, 'fact_orders')
+    with conn.cursor() as cur:
+        try:
+            steps.run_all(cur, build_full_fact_load_statements(schema.dialect_of(conn)))
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    rows = {step['step']: step['rows'] for step in steps.steps}
+    return {'staged': rows['insert_staging'], 'inserted': rows['insert_fact_orders']}
+
+
+def plan_batches(cursor, batch_column, batch_size):
+    """
+    Splits the orders of the Orders table into ranges of the batch column.
+
+    Ranges are aligned on multiples of batch_size (order IDs, or days since
+    0001-01-01), so that a rerun over the same orders plans the same ranges.
+
+    Args:
+        cursor: The cursor to run the query with.
+        batch_column (str): "OrderID" or "OrderDate".
+        batch_size (int): The number of order IDs or days per batch.
+
+    Returns:
+        list: The (first, last) bounds of every batch, inclusive, as strings.
+    """
+    cursor.execute(f"SELECT MIN({batch_column}), MAX({batch_column}) FROM Orders;")
+    first, last = cursor.fetchone()
+    if first is None:
+        return []
+    if batch_column == 'OrderDate':
+        first, last = first.toordinal(), last.toordinal()
+        to_value = lambda ordinal: str(datetime.date.fromordinal(ordinal))
+    else:
+        to_value = str
+    start = first - (first - 1) % batch_size
+    return [(to_value(low), to_value(low + batch_size - 1)) for low in range(start, last + 1, batch_size)]
+
+
+def get_completed_batches(cursor, load_name, batch_column):
+    """
+    Reads the batches of a batched load that were already committed.
+
+    Args:
+        cursor: The cursor to run the queries with.
+        load_name (str): The name of the batched load.
+        batch_column (str): The column the load is batched on.
+
+    Returns:
+        set: The (first, last) bounds of the completed batches.
+    """
+    cursor.execute(fact_batches_ddl)
+    cursor.execute(
+        "SELECT RangeStart, RangeEnd FROM etl_fact_batches WHERE LoadName = %s AND BatchColumn = %s;",
+        (load_name, batch_column)
+    )
+    return set(cursor.fetchall())
+
+
+def load_fact_batch(conn, load_name, batch_column, first, last):
+    """
+    Loads the order lines of one range of the batch column into fact_orders.
+
+    Fact rows of the orders being loaded are replaced, and the batch is
+    recorded in etl_fact_batches in the same transaction, so a batch is either
+    loaded and checkpointed or not at all. The join runs into a temporary
+    staging table before fact_orders is locked, so concurrent batches only
+    serialize on the short delete and insert.
+
+    Args:
+        conn: The connection to run the batch on.
+        load_name (str): The name of the batched load.
+        batch_column (str): "OrderID" or "OrderDate".
+        first (str): The first value of the range.
+        last (str): The last value of the range.
+
+    Returns:
+        dict: The range, the number of staged, replaced and inserted rows and
+        the duration.
+    """
+    batch_type = watermark_columns[batch_column]['type']
+    start = time.perf_counter()
+    steps = StepRunner(conn, 'fact_orders_batch')
+    with conn.cursor() as cur:
+        try:
+            steps.run(cur, 'create_staging', schema.build_create_table(
+                'staging_fact_orders', schema.dialect_of(conn), temporary=True, relation='staging_fact_batch'))
+            staged_count = steps.run(
+                cur,
+                'insert_staging',
+                staging_fact_orders_insert.replace('INTO staging_fact_orders', 'INTO staging_fact_batch')
+                + f"WHERE o.{batch_column} BETWEEN CAST(%s AS {batch_type}) AND CAST(%s AS {batch_type});",
+                (first, last)
+            )
+            cur.execute("LOCK fact_orders, etl_fact_batches;")
+            replaced_count = steps.run(cur, 'delete_fact_orders', """
+                DELETE FROM fact_orders
+                USING (SELECT DISTINCT OrderID FROM staging_fact_batch) s
+                WHERE fact_orders.OrderID = s.OrderID;
+                """)
+            inserted_count = steps.run(
+                cur, 'insert_fact_orders', fact_orders_insert.replace('FROM staging_fact_orders', 'FROM staging_fact_batch'))
+            seconds = round(time.perf_counter() - start, 3)
+            cur.execute(
+                """
+                INSERT INTO etl_fact_batches
+                  (LoadName, BatchColumn, RangeStart, RangeEnd, RowsInserted, Seconds, CompletedAt)
+                VALUES (%s, %s, %s, %s, %s, %s, %s);
+                """,
+                (load_name, batch_column, first, last, inserted_count, seconds, datetime.datetime.utcnow())
+            )
+            steps.run(cur, 'drop_staging', "DROP TABLE staging_fact_batch;")
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    result = {
+        'load': load_name,
+        'range': [first, last],
+        'staged': staged_count,
+        'replaced': replaced_count,
+        'inserted': inserted_count,
+        'seconds': seconds
+    }
+    print(json.dumps(result))
+    return result
+
+
+def batched_fact_load(conn, batch_column='OrderID', batch_size=None, concurrency=1, load_name=None):
+    """
+    Loads the orders of the Orders table into fact_orders in separately
+    committed batches, resuming after the batches an earlier attempt completed.
+
+    Meant for backfills, where a single transaction would hold its locks for
+    hours and lose all its work on a late failure. The key maps are refreshed
+    once up front, then every range of plan_batches not yet recorded in
+    etl_fact_batches is loaded with load_fact_batch. When every batch is
+    done, the watermark of batch_column is moved past the loaded orders, so
+    that incremental loads carry on from there.
+
+    Args:
+        conn: The connection to the Redshift database.
+        batch_column (str): "OrderID" or "OrderDate".
+        batch_size (int): The number of order IDs or days per batch, see DEFAULT_BATCH_SIZES.
+        concurrency (int): The number of batches loaded at a time. Batches
+            beyond the first run on connections of the runtime pool.
+        load_name (str): The name the batches are checkpointed under; a rerun
+            with the same name skips the completed ones. Defaults to the run ID
+            of pipeline.steps, which a resumed workflow run keeps.
+
+    Returns:
+        dict: The number of batches planned, skipped and loaded, the inserted
+        rows and the watermark.
+    """
+    if batch_column not in watermark_columns:
+        raise Exception(f"Unsupported batch column: {batch_column}")
+    batch_size = int(batch_size or DEFAULT_BATCH_SIZES[batch_column])
+    concurrency = max(1, min(int(concurrency), runtime.POOL_MAX_CONNECTIONS - 1))
+    load_name = load_name or get_run_id()
+
+    steps = StepRunner(conn, 'fact_orders')
+    with conn.cursor() as cur:
+        try:
+            steps.run_all(cur, build_key_map_refresh_statements(schema.dialect_of(conn)))
+            batches = plan_batches(cur, batch_column, batch_size)
+            completed = get_completed_batches(cur, load_name, batch_column)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    pending = [batch for batch in batches if batch not in completed]
+    print(f"Batched load {load_name} on {batch_column}: {len(batches)} batches, "
+          f"{len(batches) - len(pending)} already completed")
+
+    results = []
+    failures = []
+    failed = threading.Event()
+
+    def run_batch(batch):
+        # Once a batch failed, the remaining ones are left for the rerun
+        if failed.is_set():
+            return
+        try:
+            if concurrency == 1:
+                results.append(load_fact_batch(conn, load_name, batch_column, *batch))
+            else:
+                with runtime.connection() as batch_conn:
+                    results.append(load_fact_batch(batch_conn, load_name, batch_column, *batch))
+        except Exception as error:
+            failed.set()
+            print(f"Batch {batch[0]}..{batch[1]} failed: {error}")
+            failures.append(f"{batch[0]}..{batch[1]}: {error}")
+
+    if concurrency == 1:
+        for batch in pending:
+            run_batch(batch)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(run_batch, pending))
+    if failures:
+        raise Exception(f"Batched load {load_name} failed, {len(results)} of {len(pending)} batches "
+                        f"were committed and are skipped by a rerun: {'; '.join(failures)}")
+
+    watermark = None
+    with conn.cursor() as cur:
+        try:
+            watermark = get_watermark(cur, 'orders', batch_column)
+            cur.execute(f"SELECT MAX({batch_column}) FROM Orders;")
+            loaded_max = cur.fetchone()[0]
+            if loaded_max is not None and (watermark is None or loaded_max > _watermark_value(batch_column, watermark)):
+                watermark = str(loaded_max)
+            if watermark is not None:
+                # Also stores a watermark recovered from fact_orders, like the first incremental load
+                set_watermark(cur, 'orders', batch_column, watermark)
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            raise
+
+    return {
+        'batches': len(batches),
+        'skipped': len(batches) - len(pending),
+        'loaded': len(results),
+        'inserted': sum(result['inserted'] or 0 for result in results),
+        'watermark': watermark
+    }
+
+
+def _watermark_value(watermark_column, watermark):
+    """
+    Converts a stored watermark to the Python type of its column.
+    """
+    if watermark_column == 'OrderDate':
+        return datetime.date.fromisoformat(watermark[:10])
+    return int(watermark)
+
+
+def load_facts(conn, fact_load_mode='incremental', watermark_column='OrderID', batch_size=None,
+               batch_concurrency=1, batch_load_name=None):
+    """
+    Populates fact_orders from Orders and OrderDetails.
+
+    Args:
+        conn: The connection to the Redshift database.
+        fact_load_mode (str): "incremental" only loads order lines beyond the
+            watermark, "full" re-joins the whole order history, "batched"
+            loads the Orders table in resumable batches, see batched_fact_load.
+        watermark_column (str): The Orders column the watermark is kept on,
+            which batched loads also split the orders on.
+        batch_size (int): The order IDs or days per batch of a batched load.
+        batch_concurrency (int): The number of batches loaded at a time.
+        batch_load_name (str): The name the batches are checkpointed under.
+
+    Returns:
+        dict: The staged and inserted counts, and the new watermark of an
+        incremental load; the batch counts of a batched load.
+    """
+    if fact_load_mode == 'incremental':
+        return incremental_fact_load(conn, watermark_column)
+    if fact_load_mode == 'batched':
+        return batched_fact_load(conn, watermark_column, batch_size, batch_concurrency, batch_load_name)
+    return full_fact_load(conn)
@@ -0,0 +1,136 @@
+import json
+
+import psycopg2
+
+from pipeline import schema
+from pipeline.fact import build_key_map_refresh_statements
+from pipeline.steps import StepRunner, get_run_id
+
+
+# Relationships the fact load joins on, whose orphans its inner joins would drop:
+# reason code -> (child table, child key, parent table, parent key)
+relationships = {
+    'MISSING_ORDER': ('OrderDetails', 'OrderID', 'Orders', 'OrderID'),
+    'MISSING_CUSTOMER': ('Orders', 'CustomerID', 'keymap_customers', 'CustomerID'),
+    'MISSING_STORE': ('Orders', 'StoreID', 'keymap_stores', 'StoreID'),
+    'MISSING_PRODUCT': ('OrderDetails', 'ProductID', 'keymap_products', 'ProductID'),
+    'MISSING_DATE': ('Orders', 'OrderDate', 'keymap_dates', 'Date')
+}
+
+# Columns of the order lines kept in etl_quarantine, so that they can be replayed once fixed:
+# the columns of the order followed by those of the line
+quarantined_columns = schema.tables['Orders']['columns'] + [
+    column for column in schema.tables['OrderDetails']['columns'] if column['name'] != 'OrderID'
+]
+
+_quarantined_definitions = ",\n      ".join(f"{column['name']} {column['type']}" for column in quarantined_columns)
+
+quarantine_ddl = f"""
+    CREATE TABLE IF NOT EXISTS etl_quarantine (
+      RunId VARCHAR(128) NOT NULL,
+      ReasonCode VARCHAR(32) NOT NULL,
+      SourceTable VARCHAR(64) NOT NULL,
+      KeyColumn VARCHAR(64) NOT NULL,
+      KeyValue VARCHAR(64),
+      QuarantinedAt TIMESTAMP NOT NULL,
+      {_quarantined_definitions}
+    );
+"""
+
+
+def ensure_quarantine_columns(cursor):
+    """
+    Adds the order line columns that an older etl_quarantine is missing.
+
+    Args:
+        cursor: The cursor to run the statements with.
+    """
+    cursor.execute("SELECT column_name FROM information_schema.columns WHERE table_name = 'etl_quarantine';")
+    existing = {row[0].lower() for row in cursor.fetchall()}
+    for column in quarantined_columns:
+        if column['name'].lower() not in existing:
+            cursor.execute(f"ALTER TABLE etl_quarantine ADD COLUMN {column['name']} {column['type']};")
+
+
+def build_orphan_insert(reason_code):
+    """
+    Builds the anti-join that copies the orphans of one relationship into etl_quarantine.
+
+    The whole order line is copied, the columns of its order included, and
+    an orphan order is copied once per line, or once when it has no lines.
+
+    Args:
+        reason_code (str): The reason code of the relationship, see relationships.
+
+    Returns:
+        str: The INSERT statement, taking the run ID as its parameter.
+    """
+    child_table, child_key, parent_table, parent_key = relationships[reason_code]
+    if child_table == 'OrderDetails':
+        child, alias = "OrderDetails d LEFT JOIN Orders o ON d.OrderID = o.OrderID", 'd'
+    else:
+        child, alias = "Orders o LEFT JOIN OrderDetails d ON d.OrderID = o.OrderID", 'o'
+    order_columns = schema.column_names('Orders')
+    names = [column['name'] for column in quarantined_columns]
+    values = [f"{alias}.OrderID" if name == 'OrderID' else f"{'o' if name in order_columns else 'd'}.{name}"
+              for name in names]
+    return f"""
+        INSERT INTO etl_quarantine (RunId, ReasonCode, SourceTable, KeyColumn, KeyValue, QuarantinedAt, {', '.join(names)})
+        SELECT %s, '{reason_code}', '{child_table}', '{child_key}',
+               CAST({alias}.{child_key} AS VARCHAR(64)), CURRENT_TIMESTAMP, {', '.join(values)}
+        FROM {child}
+        LEFT JOIN (SELECT DISTINCT {parent_key} FROM {parent_table}) p ON {alias}.{child_key} = p.{parent_key}
+        WHERE p.{parent_key} IS NULL;
+        """
+
+
+def check_references(conn, orphan_action='quarantine'):
+    """
+    Finds the order lines the fact load would drop for a missing parent row.
+
+    Every relationship of relationships is checked with one anti-join pass
+    that copies the order lines it would drop into etl_quarantine, with
+    every column of the line and its order, tagged with the run ID and a
+    reason code, so they can be fixed and replayed instead of silently lost.
+    The key maps are refreshed first, as the fact load joins on them. Orphans
+    of an earlier check of the same run are replaced.
+
+    Args:
+        conn: The connection to the Redshift database.
+        orphan_action (str): "quarantine" records the orphans and lets the
+            fact load go on without them, "fail" also raises an exception
+            when there are any.
+
+    Returns:
+        dict: The number of quarantined rows per reason code.
+    """
+    if orphan_action not in ('quarantine', 'fail'):
+        raise Exception(f"Unsupported orphan action: {orphan_action}")
+
+    run_id = get_run_id()
+    steps = StepRunner(conn, 'check_references')
+    with conn.cursor() as cur:
+        try:
+            steps.run_all(cur, build_key_map_refresh_statements(schema.dialect_of(conn)))
+            steps.run(cur, 'create_quarantine', quarantine_ddl)
+            ensure_quarantine_columns(cur)
+            steps.run(cur, 'clear_quarantine', "DELETE FROM etl_quarantine WHERE RunId = %s;", (run_id,))
+            orphans = {
+                reason_code: steps.run(cur, f"quarantine_{reason_code.lower()}", build_orphan_insert(reason_code), (run_id,))
+                for reason_code in relationships
+            }
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    print(json.dumps({'run_id': run_id, 'orphans': orphans}))
+    total = sum(orphans.values())
+    if total:
+        print(f"{total} orphan rows were quarantined in etl_quarantine under run {run_id}")
+        if orphan_action == 'fail':
+            found = ", ".join(f"{reason_code}: {count}" for reason_code, count in orphans.items() if count)
+            raise Exception(f"Referential integrity check failed: {found}")
+    return orphans
@@ -0,0 +1,199 @@
+import datetime
+import hashlib
+import json
+
+from pipeline import runtime
+from pipeline.steps import get_run_id
+
+
+# Bytes of a local file hashed at a time
+HASH_CHUNK_SIZE = 1024 * 1024
+
+ledger_ddl = """
+    CREATE TABLE IF NOT EXISTS etl_load_ledger (
+      TableName VARCHAR(64) NOT NULL,
+      SourceUri VARCHAR(1024) NOT NULL,
+      Fingerprint CHAR(64) NOT NULL,
+      Bytes BIGINT,
+      Status VARCHAR(16) NOT NULL,
+      RunId VARCHAR(128),
+      LoadedAt TIMESTAMP NOT NULL
+    );
+"""
+
+
+def _list_objects(bucket, prefix):
+    """
+    Lists the key, ETag and size of every non-empty object under a prefix.
+    """
+    s3_client = runtime.get_client('s3')
+    objects = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        objects += [(item['Key'], item['ETag'], item['Size']) for item in response.get('Contents', []) if item['Size'] > 0]
+        if not response.get('IsTruncated'):
+            return objects
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def _head_object(bucket, key):
+    response = runtime.get_client('s3').head_object(Bucket=bucket, Key=key)
+    return key, response['ETag'], response['ContentLength']
+
+
+def _digest(objects):
+    """
+    Hashes the (key, ETag, size) of a set of objects, in key order.
+
+    Returns:
+        tuple: The fingerprint and the total size in bytes.
+    """
+    lines = ["\t".join([key, etag.strip('"'), str(size)]) for key, etag, size in sorted(objects)]
+    return hashlib.sha256("\n".join(lines).encode('utf-8')).hexdigest(), sum(size for _, _, size in objects)
+
+
+def fingerprint_s3_source(bucket, key):
+    """
+    Fingerprints the S3 objects a COPY would load from their ETags and sizes,
+    without reading them.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        key (str): The key of a file, a prefix ending with '/' or a manifest.
+
+    Returns:
+        tuple: The fingerprint and the total size in bytes.
+    """
+    if key.lower().endswith('.manifest'):
+        body = runtime.get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        objects = []
+        for entry in json.loads(body)['entries']:
+            entry_bucket, entry_key = entry['url'][len('s3://'):].split('/', 1)
+            objects.append(_head_object(entry_bucket, entry_key))
+        return _digest(objects)
+    if key.endswith('/'):
+        return _digest(_list_objects(bucket, key))
+    return _digest([_head_object(bucket, key)])
+
+
+def fingerprint_file(path):
+    """
+    Fingerprints a local file by hashing its content.
+
+    Args:
+        path (str): The path of the file, or an S3 URL, which is fingerprinted
+            from its ETag like fingerprint_s3_source does.
+
+    Returns:
+        tuple: The fingerprint and the size in bytes.
+    """
+    if path.startswith('s3://'):
+        bucket, key = path[len('s3://'):].split('/', 1)
+        return fingerprint_s3_source(bucket, key)
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def create_ledger_table(conn):
+    """
+    Creates the load ledger table unless it exists.
+
+    Loads running at the same time would race to create it, so run this first.
+
+    Args:
+        conn: The connection to the Redshift database.
+    """
+    with conn.cursor() as cur:
+        cur.execute(ledger_ddl)
+    conn.commit()
+
+
+def is_loaded(conn, table_name, fingerprint):
+    """
+    Tells whether a table still holds the validated load of the given content.
+
+    Only the latest load of the table counts: content loaded before another
+    load, or whose load did not finish its validation, is loaded again.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+        fingerprint (str): The fingerprint of the content.
+
+    Returns:
+        bool: True when the latest load of the table is a validated load of the content.
+    """
+    with conn.cursor() as cur:
+        cur.execute(ledger_ddl)
+        cur.execute(
+            """
+            SELECT Fingerprint, Status FROM etl_load_ledger
+            WHERE TableName = %s
+            ORDER BY LoadedAt DESC
+            LIMIT 1;
+            """,
+            (table_name,)
+        )
+        row = cur.fetchone()
+    conn.commit()
+    return row is not None and row[0] == fingerprint and row[1] == 'loaded'
+
+
+def record_load_start(cursor, table_name, source_uri, fingerprint, size):
+    """
+    Records a load as started, in the transaction that replaces the table's data.
+
+    Args:
+        cursor: The cursor of that transaction.
+        table_name (str): The name of the table.
+        source_uri (str): The location of the content.
+        fingerprint (str): The fingerprint of the content.
+        size (int): The size of the content in bytes.
+    """
+    cursor.execute(ledger_ddl)
+    cursor.execute(
+        """
+        INSERT INTO etl_load_ledger (TableName, SourceUri, Fingerprint, Bytes, Status, RunId, LoadedAt)
+        VALUES (%s, %s, %s, %s, 'loading', %s, %s);
+        """,
+        (table_name, source_uri, fingerprint, size, get_run_id(), datetime.datetime.utcnow())
+    )
+
+
+def record_load_done(conn, table_name, fingerprint):
+    """
+    Marks the started load of a table as validated, once its data is in place.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+        fingerprint (str): The fingerprint of the content.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE etl_load_ledger SET Status = 'loaded'
+            WHERE TableName = %s AND Fingerprint = %s AND Status = 'loading' AND RunId = %s;
+            """,
+            (table_name, fingerprint, get_run_id())
+        )
+    conn.commit()
+
+
+def report_skip(table_name, source_uri, fingerprint):
+    """
+    Prints the metrics of a load skipped because its content was already loaded.
+
+    Returns:
+        dict: The metrics.
+    """
+    metrics = {'table': table_name, 'source': source_uri, 'fingerprint': fingerprint, 'skipped': True}
+    print(json.dumps(metrics))
+    print(f"{source_uri} was already loaded into {table_name} and validated, load skipped")
+    return metrics
@@ -0,0 +1,174 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import runtime
+from pipeline.ledger import create_ledger_table
+from pipeline.profiling import create_stats_table
+from pipeline.s3_copy import copy_options_from_params
+from pipeline.streaming import stream_data_to_table
+from pipeline.validation import copy_data_to_redshift, table_columns
+
+
+# Tables loaded at a time by default; match it to the slots of the WLM queue the loads run in
+DEFAULT_LOAD_CONCURRENCY = 3
+
+
+def source_table_name(table_name):
+    """
+    Returns the table name as spelled in table_columns.
+
+    Args:
+        table_name (str): The name of the source table, in any case.
+
+    Returns:
+        str: The canonical table name.
+    """
+    for name in table_columns:
+        if name.lower() == table_name.lower():
+            return name
+    raise Exception(f"Table Not Found: {table_name}")
+
+
+def check_unique_tables(files):
+    """
+    Makes sure that no two files load the same table.
+
+    Every load replaces the contents of its table, so a second file would
+    silently replace the first. A table split across files is loaded from
+    a prefix or a manifest instead.
+
+    Args:
+        files (list): The files, see load_file.
+    """
+    tables = [source_table_name(file['table_name']) for file in files]
+    duplicates = sorted({table_name for table_name in tables if tables.count(table_name) > 1})
+    if duplicates:
+        raise Exception(f"Several files load {', '.join(duplicates)}; "
+                        f"load the files of a table from one S3 prefix or manifest instead")
+
+
+def load_file(file, conn):
+    """
+    Copies one file into its source table and validates it.
+
+    Args:
+        file (dict): The file, with table_name and either bucket and key,
+            optionally with the COPY options of pipeline.s3_copy, or a local path.
+        conn: The connection to load over.
+
+    Returns:
+        The result of copy_data_to_redshift, or the load metrics of
+        stream_data_to_table; either has 'skipped' set when the file was
+        already loaded.
+    """
+    table_name = source_table_name(file['table_name'])
+    if 'path' in file:
+        # Local files are streamed through the connection instead of COPY from S3
+        return stream_data_to_table(
+            file['path'], table_name, conn, file.get('data_format'), preflight=file.get('preflight', 'none'),
+            force_load=str(file.get('force_load', 'false')).lower() == 'true')
+    return copy_data_to_redshift(file['bucket'], file['key'], table_name, conn, **copy_options_from_params(file))
+
+
+def _load_pooled(file):
+    """
+    Loads one file over a pooled connection, catching its error.
+
+    Returns:
+        dict: The table, status ("succeeded", "unchanged" when the file was
+        already loaded, or "failed"), duration in seconds and result or error.
+    """
+    start = time.perf_counter()
+    try:
+        with runtime.connection() as conn:
+            result = load_file(file, conn)
+        status = 'unchanged' if result.get('skipped') else 'succeeded'
+    except Exception as error:
+        print(f"Loading {file['table_name']} failed: {error}")
+        status, result = 'failed', str(error)
+    table_result = {
+        'table': file['table_name'],
+        'status': status,
+        'seconds': round(time.perf_counter() - start, 3),
+        'result': result
+    }
+    print(json.dumps(table_result, default=str))
+    return table_result
+
+
+async def load_files_async(files, concurrency=DEFAULT_LOAD_CONCURRENCY):
+    """
+    Loads and validates several files at once from an event loop.
+
+    psycopg2 blocks, so every load runs on a worker thread of a pool sized to
+    the concurrency, while a semaphore keeps at most that many loads, and
+    pooled connections, busy at a time.
+
+    Args:
+        files (list): The files, see load_file.
+        concurrency (int): The number of loads running at a time.
+
+    Returns:
+        list: One dict per file, in the order of files, see _load_pooled.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(file):
+        async with semaphore:
+            return await loop.run_in_executor(executor, _load_pooled, file)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(await asyncio.gather(*[load(file) for file in files]))
+
+
+def load_files(files, concurrency=DEFAULT_LOAD_CONCURRENCY):
+    """
+    Loads and validates several files at once and reports on each of them.
+
+    Each file is copied into its table and validated like copy_data_to_redshift
+    does for one file; a failed load does not stop the others. When an event
+    loop is already running in this thread, a plain thread pool runs the loads
+    instead.
+
+    Args:
+        files (list): The files, see load_file.
+        concurrency (int): The number of loads running at a time, at most the
+            size of the runtime connection pool.
+
+    Returns:
+        dict: The concurrency, the result of every file and the overall duration.
+    """
+    # asyncio is only imported by the jobs that load several tables, keeping the others' start fast
+    import asyncio
+
+    check_unique_tables(files)
+    concurrency = max(1, min(int(concurrency), runtime.POOL_MAX_CONNECTIONS, len(files) or 1))
+    start = time.perf_counter()
+    with runtime.connection() as conn:
+        create_ledger_table(conn)
+        create_stats_table(conn)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        results = asyncio.run(load_files_async(files, concurrency))
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(_load_pooled, files))
+
+    report = {
+        'concurrency': concurrency,
+        'tables': results,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+    print(json.dumps({
+        'concurrency': concurrency,
+        'loaded': sum(result['status'] == 'succeeded' for result in results),
+        'unchanged': sum(result['status'] == 'unchanged' for result in results),
+        'failed': sum(result['status'] == 'failed' for result in results),
+        'seconds': report['seconds']
+    }))
+    return report
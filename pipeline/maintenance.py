@@ -0,0 +1,194 @@
+import json
+import time
+
+import psycopg2
+
+from pipeline import runtime
+
+
+# Percentages past which a table is vacuumed or analyzed: the share of its rows
+# outside the sorted region, the share of its rows deleted but not reclaimed,
+# and how stale its planner statistics are
+DEFAULT_THRESHOLDS = {'unsorted_pct': 10.0, 'deleted_pct': 10.0, 'stats_off_pct': 10.0}
+
+# Workflow properties overriding the thresholds
+threshold_params = {
+    'unsorted_pct': 'vacuum_unsorted_pct',
+    'deleted_pct': 'vacuum_deleted_pct',
+    'stats_off_pct': 'analyze_stats_off_pct'
+}
+
+
+def thresholds_from_params(params):
+    """
+    Reads the maintenance thresholds of a workflow run from its properties.
+
+    Args:
+        params (dict): The workflow parameters.
+
+    Returns:
+        dict: The thresholds, see DEFAULT_THRESHOLDS.
+    """
+    return {name: float(params.get(param, DEFAULT_THRESHOLDS[name])) for name, param in threshold_params.items()}
+
+
+def _percent(part, whole):
+    return round(100.0 * part / whole, 2) if whole else 0.0
+
+
+def read_table_health(conn, table_names):
+    """
+    Reads how unsorted, bloated and stale the given tables are.
+
+    On Redshift the figures come from svv_table_info, which leaves out empty
+    tables. On the PostgreSQL stand-in they come from pg_stat_user_tables,
+    whose tables have no sorted region and whose statistics are as stale as
+    the share of rows modified since they were last analyzed.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_names (list): The tables.
+
+    Returns:
+        dict: By table name, the unsorted, deleted and stats-off percentages
+        and the size in bytes.
+    """
+    names = tuple(table_name.lower() for table_name in table_names)
+    health = {}
+    with conn.cursor() as cur:
+        if runtime.is_redshift(conn):
+            cur.execute(
+                """
+                SELECT "table", COALESCE(unsorted, 0), COALESCE(stats_off, 0), tbl_rows,
+                       COALESCE(estimated_visible_rows, tbl_rows), size
+                FROM svv_table_info
+                WHERE schema = current_schema() AND "table" IN %s;
+                """,
+                (names,)
+            )
+            for table_name, unsorted, stats_off, rows, visible_rows, size in cur.fetchall():
+                health[table_name] = {
+                    'unsorted_pct': float(unsorted),
+                    'deleted_pct': _percent(max(rows - visible_rows, 0), rows),
+                    'stats_off_pct': float(stats_off),
+                    # size counts 1 MB blocks
+                    'bytes': size * 1024 * 1024
+                }
+        else:
+            if conn.server_version >= 150000:
+                # The counters of this session's own writes are only published once it goes idle
+                cur.execute("SELECT pg_stat_force_next_flush();")
+                conn.commit()
+            cur.execute(
+                """
+                SELECT relname, n_live_tup, n_dead_tup, n_mod_since_analyze,
+                       COALESCE(last_analyze, last_autoanalyze) IS NULL, pg_total_relation_size(relid)
+                FROM pg_stat_user_tables
+                WHERE schemaname = current_schema() AND relname IN %s;
+                """,
+                (names,)
+            )
+            for table_name, live_rows, dead_rows, modified_rows, never_analyzed, size in cur.fetchall():
+                health[table_name] = {
+                    'unsorted_pct': 0.0,
+                    'deleted_pct': _percent(dead_rows, live_rows + dead_rows),
+                    'stats_off_pct': 100.0 if never_analyzed and live_rows else min(_percent(modified_rows, live_rows), 100.0),
+                    'bytes': size
+                }
+    conn.commit()
+    return health
+
+
+def plan_maintenance(table_name, health, thresholds, dialect='redshift'):
+    """
+    Works out the VACUUM and ANALYZE statements a table needs.
+
+    Args:
+        table_name (str): The name of the table.
+        health (dict): The figures of the table, see read_table_health.
+        thresholds (dict): The thresholds, see DEFAULT_THRESHOLDS.
+        dialect (str): "redshift" or "postgres".
+
+    Returns:
+        list: The statements, empty when the table is within every threshold.
+    """
+    unsorted = health['unsorted_pct'] > thresholds['unsorted_pct']
+    deleted = health['deleted_pct'] > thresholds['deleted_pct']
+    stale = health['stats_off_pct'] > thresholds['stats_off_pct']
+
+    statements = []
+    if dialect == 'redshift':
+        if unsorted and deleted:
+            statements.append(f"VACUUM FULL {table_name};")
+        elif unsorted:
+            statements.append(f"VACUUM SORT ONLY {table_name};")
+        elif deleted:
+            statements.append(f"VACUUM DELETE ONLY {table_name};")
+        if stale:
+            # Only the columns used in joins, filters and group bys matter to the planner
+            statements.append(f"ANALYZE {table_name} PREDICATE COLUMNS;")
+    else:
+        if deleted:
+            statements.append(f"VACUUM {table_name};")
+        if stale:
+            statements.append(f"ANALYZE {table_name};")
+    return statements
+
+
+def maintain_tables(conn, table_names, thresholds=None):
+    """
+    Vacuums and analyzes the tables past the thresholds, leaving the others alone.
+
+    VACUUM cannot run in a transaction, so the statements run in autocommit
+    mode. A failed statement, e.g. because another VACUUM is running on the
+    cluster, is printed and does not stop the other tables.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_names (list): The tables.
+        thresholds (dict): The thresholds, see DEFAULT_THRESHOLDS. Defaults
+            to DEFAULT_THRESHOLDS.
+
+    Returns:
+        list: One dict per table with its figures, the statements run, their
+        duration in seconds, the bytes reclaimed and the errors.
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    dialect = 'redshift' if runtime.is_redshift(conn) else 'postgres'
+    health = read_table_health(conn, table_names)
+
+    results = []
+    for table_name in table_names:
+        before = health.get(table_name.lower())
+        if before is None:
+            print(f"No health figures for {table_name}, maintenance skipped")
+            continue
+        statements = plan_maintenance(table_name, before, thresholds, dialect)
+        result = dict(before, table=table_name, statements=statements, seconds=0.0, reclaimed_bytes=0, errors=[])
+        if statements:
+            start = time.perf_counter()
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    for statement in statements:
+                        print(f"SQL: {statement}")
+                        try:
+                            cur.execute(statement)
+                        except psycopg2.Error as e:
+                            print(f"Maintenance of {table_name} failed: {e}")
+                            result['errors'].append(str(e).strip())
+            finally:
+                conn.autocommit = False
+            result['seconds'] = round(time.perf_counter() - start, 3)
+            after = read_table_health(conn, [table_name]).get(table_name.lower(), before)
+            result['reclaimed_bytes'] = before['bytes'] - after['bytes']
+        print(json.dumps(result))
+        results.append(result)
+
+    print(json.dumps({
+        'tables': len(results),
+        'maintained': sum(bool(result['statements']) for result in results),
+        'seconds': round(sum(result['seconds'] for result in results), 3),
+        'reclaimed_bytes': sum(result['reclaimed_bytes'] for result in results)
+    }))
+    return results
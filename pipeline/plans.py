@@ -0,0 +1,263 @@
+import datetime
+import hashlib
+import json
+import re
+import threading
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+
+# Table the captured plans are written to
+PLAN_HISTORY_TABLE = 'etl_query_plans'
+
+# Relative growth of a plan's estimated cost over the last run that counts as a regression
+DEFAULT_COST_THRESHOLD = 0.5
+
+# Redshift join steps that broadcast or redistribute rows across the slices
+redistribution_labels = ['DS_BCAST_INNER', 'DS_DIST_ALL_INNER', 'DS_DIST_BOTH', 'DS_DIST_INNER', 'DS_DIST_OUTER']
+
+# Statements EXPLAIN accepts on both Redshift and PostgreSQL
+explainable_statements = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# CREATE [TEMP] TABLE ... AS query, which EXPLAIN accepts as well
+_create_table_as = re.compile(r"CREATE\s+(TEMP\s+|TEMPORARY\s+)?TABLE\b.*?\bAS\s*\(?\s*(SELECT|WITH)\b",
+                              re.IGNORECASE | re.DOTALL)
+
+_lock = threading.Lock()
+_settings = {'mode': 'off', 'cost_threshold': DEFAULT_COST_THRESHOLD}
+
+
+def set_plan_capture(mode='off', cost_threshold=DEFAULT_COST_THRESHOLD):
+    """
+    Sets whether the SQL steps of this process have their plans captured.
+
+    Args:
+        mode (str): "off", "warn" to print plan regressions, or "fail" to
+            stop a step whose plan regressed before it runs.
+        cost_threshold (float): The relative cost growth that counts as a regression.
+    """
+    if mode not in ('off', 'warn', 'fail'):
+        raise Exception(f"Unsupported plan capture mode: {mode}")
+    with _lock:
+        _settings['mode'] = mode
+        _settings['cost_threshold'] = float(cost_threshold)
+
+
+def get_plan_capture():
+    """
+    Returns the plan capture settings.
+
+    Returns:
+        dict: The mode and the cost threshold.
+    """
+    with _lock:
+        return dict(_settings)
+
+
+def is_explainable(statement):
+    """
+    Tells whether EXPLAIN can be run on a statement.
+
+    Args:
+        statement (str): The SQL statement.
+
+    Returns:
+        bool: True for queries, DML other than MERGE and CREATE TABLE ... AS.
+    """
+    words = statement.split(None, 1)
+    if not words:
+        return False
+    return words[0].upper() in explainable_statements or bool(_create_table_as.match(statement.strip()))
+
+
+def build_plan_history_ddl():
+    """
+    Builds the DDL of the plan history table.
+
+    Returns:
+        str: The CREATE TABLE statement.
+    """
+    return f"""
+        CREATE TABLE IF NOT EXISTS {PLAN_HISTORY_TABLE} (
+          RunId VARCHAR(128) NOT NULL,
+          JobName VARCHAR(128) NOT NULL,
+          StepName VARCHAR(128) NOT NULL,
+          Fingerprint CHAR(40) NOT NULL,
+          TotalCost DOUBLE PRECISION,
+          Redistribution VARCHAR(256),
+          Accepted BOOLEAN NOT NULL,
+          CapturedAt TIMESTAMP NOT NULL,
+          PlanText VARCHAR(65535)
+        );
+        """
+
+
+def parse_plan(lines):
+    """
+    Summarizes the output of EXPLAIN.
+
+    The fingerprint hashes the plan's operators and their nesting, with costs,
+    row estimates and literals left out, so it changes only when the shape of
+    the plan does.
+
+    Args:
+        lines (list): The lines of the EXPLAIN output.
+
+    Returns:
+        dict: The fingerprint, the estimated total cost, the redistribution
+        labels of the plan and its text.
+    """
+    normalized = []
+    for line in lines:
+        line = re.sub(r"\s*\(cost=[^)]*\)", "", line.rstrip())
+        line = re.sub(r"'[^']*'", "?", line)
+        line = re.sub(r"\b\d+(\.\d+)?\b", "?", line)
+        if line.strip():
+            normalized.append(line)
+    cost = None
+    for line in lines:
+        match = re.search(r"cost=[\d.]+\.\.([\d.]+)", line)
+        if match:
+            cost = float(match.group(1))
+            break
+    text = "\n".join(lines)
+    return {
+        'fingerprint': hashlib.sha1("\n".join(normalized).encode('utf-8')).hexdigest(),
+        'cost': cost,
+        'redistribution': sorted({label for label in redistribution_labels if label in text}),
+        'text': text
+    }
+
+
+def find_regressions(plan, previous, cost_threshold):
+    """
+    Compares a plan with the plan the same step had in the last run.
+
+    Args:
+        plan (dict): The plan, see parse_plan.
+        previous (dict): The last accepted plan of the step, or None.
+        cost_threshold (float): The relative cost growth that counts as a regression.
+
+    Returns:
+        list: The regressions, as messages. Empty when there is no previous plan.
+    """
+    if previous is None:
+        return []
+    regressions = []
+    added = [label for label in plan['redistribution'] if label not in previous['redistribution']]
+    if added:
+        regressions.append(f"new redistribution steps {', '.join(added)}")
+    if plan['cost'] is not None and previous['cost'] and plan['cost'] > previous['cost'] * (1 + cost_threshold):
+        regressions.append(f"cost grew from {previous['cost']:.2f} to {plan['cost']:.2f}")
+    return regressions
+
+
+class PlanRecorder:
+    """
+    Captures the plans of the SQL steps of a job and compares each with the
+    plan the step had in the last run.
+    """
+
+    def __init__(self, conn, job_name, run_id):
+        self.conn = conn
+        self.job_name = job_name
+        self.run_id = run_id
+        self.plans = []
+        self._previous = None
+
+    def _previous_plans(self, cur):
+        """
+        Reads the last accepted plan of every step of the job in an earlier run.
+        """
+        if self._previous is None:
+            cur.execute(build_plan_history_ddl())
+            cur.execute(f"""
+                SELECT StepName, Fingerprint, TotalCost, Redistribution
+                FROM (
+                  SELECT StepName, Fingerprint, TotalCost, Redistribution,
+                         ROW_NUMBER() OVER (PARTITION BY StepName ORDER BY CapturedAt DESC) AS Position
+                  FROM {PLAN_HISTORY_TABLE}
+                  WHERE JobName = %s AND RunId <> %s AND Accepted
+                ) t
+                WHERE Position = 1;
+                """, (self.job_name, self.run_id))
+            self._previous = {
+                step_name: {
+                    'fingerprint': fingerprint,
+                    'cost': cost,
+                    'redistribution': redistribution.split(',') if redistribution else []
+                }
+                for step_name, fingerprint, cost, redistribution in cur.fetchall()
+            }
+        return self._previous
+
+    def check(self, cur, step_name, statement, params=None):
+        """
+        Runs EXPLAIN on a step's statement and checks its plan for regressions.
+
+        Args:
+            cur: The cursor to run EXPLAIN with.
+            step_name (str): The name of the step.
+            statement (str): The SQL statement.
+            params: The query parameters of the statement.
+
+        Returns:
+            dict: The plan, see parse_plan, with its regressions. Raises an
+            exception when there are any in "fail" mode.
+        """
+        settings = get_plan_capture()
+        previous = self._previous_plans(cur).get(step_name)
+        cur.execute("EXPLAIN " + statement.strip(), params)
+        plan = parse_plan([row[0] for row in cur.fetchall()])
+        plan['step'] = step_name
+        plan['regressions'] = find_regressions(plan, previous, settings['cost_threshold'])
+        plan['accepted'] = not (plan['regressions'] and settings['mode'] == 'fail')
+        plan['captured_at'] = datetime.datetime.utcnow()
+        self.plans.append(plan)
+
+        print(json.dumps({
+            'job': self.job_name,
+            'step': step_name,
+            'fingerprint': plan['fingerprint'],
+            'changed': previous is not None and previous['fingerprint'] != plan['fingerprint'],
+            'cost': plan['cost'],
+            'redistribution': plan['redistribution'],
+            'regressions': plan['regressions']
+        }))
+        if plan['regressions']:
+            message = f"Plan regression in {self.job_name}.{step_name}: {'; '.join(plan['regressions'])}"
+            print(message)
+            print(plan['text'])
+            if not plan['accepted']:
+                raise Exception(message)
+        return plan
+
+    def save(self):
+        """
+        Writes the captured plans to the plan history table.
+
+        Call it after the job's transaction was committed or rolled back.
+        Rejected plans are kept but never become the baseline of later runs.
+        A failure to write the plans is printed and does not fail the job.
+        """
+        if not self.plans:
+            return
+        rows = [
+            (self.run_id, self.job_name, plan['step'], plan['fingerprint'], plan['cost'],
+             ','.join(plan['redistribution']), plan['accepted'], plan['captured_at'], plan['text'][:65535])
+            for plan in self.plans
+        ]
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(build_plan_history_ddl())
+                execute_values(cur, f"""
+                    INSERT INTO {PLAN_HISTORY_TABLE}
+                      (RunId, JobName, StepName, Fingerprint, TotalCost, Redistribution, Accepted, CapturedAt, PlanText)
+                    VALUES %s;
+                    """, rows)
+            self.conn.commit()
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            print(f"Failed to write the plans of {self.job_name}: {e}")
+        self.plans = []
@@ -0,0 +1,364 @@
+import json
+import math
+import time
+from array import array
+
+from pipeline import runtime, schema
+from pipeline.s3_copy import describe_source, list_keys, open_source
+
+
+# Errors collected before a file is rejected
+DEFAULT_MAX_ERRORS = 10
+
+# False-positive rate of each Bloom filter of the "bloom" key mode
+DEFAULT_ERROR_RATE = 0.001
+
+# Keys the first Bloom filter is sized for; further filters double it
+DEFAULT_BLOOM_CAPACITY = 1024 * 1024
+
+_MASK64 = (1 << 64) - 1
+_EMPTY = -(1 << 63)
+
+
+def _mix64(value):
+    """
+    Scrambles a 64-bit integer (splitmix64 finalizer), so that sequential IDs spread evenly.
+    """
+    value = (value + 0x9E3779B97F4A7C15) & _MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return value ^ (value >> 31)
+
+
+class IntKeySet:
+    """
+    Set of 64-bit integers in an open-addressing hash table backed by one
+    array, about 16 bytes per key instead of the ~70 of a Python set.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 1
+        while size < 2 * capacity:
+            size *= 2
+        self._slots = array('q', [_EMPTY]) * size
+        self._count = 0
+        self._has_empty = False
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._slots) * self._slots.itemsize
+
+    def _grow(self):
+        old_slots = self._slots
+        self._slots = array('q', [_EMPTY]) * (2 * len(old_slots))
+        mask = len(self._slots) - 1
+        for key in old_slots:
+            if key != _EMPTY:
+                i = _mix64(key & _MASK64) & mask
+                while self._slots[i] != _EMPTY:
+                    i = (i + 1) & mask
+                self._slots[i] = key
+
+    def add(self, key):
+        """
+        Adds a key.
+
+        Args:
+            key (int): The key, within the signed 64-bit range.
+
+        Returns:
+            bool: False when the key was already in the set.
+        """
+        if key == _EMPTY:
+            added = not self._has_empty
+            self._has_empty = True
+            self._count += added
+            return added
+        slots = self._slots
+        mask = len(slots) - 1
+        i = _mix64(key & _MASK64) & mask
+        while True:
+            slot = slots[i]
+            if slot == _EMPTY:
+                slots[i] = key
+                self._count += 1
+                if 2 * self._count > len(slots):
+                    self._grow()
+                return True
+            if slot == key:
+                return False
+            i = (i + 1) & mask
+
+
+class KeyBloomFilter:
+    """
+    Scalable Bloom filter of 64-bit integers, about 2 bytes per key at the
+    default error rate. A new filter of twice the capacity and half the error
+    rate is added whenever the last one is full, so the number of keys need
+    not be known up front and the overall error rate stays below twice
+    error_rate. Membership answers may be false positives, never false negatives.
+    """
+
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.error_rate = error_rate
+        self._filters = []
+        self._add_filter(capacity, error_rate)
+
+    def _add_filter(self, capacity, error_rate):
+        bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, int(round(bits / capacity * math.log(2))))
+        self._filters.append({'bits': bytearray((bits + 7) // 8), 'size': bits, 'hashes': hashes,
+                              'capacity': capacity, 'error_rate': error_rate, 'count': 0})
+
+    @property
+    def nbytes(self):
+        return sum(len(bloom['bits']) for bloom in self._filters)
+
+    @staticmethod
+    def _positions(bloom, key):
+        h1 = _mix64(key & _MASK64)
+        h2 = _mix64(h1) | 1
+        return [(h1 + i * h2) % bloom['size'] for i in range(bloom['hashes'])]
+
+    def __contains__(self, key):
+        for bloom in self._filters:
+            if all(bloom['bits'][p >> 3] & (1 << (p & 7)) for p in self._positions(bloom, key)):
+                return True
+        return False
+
+    def add(self, key):
+        """
+        Adds a key.
+
+        Args:
+            key (int): The key.
+
+        Returns:
+            bool: False when the key may already have been added.
+        """
+        if key in self:
+            return False
+        bloom = self._filters[-1]
+        if bloom['count'] >= bloom['capacity']:
+            self._add_filter(2 * bloom['capacity'], bloom['error_rate'] / 2)
+            bloom = self._filters[-1]
+        for p in self._positions(bloom, key):
+            bloom['bits'][p >> 3] |= 1 << (p & 7)
+        bloom['count'] += 1
+        return True
+
+
+def _parse_record(line, lines):
+    """
+    Splits a CSV record holding quotes into its fields, reading on while a
+    quoted field spans lines.
+
+    Returns:
+        tuple: The fields, None for the unquoted empty ones, and the number of
+        lines read after the first one.
+    """
+    fields = []
+    extra_lines = 0
+    pos = 0
+    while True:
+        if not line.startswith('"', pos):
+            comma = line.find(',', pos)
+            fields.append((line[pos:] if comma < 0 else line[pos:comma]) or None)
+            if comma < 0:
+                return fields, extra_lines
+            pos = comma + 1
+            continue
+        value = []
+        pos += 1
+        while True:
+            quote = line.find('"', pos)
+            if quote < 0:
+                value.append(line[pos:])
+                next_line = next(lines, None)
+                if next_line is None:
+                    fields.append(''.join(value))
+                    return fields, extra_lines
+                extra_lines += 1
+                value.append('\n')
+                line = next_line.rstrip('\r\n')
+                pos = 0
+                continue
+            value.append(line[pos:quote])
+            pos = quote + 1
+            if not line.startswith('"', pos):
+                break
+            # A doubled quote is a literal quote
+            value.append('"')
+            pos += 1
+        comma = line.find(',', pos)
+        value.append(line[pos:] if comma < 0 else line[pos:comma])
+        fields.append(''.join(value))
+        if comma < 0:
+            return fields, extra_lines
+        pos = comma + 1
+
+
+def _rows(source, compression=None):
+    """
+    Yields the line number and fields of every data row of a CSV file, skipping its header.
+
+    Like COPY, and unlike csv.reader, this tells an unquoted empty field,
+    returned as None and loaded as NULL, from a quoted one, returned as ''
+    and loaded as an empty string.
+    """
+    stream = open_source(source, compression) if isinstance(source, str) else source
+    try:
+        lines = iter(stream)
+        line_num = 0
+        for line in lines:
+            line_num += 1
+            line = line.rstrip('\r\n')
+            if '"' in line:
+                row, extra_lines = _parse_record(line, lines)
+            else:
+                row, extra_lines = [field or None for field in line.split(',')], 0
+            if line_num > 1:
+                yield line_num, row
+            line_num += extra_lines
+    finally:
+        if isinstance(source, str):
+            stream.close()
+
+
+def _source_name(source):
+    return source if isinstance(source, str) else getattr(source, 'name', '<stream>')
+
+
+def preflight_csv(sources, table_name, key_mode='exact', max_errors=DEFAULT_MAX_ERRORS, compression=None):
+    """
+    Checks CSV files before they are copied into a source table.
+
+    Every row must have the table's number of columns, no unquoted empty
+    field, which COPY loads as NULL, in a column validate_data checks for
+    NULLs, and a unique integer key (the first of those columns), also
+    across files. Rows are streamed, so only the keys are held in memory: in
+    an IntKeySet with key_mode "exact", or in a KeyBloomFilter with key_mode
+    "bloom", whose possible duplicates are confirmed by a second pass over
+    the files.
+
+    Args:
+        sources (list): Local paths, S3 URLs or, with key_mode "exact", text
+            file objects of CSV files with a header row.
+        table_name (str): The name of the source table, as in pipeline.schema.
+        key_mode (str): "exact" or "bloom".
+        max_errors (int): The number of errors after which checking stops.
+        compression (str): "gzip" or "zstd" for paths and S3 URLs whose
+            compression the extension does not show. Derived from each
+            location when omitted.
+
+    Returns:
+        dict: The number of files and rows, the bytes used for the keys and the duration.
+    """
+    columns = schema.column_names(table_name)
+    checked = schema.validated_columns(table_name)
+    not_null_positions = [columns.index(column) for column in checked]
+    key_column = checked[0]
+    key_position = columns.index(key_column)
+    if key_mode == 'exact':
+        keys = IntKeySet()
+    elif key_mode == 'bloom':
+        if not all(isinstance(source, str) for source in sources):
+            raise Exception("The bloom key mode reads the files twice and needs paths or S3 URLs")
+        keys = KeyBloomFilter()
+    else:
+        raise Exception(f"Unsupported key mode: {key_mode}")
+
+    start = time.perf_counter()
+    errors = []
+    suspects = {}
+    row_count = 0
+    for source in sources:
+        name = _source_name(source)
+        for line, row in _rows(source, compression):
+            if len(errors) >= max_errors:
+                break
+            row_count += 1
+            if len(row) != len(columns):
+                errors.append(f"{name}:{line}: {len(row)} columns instead of {len(columns)}")
+                continue
+            for position in not_null_positions:
+                if row[position] is None:
+                    errors.append(f"{name}:{line}: NULL value in column {columns[position]}")
+            value = row[key_position]
+            if value is None:
+                continue
+            try:
+                key = int(value)
+                added = keys.add(key)
+            except (ValueError, OverflowError):
+                errors.append(f"{name}:{line}: {key_column} {value!r} is not a 64-bit integer")
+                continue
+            if not added:
+                if key_mode == 'exact':
+                    errors.append(f"{name}:{line}: duplicate {key_column} {key}")
+                else:
+                    suspects.setdefault(key, [])
+        if len(errors) >= max_errors:
+            break
+
+    # Bloom filter hits may be false positives: count the suspects exactly
+    if suspects and len(errors) < max_errors:
+        for source in sources:
+            name = _source_name(source)
+            for line, row in _rows(source, compression):
+                value = (row[key_position] if len(row) == len(columns) else None) or ''
+                if value.lstrip('-').isdigit() and int(value) in suspects:
+                    suspects[int(value)].append(f"{name}:{line}")
+        for key, lines in suspects.items():
+            if len(lines) > 1:
+                errors.append(f"{', '.join(lines[1:])}: duplicate {key_column} {key} (first at {lines[0]})")
+
+    result = {
+        'table': table_name,
+        'files': len(sources),
+        'rows': row_count,
+        'key_mode': key_mode,
+        'key_bytes': keys.nbytes,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+    print(json.dumps(result))
+    if errors:
+        for error in errors[:max_errors]:
+            print(f"Pre-flight violation: {error}")
+        raise Exception(f"Pre-flight validation of {table_name} failed: {'; '.join(errors[:max_errors])}")
+    return result
+
+
+def preflight_copy_source(bucket, key, table_name, key_mode='exact', data_format=None, compression=None):
+    """
+    Checks the CSV files a COPY would load, before anything is loaded.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        key (str): The S3 key of a file, a prefix ending with '/' or a manifest.
+        table_name (str): The name of the source table.
+        key_mode (str): "exact" or "bloom", see preflight_csv.
+        data_format (str): Overrides the format derived from the key.
+        compression (str): Overrides the compression derived from the key,
+            as for the COPY.
+
+    Returns:
+        dict: The result of preflight_csv, or None for Parquet sources, whose
+        schema is enforced by COPY itself.
+    """
+    source = describe_source(key, data_format, compression)
+    if source['data_format'] != 'csv':
+        print(f"Pre-flight validation skipped for {source['data_format']} source s3://{bucket}/{key}")
+        return None
+
+    if source['manifest']:
+        body = runtime.get_client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+        locations = [entry['url'] for entry in json.loads(body)['entries']]
+    elif key.endswith('/'):
+        locations = [f"s3://{bucket}/{object_key}" for object_key, _ in list_keys(bucket, key)]
+    else:
+        locations = [f"s3://{bucket}/{key}"]
+    return preflight_csv(locations, table_name, key_mode, compression=source['compression'])
@@ -0,0 +1,216 @@
+import datetime
+import json
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from pipeline.steps import get_run_id
+
+
+# Relative change of the row count over the previous load that is flagged
+ROW_COUNT_TOLERANCE = 0.5
+
+# Increase of a column's NULL ratio over the previous load that is flagged
+NULL_RATIO_TOLERANCE = 0.05
+
+# Relative change of a column's distinct count over the previous load that is flagged
+DISTINCT_COUNT_TOLERANCE = 0.5
+
+# Characters of the MIN and MAX values kept
+VALUE_LENGTH = 256
+
+# Pseudo column under which the table-level statistics are stored
+TABLE_LEVEL = '*'
+
+stats_ddl = """
+    CREATE TABLE IF NOT EXISTS etl_column_stats (
+      RunId VARCHAR(128) NOT NULL,
+      TableName VARCHAR(64) NOT NULL,
+      ColumnName VARCHAR(64) NOT NULL,
+      LoadedAt TIMESTAMP NOT NULL,
+      Valid BOOLEAN NOT NULL,
+      RowCount BIGINT,
+      NullCount BIGINT,
+      NullRatio DOUBLE PRECISION,
+      MinValue VARCHAR(256),
+      MaxValue VARCHAR(256),
+      DistinctCount BIGINT,
+      Anomalies VARCHAR(512)
+    );
+"""
+
+
+def build_profile_select(columns, dialect='redshift'):
+    """
+    Builds the aggregates profiling columns, to be added to the validation query.
+
+    Args:
+        columns (list): The columns to profile.
+        dialect (str): "redshift", whose APPROXIMATE COUNT(DISTINCT) estimates
+            the distinct count with a HyperLogLog sketch, or "postgres", which
+            counts exactly.
+
+    Returns:
+        list: Four expressions per column: its NULL count, MIN, MAX and distinct count.
+    """
+    distinct = "APPROXIMATE COUNT(DISTINCT {})" if dialect == 'redshift' else "COUNT(DISTINCT {})"
+    select_list = []
+    for column in columns:
+        select_list += [f"COUNT(*) - COUNT({column})", f"MIN({column})", f"MAX({column})", distinct.format(column)]
+    return select_list
+
+
+def parse_profile(columns, row_count, values):
+    """
+    Reads the result of the aggregates of build_profile_select.
+
+    Args:
+        columns (list): The profiled columns.
+        row_count (int): The number of rows of the table.
+        values (tuple): The values of the aggregates, in select-list order.
+
+    Returns:
+        list: One dict per column with its NULL count and ratio, MIN, MAX and distinct count.
+    """
+    profile = []
+    for i, column in enumerate(columns):
+        null_count, minimum, maximum, distinct_count = values[4 * i:4 * i + 4]
+        profile.append({
+            'column': column,
+            'null_count': null_count,
+            'null_ratio': round(null_count / row_count, 6) if row_count else None,
+            'min': None if minimum is None else str(minimum)[:VALUE_LENGTH],
+            'max': None if maximum is None else str(maximum)[:VALUE_LENGTH],
+            'distinct_count': distinct_count
+        })
+    return profile
+
+
+def _relative_change(before, after):
+    if not before:
+        return None
+    return abs(after - before) / before
+
+
+def find_anomalies(row_count, profile, previous):
+    """
+    Compares the profile of a load with that of the previous valid load of the table.
+
+    Args:
+        row_count (int): The number of rows of the load.
+        profile (list): The column statistics of the load, see parse_profile.
+        previous (dict): The statistics of the previous load by column name,
+            TABLE_LEVEL holding its row count; empty for a first load.
+
+    Returns:
+        dict: The anomalies by column name, TABLE_LEVEL for volume anomalies.
+    """
+    anomalies = {}
+    if TABLE_LEVEL in previous:
+        change = _relative_change(previous[TABLE_LEVEL]['row_count'], row_count)
+        if change is not None and change > ROW_COUNT_TOLERANCE:
+            anomalies[TABLE_LEVEL] = [f"row count {previous[TABLE_LEVEL]['row_count']} -> {row_count}"]
+    for stats in profile:
+        before = previous.get(stats['column'])
+        if before is None:
+            continue
+        found = []
+        if (stats['null_ratio'] is not None and before['null_ratio'] is not None
+                and stats['null_ratio'] - before['null_ratio'] > NULL_RATIO_TOLERANCE):
+            found.append(f"null ratio {before['null_ratio']:.3f} -> {stats['null_ratio']:.3f}")
+        change = _relative_change(before['distinct_count'], stats['distinct_count'])
+        if change is not None and change > DISTINCT_COUNT_TOLERANCE:
+            found.append(f"distinct count {before['distinct_count']} -> {stats['distinct_count']}")
+        if found:
+            anomalies[stats['column']] = found
+    return anomalies
+
+
+def create_stats_table(conn):
+    """
+    Creates the column statistics table unless it exists.
+
+    Loads running at the same time would race to create it, so run this first.
+
+    Args:
+        conn: The connection to the Redshift database.
+    """
+    with conn.cursor() as cur:
+        cur.execute(stats_ddl)
+    conn.commit()
+
+
+def get_previous_profile(cursor, table_name):
+    """
+    Reads the statistics of the last valid load of a table.
+
+    Args:
+        cursor: The cursor to run the queries with.
+        table_name (str): The name of the table.
+
+    Returns:
+        dict: The row count, NULL ratio and distinct count by column name,
+        see find_anomalies.
+    """
+    cursor.execute(stats_ddl)
+    cursor.execute(
+        """
+        SELECT ColumnName, RowCount, NullRatio, DistinctCount
+        FROM etl_column_stats
+        WHERE TableName = %s AND Valid
+          AND LoadedAt = (SELECT MAX(LoadedAt) FROM etl_column_stats WHERE TableName = %s AND Valid);
+        """,
+        (table_name, table_name)
+    )
+    return {
+        column: {'row_count': row_count, 'null_ratio': null_ratio, 'distinct_count': distinct_count}
+        for column, row_count, null_ratio, distinct_count in cursor.fetchall()
+    }
+
+
+def record_profile(conn, table_name, row_count, profile, valid):
+    """
+    Flags the anomalies of a load against the previous valid load and stores its statistics.
+
+    Only the statistics table is read, so no scan is added to the load. A
+    failure to store the statistics is printed and does not fail the load.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+        row_count (int): The number of rows of the load.
+        profile (list): The column statistics, see parse_profile.
+        valid (bool): Whether the load passed validation. Only valid loads
+            are compared against.
+
+    Returns:
+        dict: The anomalies by column name, see find_anomalies.
+    """
+    loaded_at = datetime.datetime.utcnow()
+    try:
+        with conn.cursor() as cur:
+            anomalies = find_anomalies(row_count, profile, get_previous_profile(cur, table_name))
+            rows = [(get_run_id(), table_name, TABLE_LEVEL, loaded_at, valid, row_count, None, None, None, None, None,
+                     '; '.join(anomalies.get(TABLE_LEVEL, [])) or None)]
+            rows += [
+                (get_run_id(), table_name, stats['column'], loaded_at, valid, row_count, stats['null_count'],
+                 stats['null_ratio'], stats['min'], stats['max'], stats['distinct_count'],
+                 '; '.join(anomalies.get(stats['column'], [])) or None)
+                for stats in profile
+            ]
+            execute_values(cur, """
+                INSERT INTO etl_column_stats
+                  (RunId, TableName, ColumnName, LoadedAt, Valid, RowCount, NullCount, NullRatio,
+                   MinValue, MaxValue, DistinctCount, Anomalies)
+                VALUES %s;
+                """, rows)
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        print(f"Failed to store the column statistics of {table_name}: {e}")
+        return {}
+
+    print(json.dumps({'table': table_name, 'rows': row_count, 'profile': profile}, default=str))
+    for column, found in anomalies.items():
+        print(f"Profile anomaly in {table_name}.{column}: {'; '.join(found)}")
+    return anomalies
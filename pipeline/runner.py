@@ -0,0 +1,249 @@
+import json
+import time
+
+from pipeline import runtime
+from pipeline.dates import populate_dim_dates
+from pipeline.fact import load_facts
+from pipeline.integrity import check_references
+from pipeline.loader import check_unique_tables, load_file, load_files, source_table_name
+from pipeline.maintenance import maintain_tables, thresholds_from_params
+from pipeline.upsert import dimension_tables, upsert_dimension
+
+
+# Source tables whose new rows feed fact_orders
+fact_source_tables = ['orders', 'orderdetails']
+
+
+def files_from_params(params):
+    """
+    Reads the files of a workflow run from its properties.
+
+    The 'files' property holds a JSON list of {"table_name", "bucket", "key"}
+    objects, optionally with the COPY options of pipeline.s3_copy. Entries
+    with a "path" instead of "bucket" and "key" are streamed from local disk.
+    Runs started for a single file use the 'table_name', 'bucket' and 'key'
+    properties instead.
+
+    Args:
+        params (dict): The workflow parameters.
+
+    Returns:
+        list: The files, as dicts with table_name, bucket and key.
+    """
+    if 'files' in params:
+        return json.loads(params['files'])
+    return [{'table_name': params['table_name'], 'bucket': params['bucket'], 'key': params['key']}]
+
+
+def options_from_params(params):
+    """
+    Reads the stage options of a workflow run from its properties.
+
+    Args:
+        params (dict): The workflow parameters.
+
+    Returns:
+        dict: The stage options.
+    """
+    return {
+        'upsert_mode': params.get('upsert_mode', 'incremental').lower(),
+        'use_merge': params.get('use_merge', 'true').lower() == 'true',
+        'fact_load_mode': params.get('fact_load_mode', 'incremental').lower(),
+        'watermark_column': params.get('watermark_column', 'OrderID'),
+        'batch_size': params.get('batch_size'),
+        'batch_concurrency': int(params.get('batch_concurrency', 1)),
+        'batch_load_name': params.get('batch_load_name'),
+        'check_references': params.get('check_references', 'true').lower() == 'true',
+        'orphan_action': params.get('orphan_action', 'quarantine').lower(),
+        'populate_dates': params.get('populate_dates', 'true').lower() == 'true',
+        'dates_start': params.get('dates_start'),
+        'dates_end': params.get('dates_end'),
+        'fiscal_year_start_month': params.get('fiscal_year_start_month', 1),
+        'staging_bucket': params.get('staging_bucket'),
+        'load_concurrency': int(params.get('load_concurrency', 1)),
+        'force_load': params.get('force_load', 'false').lower() == 'true',
+        'maintenance': params.get('maintenance', 'true').lower() == 'true',
+        'maintenance_thresholds': thresholds_from_params(params)
+    }
+
+
+def build_stages(files, options):
+    """
+    Works out the stages of a workflow run and what each of them depends on.
+
+    Every file is loaded and validated first. Dimension sources are then
+    upserted, and fact_orders is populated after every dimension, dim_dates
+    and the order tables of the run, and after the referential check of the
+    order lines. The tables written to are vacuumed and analyzed last, where
+    past the maintenance thresholds.
+
+    Args:
+        files (list): The files, as dicts with table_name and either bucket
+            and key or a local path, at most one per table.
+        options (dict): The stage options, see options_from_params.
+
+    Returns:
+        dict: The stages by name, each with the stages it depends on and the
+        function running it on a connection.
+    """
+    check_unique_tables(files)
+    stages = {}
+    loaded_tables = []
+    for file in files:
+        table_name = source_table_name(file['table_name'])
+        if options['force_load']:
+            file = dict(file, force_load='true')
+        stages[f"load_{table_name.lower()}"] = {
+            'depends_on': [],
+            'run': lambda conn, file=file: load_file(file, conn),
+            'file': file
+        }
+        loaded_tables.append(table_name.lower())
+
+    if options['populate_dates']:
+        # Redshift loads the generated dates through S3, by default next to the run's files
+        staging_bucket = options['staging_bucket'] or next((file['bucket'] for file in files if 'bucket' in file), None)
+        # The dates run up to the latest OrderDate, so they wait for the Orders load of the run
+        stages['dim_dates'] = {
+            'depends_on': ['load_orders'] if 'orders' in loaded_tables else [],
+            'run': lambda conn: populate_dim_dates(
+                conn, options['dates_start'], options['dates_end'], options['fiscal_year_start_month'], staging_bucket)
+        }
+
+    for table_name in loaded_tables:
+        if table_name in dimension_tables:
+            stages[f"upsert_{table_name}"] = {
+                'depends_on': [f"load_{table_name}"],
+                'run': lambda conn, table_name=table_name: upsert_dimension(
+                    conn, table_name, options['upsert_mode'], options['use_merge'])
+            }
+
+    if any(table_name in fact_source_tables for table_name in loaded_tables):
+        depends_on = [f"load_{table_name}" for table_name in loaded_tables if table_name in fact_source_tables]
+        depends_on += [name for name in stages if name.startswith('upsert_') or name == 'dim_dates']
+        if options['check_references']:
+            stages['check_references'] = {
+                'depends_on': depends_on,
+                'run': lambda conn: check_references(conn, options['orphan_action'])
+            }
+            depends_on = depends_on + ['check_references']
+        stages['fact_orders'] = {
+            'depends_on': depends_on,
+            'run': lambda conn: load_facts(
+                conn, options['fact_load_mode'], options['watermark_column'], options['batch_size'],
+                options['batch_concurrency'], options['batch_load_name'])
+        }
+
+    written = {'dim_dates': 'dim_dates', 'fact_orders': 'fact_orders'}
+    written.update({f"upsert_{table_name}": f"dim_{table_name}" for table_name in dimension_tables})
+    maintained = [name for name in stages if name in written]
+    if options['maintenance'] and maintained:
+        stages['maintenance'] = {
+            'depends_on': maintained,
+            'run': lambda conn: maintain_tables(
+                conn, [written[name] for name in maintained], options['maintenance_thresholds'])
+        }
+    return stages
+
+
+def order_stages(stages):
+    """
+    Orders the stages so that every stage comes after its dependencies.
+
+    Args:
+        stages (dict): The stages by name.
+
+    Returns:
+        list: The stage names in execution order. Stages without a dependency
+        between them keep the order they were declared in.
+    """
+    ordered = []
+    remaining = list(stages)
+    while remaining:
+        ready = [name for name in remaining if all(dependency in ordered for dependency in stages[name]['depends_on'])]
+        if not ready:
+            raise Exception(f"Circular or missing stage dependencies: {', '.join(remaining)}")
+        ordered.append(ready[0])
+        remaining.remove(ready[0])
+    return ordered
+
+
+def run_stages(stages, conn, completed=None):
+    """
+    Runs the stages in dependency order over one connection.
+
+    A failed stage does not stop the stages that do not depend on it; the
+    stages that do are skipped. A load whose file was already loaded is
+    "unchanged". The stages depending on it still run: a previous run may
+    have failed after the load, and with no new rows the upserts find no
+    changed keys and the fact load nothing beyond its watermark.
+
+    Args:
+        stages (dict): The stages by name.
+        conn: The connection to the Redshift database.
+        completed (list): The results of stages that already ran, which are
+            not run again.
+
+    Returns:
+        list: One dict per stage with its status, duration in seconds and result.
+    """
+    results = list(completed or [])
+    statuses = {result['stage']: result['status'] for result in results}
+    for name in order_stages(stages):
+        if name in statuses:
+            continue
+        depends_on = stages[name]['depends_on']
+        blocked = [dependency for dependency in depends_on if statuses[dependency] not in ('succeeded', 'unchanged')]
+        start = time.perf_counter()
+        if blocked:
+            status, result = 'skipped', f"Blocked by {', '.join(blocked)}"
+        else:
+            try:
+                result = stages[name]['run'](conn)
+                status = 'unchanged' if isinstance(result, dict) and result.get('skipped') else 'succeeded'
+            except Exception as error:
+                print(f"Stage {name} failed: {error}")
+                # Leave the shared connection usable for the stages that do not depend on this one
+                conn.rollback()
+                status, result = 'failed', str(error)
+        statuses[name] = status
+        stage_result = {
+            'stage': name,
+            'status': status,
+            'seconds': round(time.perf_counter() - start, 3),
+            'result': result
+        }
+        print(json.dumps(stage_result, default=str))
+        results.append(stage_result)
+    return results
+
+
+def run_pipeline(files, options):
+    """
+    Loads, validates, upserts and populates the facts of a workflow run in one process.
+
+    Args:
+        files (list): The files, as dicts with table_name, bucket and key.
+        options (dict): The stage options, see options_from_params.
+
+    Returns:
+        list: One dict per stage with its status, duration in seconds and result.
+    """
+    stages = build_stages(files, options)
+    print(f"Pipeline stages: {order_stages(stages)}")
+
+    completed = []
+    load_stages = [name for name in stages if 'file' in stages[name]]
+    if options['load_concurrency'] > 1 and len(load_stages) > 1:
+        # The loads depend on nothing, so they run first, several at a time over pooled connections
+        report = load_files([stages[name]['file'] for name in load_stages], options['load_concurrency'])
+        for name, table_result in zip(load_stages, report['tables']):
+            completed.append({
+                'stage': name,
+                'status': table_result['status'],
+                'seconds': table_result['seconds'],
+                'result': table_result['result']
+            })
+
+    with runtime.connection() as conn:
+        return run_stages(stages, conn, completed)
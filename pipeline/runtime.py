@@ -0,0 +1,308 @@
+import json
+import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+
+
+# Seconds a cached secret or set of workflow properties stays valid
+DEFAULT_TTL_SECONDS = 300
+
+# Size of the Redshift connection pool shared by the pipeline stages
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 4
+
+_lock = threading.RLock()
+_job_args = {}
+_clients = {}
+_cache = {}
+_pool = None
+_server_kinds = weakref.WeakKeyDictionary()
+
+
+def _parse_argv(argv, names):
+    """
+    Reads '--Name value' pairs from the command line when awsglue is not installed.
+
+    Args:
+        argv (list): The command line arguments.
+        names (list): The names of the arguments to read.
+
+    Returns:
+        dict: The values of the requested arguments.
+    """
+    resolved = {}
+    for name in names:
+        option = f"--{name}"
+        for i, arg in enumerate(argv):
+            if arg == option and i + 1 < len(argv):
+                resolved[name] = argv[i + 1]
+            elif arg.startswith(option + "="):
+                resolved[name] = arg[len(option) + 1:]
+        if name not in resolved:
+            raise Exception(f"Missing job argument: {name}")
+    return resolved
+
+
+def set_job_args(**kwargs):
+    """
+    Sets job arguments explicitly, e.g. when running outside of Glue.
+
+    Args:
+        **kwargs: The job arguments, e.g. SecretName='redshift'.
+    """
+    with _lock:
+        _job_args.update(kwargs)
+
+
+def get_job_args(names):
+    """
+    Resolves the Glue job arguments, reading the command line only once per argument.
+
+    Args:
+        names (list): The names of the arguments.
+
+    Returns:
+        dict: The values of the requested arguments.
+    """
+    with _lock:
+        missing = [name for name in names if name not in _job_args]
+        if missing:
+            try:
+                from awsglue.utils import getResolvedOptions
+                _job_args.update(getResolvedOptions(sys.argv, missing))
+            except ImportError:
+                _job_args.update(_parse_argv(sys.argv, missing))
+        return {name: _job_args[name] for name in names}
+
+
+def register_client(service_name, client, region_name=None):
+    """
+    Registers a client to be returned by get_client, e.g. a stubbed boto3 client.
+
+    Args:
+        service_name (str): The name of the AWS service.
+        client: The client object.
+        region_name (str): The region the client is used for.
+    """
+    with _lock:
+        _clients[(service_name, region_name)] = client
+
+
+def get_client(service_name, region_name=None):
+    """
+    Returns the boto3 client of a service, creating it on first use.
+
+    Args:
+        service_name (str): The name of the AWS service.
+        region_name (str): The name of the region.
+
+    Returns:
+        The boto3 client.
+    """
+    with _lock:
+        client = _clients.get((service_name, region_name))
+        if client is None:
+            import boto3
+            session = boto3.session.Session()
+            client = session.client(service_name=service_name, region_name=region_name)
+            _clients[(service_name, region_name)] = client
+        return client
+
+
+def _cached(key, loader, ttl):
+    """
+    Returns a cached value, calling the loader when it is missing or expired.
+
+    Args:
+        key (tuple): The cache key.
+        loader (callable): Computes the value.
+        ttl (float): Seconds the value stays valid.
+
+    Returns:
+        The cached value.
+    """
+    with _lock:
+        entry = _cache.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            return entry[0]
+        value = loader()
+        _cache[key] = (value, time.monotonic() + ttl)
+        return value
+
+
+def clear_cache():
+    """
+    Drops every cached secret and set of workflow properties.
+    """
+    with _lock:
+        _cache.clear()
+
+
+def get_secret(secret_name=None, region_name=None, service_name=None, ttl=DEFAULT_TTL_SECONDS):
+    """
+    Retrieves the secret value from AWS Secrets Manager.
+
+    Args:
+        secret_name (str): The name of the secret. Defaults to the SecretName job argument.
+        region_name (str): The name of the region. Defaults to the SecretRegionName job argument.
+        service_name (str): The name of the service. Defaults to the SecretManagerService job argument.
+        ttl (float): Seconds the secret is served from the cache.
+
+    Returns:
+        str: The secret value.
+    """
+    if secret_name is None or region_name is None or service_name is None:
+        args = get_job_args(['SecretName', 'SecretRegionName', 'SecretManagerService'])
+        secret_name = secret_name or args['SecretName']
+        region_name = region_name or args['SecretRegionName']
+        service_name = service_name or args['SecretManagerService']
+
+    def load():
+        client = get_client(service_name, region_name)
+        try:
+            get_secret_value_response = client.get_secret_value(SecretId=secret_name)
+        except Exception as e:
+            print(f"Secret Manager get_secret_value failed: {e}")
+            raise Exception("Secret Manager get_secret_value failed")
+        return get_secret_value_response['SecretString']
+
+    return _cached(('secret', secret_name, region_name, service_name), load, ttl)
+
+
+def get_credentials():
+    """
+    Returns the Redshift connection details stored in the secret.
+
+    Returns:
+        dict: The host, port, user, password and database.
+    """
+    return json.loads(get_secret())
+
+
+def get_workflow_params(ttl=DEFAULT_TTL_SECONDS):
+    """
+    Retrieves the workflow parameters from AWS Glue.
+
+    Args:
+        ttl (float): Seconds the parameters are served from the cache.
+
+    Returns:
+        dict: The workflow parameters.
+    """
+    args = get_job_args(['WORKFLOW_NAME', 'WORKFLOW_RUN_ID'])
+    workflow_name = args['WORKFLOW_NAME']
+    workflow_run_id = args['WORKFLOW_RUN_ID']
+
+    def load():
+        try:
+            glue_client = get_client("glue")
+            workflow_params = glue_client.get_workflow_run_properties(Name=workflow_name, RunId=workflow_run_id)["RunProperties"]
+        except Exception as e:
+            print(f"Failed to get workflow parameters: {e}")
+            raise Exception("Failed to get workflow parameters")
+        print("Workflow properties")
+        print(f"{workflow_name}, {workflow_params}")
+        return workflow_params
+
+    return _cached(('workflow', workflow_name, workflow_run_id), load, ttl)
+
+
+def get_pool():
+    """
+    Returns the Redshift connection pool, creating it on first use.
+
+    Returns:
+        psycopg2.pool.ThreadedConnectionPool: The connection pool.
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            credentials = get_credentials()
+            _pool = pool.ThreadedConnectionPool(
+                POOL_MIN_CONNECTIONS,
+                POOL_MAX_CONNECTIONS,
+                host=credentials['host'],
+                port=int(credentials['port']),
+                user=credentials['user'],
+                password=credentials['password'],
+                database=credentials['database']
+            )
+        return _pool
+
+
+def get_connection():
+    """
+    Takes a Redshift connection from the pool.
+
+    Returns:
+        The psycopg2 connection. Hand it back with release_connection.
+    """
+    return get_pool().getconn()
+
+
+def release_connection(conn):
+    """
+    Hands a connection back to the pool, discarding any open transaction.
+
+    Args:
+        conn: The psycopg2 connection.
+    """
+    if not conn.closed:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+    get_pool().putconn(conn, close=bool(conn.closed))
+
+
+@contextmanager
+def connection():
+    """
+    Context manager lending a pooled Redshift connection.
+
+    Yields:
+        The psycopg2 connection.
+    """
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+
+def is_redshift(conn):
+    """
+    Tells whether a connection is to Redshift rather than to a PostgreSQL server
+    such as the local stand-in. The answer is cached per connection.
+
+    Args:
+        conn: The psycopg2 connection.
+
+    Returns:
+        bool: True for Redshift.
+    """
+    with _lock:
+        redshift = _server_kinds.get(conn)
+    if redshift is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT version();")
+            redshift = 'redshift' in cur.fetchone()[0].lower()
+        with _lock:
+            _server_kinds[conn] = redshift
+    return redshift
+
+
+def close_pool():
+    """
+    Closes every pooled connection.
+    """
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
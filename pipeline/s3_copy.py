@@ -0,0 +1,346 @@
+import codecs
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from pipeline import runtime
+
+
+IAM_ROLE = 'arn:aws:iam::414432075221:role/service-role/AmazonRedshift-CommandsAccessRole-20230302T155618'
+
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.gzip': 'gzip',
+    '.zst': 'zstd',
+    '.zstd': 'zstd'
+}
+
+PART_EXTENSIONS = {
+    None: '.csv',
+    'gzip': '.csv.gz',
+    'zstd': '.csv.zst'
+}
+
+# Workflow properties (or runner file entries) that shape the load
+COPY_OPTION_NAMES = ['data_format', 'compression', 'use_manifest', 'split_parts', 'split_compression',
+                     'load_mode', 'swap_method', 'preflight', 'force_load']
+
+
+def describe_source(key, data_format=None, compression=None):
+    """
+    Works out the format and compression of a COPY source from its key.
+
+    Args:
+        key (str): The S3 key of a file, a prefix ending with '/' or a manifest.
+        data_format (str): "csv" or "parquet". Derived from the key when omitted.
+        compression (str): "gzip" or "zstd". Derived from the key when omitted.
+
+    Returns:
+        dict: The data format, the compression and whether the key is a manifest.
+    """
+    name = key.lower()
+    manifest = name.endswith('.manifest')
+    if manifest:
+        name = name[:-len('.manifest')]
+    name = name.rstrip('/')
+
+    if compression is None:
+        for extension, codec in COMPRESSION_EXTENSIONS.items():
+            if name.endswith(extension):
+                compression = codec
+                name = name[:-len(extension)]
+                break
+    if data_format is None:
+        data_format = 'parquet' if name.endswith('.parquet') else 'csv'
+    return {'data_format': data_format.lower(), 'compression': compression, 'manifest': manifest}
+
+
+def build_copy_options(data_format, compression=None):
+    """
+    Builds the format options of a COPY command.
+
+    Args:
+        data_format (str): "csv" or "parquet".
+        compression (str): "gzip", "zstd" or None for uncompressed CSV.
+
+    Returns:
+        str: The COPY options.
+    """
+    if data_format == 'parquet':
+        # Parquet carries its own compression and has no header row
+        return "FORMAT AS PARQUET"
+    if data_format != 'csv':
+        raise Exception(f"Unsupported data format: {data_format}")
+
+    options = "FORMAT AS CSV DELIMITER ',' IGNOREHEADER 1"
+    if compression is not None:
+        if compression not in PART_EXTENSIONS:
+            raise Exception(f"Unsupported compression: {compression}")
+        options += f" {compression.upper()}"
+    return options
+
+
+def build_copy_command(table_name, bucket, key, data_format=None, compression=None, columns=None):
+    """
+    Builds the COPY command loading a file, a prefix of split files or a manifest.
+
+    Args:
+        table_name (str): The name of the Redshift table.
+        bucket (str): The name of the S3 bucket.
+        key (str): The S3 key of a file, a prefix ending with '/' or a manifest.
+        data_format (str): Overrides the format derived from the key.
+        compression (str): Overrides the compression derived from the key.
+        columns (list): The target columns, in file order. All columns when omitted.
+
+    Returns:
+        str: The COPY command.
+    """
+    source = describe_source(key, data_format, compression)
+    manifest = " MANIFEST" if source['manifest'] else ""
+    column_list = f" ({', '.join(columns)})" if columns else ""
+    return f"""
+    COPY {table_name}{column_list}
+    FROM 's3://{bucket}/{key}'
+    IAM_ROLE '{IAM_ROLE}'{manifest}
+    {build_copy_options(source['data_format'], source['compression'])};
+    """
+
+
+def list_keys(bucket, prefix):
+    """
+    Lists the keys of the non-empty objects under a prefix.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        prefix (str): The key prefix.
+
+    Returns:
+        list: The keys and sizes of the objects, as (key, size) tuples.
+    """
+    s3_client = runtime.get_client('s3')
+    keys = []
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    while True:
+        response = s3_client.list_objects_v2(**kwargs)
+        keys += [(item['Key'], item['Size']) for item in response.get('Contents', []) if item['Size'] > 0]
+        if not response.get('IsTruncated'):
+            return keys
+        kwargs['ContinuationToken'] = response['NextContinuationToken']
+
+
+def write_manifest(bucket, keys, manifest_key):
+    """
+    Writes a COPY manifest listing the given objects.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        keys (list): The keys and sizes of the objects, as (key, size) tuples.
+        manifest_key (str): The key the manifest is written to.
+
+    Returns:
+        str: The key of the manifest.
+    """
+    if not keys:
+        raise Exception(f"No files to load under s3://{bucket}/{manifest_key}")
+    # content_length is required when the manifest lists Parquet files
+    manifest = {
+        'entries': [
+            {'url': f"s3://{bucket}/{key}", 'mandatory': True, 'meta': {'content_length': size}}
+            for key, size in keys
+        ]
+    }
+    runtime.get_client('s3').put_object(Bucket=bucket, Key=manifest_key, Body=json.dumps(manifest).encode('utf-8'))
+    print(f"Manifest with {len(keys)} files written to s3://{bucket}/{manifest_key}")
+    return manifest_key
+
+
+def get_slice_count(conn):
+    """
+    Returns the number of slices of the cluster, the unit COPY parallelizes over.
+
+    Args:
+        conn: The connection to the Redshift database.
+
+    Returns:
+        int: The number of slices.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM stv_slices;")
+        return cur.fetchone()[0]
+
+
+def _split_location(location):
+    """
+    Splits an s3://bucket/key URL.
+
+    Args:
+        location (str): An S3 URL or a local path.
+
+    Returns:
+        tuple: The bucket and key, or (None, path) for a local path.
+    """
+    if location.startswith('s3://'):
+        bucket, _, key = location[len('s3://'):].partition('/')
+        return bucket, key
+    return None, location
+
+
+def open_source(location, compression=None):
+    """
+    Opens a local or S3 CSV file as a text stream, decompressing it if needed.
+
+    Args:
+        location (str): An S3 URL or a local path.
+        compression (str): "gzip" or "zstd". Derived from the location when omitted.
+
+    Returns:
+        The text stream.
+    """
+    bucket, key = _split_location(location)
+    if bucket is None:
+        stream = open(key, 'rb')
+    else:
+        stream = runtime.get_client('s3').get_object(Bucket=bucket, Key=key)['Body']
+    compression = describe_source(key, compression=compression)['compression']
+    if compression == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream)
+    elif compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    return codecs.getreader('utf-8')(stream)
+
+
+def _open_part(path, compression):
+    """
+    Opens a split part for writing.
+
+    Args:
+        path (str): The local path of the part.
+        compression (str): "gzip", "zstd" or None.
+
+    Returns:
+        The text stream.
+    """
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='utf-8', newline='')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("ZSTD compression requires the zstandard package")
+        return zstandard.open(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def split_and_compress(source, target_prefix, parts, compression='gzip'):
+    """
+    Splits one large CSV file into compressed parts that COPY loads in parallel.
+
+    Rows are dealt round-robin so that the parts have the same size. Every part
+    repeats the header row, as COPY skips the header of each file.
+
+    Args:
+        source (str): An S3 URL or local path of the CSV file.
+        target_prefix (str): An S3 URL or local directory the parts are written under.
+        parts (int): The number of parts, ideally a multiple of the slice count.
+        compression (str): "gzip", "zstd" or None.
+
+    Returns:
+        list: The S3 URLs or local paths of the parts.
+    """
+    target_bucket, target_key = _split_location(target_prefix)
+    work_dir = tempfile.mkdtemp() if target_bucket is not None else target_key
+    os.makedirs(work_dir, exist_ok=True)
+    names = [f"part-{i:04d}{PART_EXTENSIONS[compression]}" for i in range(parts)]
+
+    reader = csv.reader(open_source(source))
+    writers = []
+    streams = []
+    try:
+        for name in names:
+            streams.append(_open_part(os.path.join(work_dir, name), compression))
+            writers.append(csv.writer(streams[-1], lineterminator='\n'))
+
+        header = next(reader, None)
+        if header is not None:
+            for writer in writers:
+                writer.writerow(header)
+        for i, row in enumerate(reader):
+            writers[i % parts].writerow(row)
+    finally:
+        for stream in streams:
+            stream.close()
+
+    if target_bucket is None:
+        return [os.path.join(work_dir, name) for name in names]
+
+    try:
+        s3_client = runtime.get_client('s3')
+        locations = []
+        for name in names:
+            key = target_key.rstrip('/') + '/' + name
+            s3_client.upload_file(os.path.join(work_dir, name), target_bucket, key)
+            locations.append(f"s3://{target_bucket}/{key}")
+        print(f"{source} split into {parts} parts under {target_prefix}")
+        return locations
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def copy_options_from_params(params):
+    """
+    Reads the COPY options of a load from workflow properties or a runner file entry.
+
+    Args:
+        params (dict): The workflow properties or file entry.
+
+    Returns:
+        dict: The keyword arguments of copy_data_to_redshift.
+    """
+    options = {name: params[name] for name in COPY_OPTION_NAMES if params.get(name) not in (None, '')}
+    for name in ['use_manifest', 'force_load']:
+        if name in options:
+            options[name] = str(options[name]).lower() == 'true'
+    if 'split_compression' in options and str(options['split_compression']).lower() == 'none':
+        options['split_compression'] = None
+    return options
+
+
+def prepare_copy_source(conn, bucket, key, data_format=None, compression=None, use_manifest=False,
+                        split_parts=None, split_compression='gzip'):
+    """
+    Prepares the S3 source of a COPY and returns the key to load from.
+
+    Args:
+        conn: The connection to the Redshift database.
+        bucket (str): The name of the S3 bucket.
+        key (str): The S3 key of a file, a prefix ending with '/' or a manifest.
+        data_format (str): Overrides the format derived from the key.
+        compression (str): Overrides the compression derived from the key.
+        use_manifest (bool): Load a prefix through a generated manifest, so that
+            only the objects present now are loaded.
+        split_parts: Split a single CSV file into this many parts first, or
+            "auto" for one part per slice.
+        split_compression (str): The compression of the split parts.
+
+    Returns:
+        tuple: The key to load from, the data format and the compression.
+    """
+    if split_parts:
+        parts = get_slice_count(conn) if str(split_parts).lower() == 'auto' else int(split_parts)
+        prefix = f"{key}.parts/"
+        locations = split_and_compress(f"s3://{bucket}/{key}", f"s3://{bucket}/{prefix}", parts, split_compression)
+        # Only the parts of this split: an earlier split into more parts leaves stale ones under the prefix
+        written = {_split_location(location)[1] for location in locations}
+        manifest_keys = [(part_key, size) for part_key, size in list_keys(bucket, prefix) if part_key in written]
+        if len(manifest_keys) != len(written):
+            raise Exception(f"Only {len(manifest_keys)} of the {len(written)} parts were found under s3://{bucket}/{prefix}")
+        key = write_manifest(bucket, manifest_keys, f"{prefix.rstrip('/')}.manifest")
+        return key, 'csv', split_compression
+
+    if use_manifest and key.endswith('/'):
+        key = write_manifest(bucket, list_keys(bucket, key), f"{key.rstrip('/')}.manifest")
+    return key, data_format, compression
@@ -0,0 +1,512 @@
+import re
+
+import psycopg2
+
+from pipeline import runtime
+
+
+# Compression of a column by type; the leading sort key column is left RAW so
+# that zone maps stay effective
+type_encodings = {
+    'INT': 'AZ64',
+    'BIGINT': 'AZ64',
+    'DECIMAL': 'AZ64',
+    'DATE': 'AZ64',
+    'TIMESTAMP': 'AZ64',
+    'BOOLEAN': 'ZSTD',
+    'VARCHAR': 'ZSTD'
+}
+
+# How pg_table_def spells the types of the registry
+catalog_types = {
+    'INT': 'integer',
+    'BIGINT': 'bigint',
+    'DECIMAL': 'numeric',
+    'DATE': 'date',
+    'TIMESTAMP': 'timestamp without time zone',
+    'BOOLEAN': 'boolean',
+    'VARCHAR': 'character varying'
+}
+
+# Distribution styles by pg_class.reldiststyle; AUTO styles count as AUTO
+catalog_diststyles = {0: 'EVEN', 1: 'KEY', 8: 'ALL'}
+
+
+def _column(name, data_type, not_null=False, identity=False, default=None, validated=True):
+    """
+    Declares a column of the registry.
+
+    Args:
+        name (str): The column name.
+        data_type (str): The Redshift type, e.g. 'VARCHAR(50)'.
+        not_null (bool): Whether the DDL declares the column NOT NULL.
+        identity (bool): Whether the column is an IDENTITY(1,1) surrogate key.
+        default (str): The DEFAULT expression.
+        validated (bool): Whether validate_data checks the column of a source table.
+
+    Returns:
+        dict: The column.
+    """
+    return {
+        'name': name,
+        'type': data_type,
+        'not_null': not_null,
+        'identity': identity,
+        'default': default,
+        'validated': validated
+    }
+
+
+# Source tables loaded by COPY. Their DDL declares no constraints so that
+# validate_data reports the violations of a file instead of COPY failing on them.
+_sources = {
+    'Customers': {
+        'columns': [
+            _column('CustomerID', 'INT'),
+            _column('FirstName', 'VARCHAR(50)'),
+            _column('LastName', 'VARCHAR(50)'),
+            _column('Email', 'VARCHAR(50)'),
+            _column('Address', 'VARCHAR(50)'),
+            _column('City', 'VARCHAR(50)'),
+            _column('State', 'VARCHAR(50)'),
+            _column('ZipCode', 'VARCHAR(10)')
+        ],
+        'diststyle': 'KEY',
+        'distkey': 'CustomerID',
+        'sortkey': ['CustomerID']
+    },
+    'Products': {
+        'columns': [
+            _column('ProductID', 'INT'),
+            _column('ProductName', 'VARCHAR(50)'),
+            _column('Category', 'VARCHAR(50)'),
+            _column('Description', 'VARCHAR(50)'),
+            _column('Price', 'DECIMAL(8,2)')
+        ],
+        'diststyle': 'ALL',
+        'sortkey': ['ProductID']
+    },
+    'Stores': {
+        'columns': [
+            _column('StoreID', 'INT'),
+            _column('StoreName', 'VARCHAR(50)'),
+            _column('Address', 'VARCHAR(50)'),
+            _column('City', 'VARCHAR(50)'),
+            _column('State', 'VARCHAR(50)'),
+            _column('ZipCode', 'VARCHAR(10)')
+        ],
+        'diststyle': 'ALL',
+        'sortkey': ['StoreID']
+    },
+    # Orders and OrderDetails share their distribution key so that staging the facts joins them locally
+    'Orders': {
+        'columns': [
+            _column('OrderID', 'INT'),
+            _column('CustomerID', 'INT'),
+            _column('StoreID', 'INT'),
+            _column('OrderDate', 'DATE')
+        ],
+        'diststyle': 'KEY',
+        'distkey': 'OrderID',
+        'sortkey': ['OrderID']
+    },
+    'OrderDetails': {
+        'columns': [
+            _column('OrderID', 'INT'),
+            _column('ProductID', 'INT'),
+            _column('Quantity', 'INT'),
+            _column('Price', 'DECIMAL(8,2)', validated=False)
+        ],
+        'diststyle': 'KEY',
+        'distkey': 'OrderID',
+        'sortkey': ['OrderID']
+    }
+}
+
+# Surrogate keys of the SCD2 dimensions built from source tables
+_dimension_keys = {
+    'Customers': 'CustomerKey',
+    'Products': 'ProductKey',
+    'Stores': 'StoreKey'
+}
+
+
+def _dimension_tables(source_name, surrogate_key):
+    """
+    Declares the staging, dimension and key map tables of an SCD2 dimension.
+
+    The large customer dimension is distributed on its surrogate key like
+    fact_orders; small dimensions and every key map are copied to all nodes.
+    """
+    source_columns = [dict(column, validated=False) for column in _sources[source_name]['columns']]
+    natural_key = source_columns[0]['name']
+    small = _sources[source_name]['diststyle'] == 'ALL'
+    name = source_name.lower()
+    return {
+        f"dim_{name}_staging": {
+            'columns': source_columns + [_column('LoadDate', 'DATE', default='current_date')],
+            'diststyle': 'ALL' if small else 'KEY',
+            'distkey': None if small else natural_key,
+            'sortkey': [natural_key],
+            'transient': True
+        },
+        f"dim_{name}": {
+            'columns': [_column(surrogate_key, 'INT', not_null=True, identity=True),
+                        dict(source_columns[0], not_null=True)]
+                       + source_columns[1:]
+                       + [_column('StartDate', 'DATE', not_null=True), _column('EndDate', 'DATE')],
+            'diststyle': 'ALL' if small else 'KEY',
+            'distkey': None if small else surrogate_key,
+            'sortkey': [natural_key, 'EndDate']
+        },
+        f"keymap_{name}": {
+            'columns': [_column(natural_key, 'INT', not_null=True), _column(surrogate_key, 'INT', not_null=True)],
+            'diststyle': 'ALL',
+            'sortkey': [natural_key]
+        }
+    }
+
+
+tables = dict(_sources)
+for _source_name, _surrogate_key in _dimension_keys.items():
+    tables.update(_dimension_tables(_source_name, _surrogate_key))
+
+tables['dim_dates'] = {
+    'columns': [
+        _column('DateKey', 'INT', not_null=True, identity=True),
+        _column('Date', 'DATE', not_null=True),
+        _column('Year', 'INT'),
+        _column('Quarter', 'INT'),
+        _column('Month', 'INT'),
+        _column('Day', 'INT'),
+        _column('Weekday', 'INT'),
+        _column('Week', 'INT'),
+        _column('IsoYear', 'INT'),
+        _column('FiscalYear', 'INT'),
+        _column('FiscalQuarter', 'INT'),
+        _column('FiscalMonth', 'INT'),
+        _column('IsWeekend', 'BOOLEAN'),
+        _column('IsHoliday', 'BOOLEAN'),
+        _column('HolidayName', 'VARCHAR(50)')
+    ],
+    'diststyle': 'ALL',
+    'sortkey': ['Date']
+}
+tables['keymap_dates'] = {
+    'columns': [_column('Date', 'DATE', not_null=True), _column('DateKey', 'INT', not_null=True)],
+    'diststyle': 'ALL',
+    'sortkey': ['Date']
+}
+
+_fact_columns = [
+    _column('OrderID', 'INT', not_null=True),
+    _column('CustomerID', 'INT', not_null=True),
+    _column('StoreID', 'INT', not_null=True),
+    _column('ProductID', 'INT', not_null=True),
+    _column('Quantity', 'INT', not_null=True),
+    _column('UnitPrice', 'DECIMAL(8,2)', not_null=True),
+    _column('TotalPrice', 'DECIMAL(8,2)', not_null=True)
+]
+# Staged like Orders, so that staging is local; the key map joins are against replicated tables
+tables['staging_fact_orders'] = {
+    'columns': _fact_columns + [_column('OrderDate', 'DATE', not_null=True)],
+    'diststyle': 'KEY',
+    'distkey': 'OrderID',
+    'sortkey': ['OrderID'],
+    'transient': True
+}
+# CustomerID holds the CustomerKey of dim_customers, which is distributed the same way
+tables['fact_orders'] = {
+    'columns': _fact_columns + [_column('OrderDateID', 'INT', not_null=True)],
+    'diststyle': 'KEY',
+    'distkey': 'CustomerID',
+    'sortkey': ['OrderDateID']
+}
+
+source_tables = list(_sources)
+
+
+def column_names(table_name):
+    """
+    Returns the column names of a table of the registry.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        list: The column names, in table order.
+    """
+    return [column['name'] for column in tables[table_name]['columns']]
+
+
+def validated_columns(table_name):
+    """
+    Returns the columns of a source table that validate_data checks.
+
+    Args:
+        table_name (str): The name of the source table.
+
+    Returns:
+        list: The column names; the first one is the unique key.
+    """
+    return [column['name'] for column in tables[table_name]['columns'] if column['validated']]
+
+
+def _base_type(data_type):
+    return data_type.split('(')[0].upper()
+
+
+def column_encoding(table_name, column):
+    """
+    Returns the compression encoding of a column.
+
+    Args:
+        table_name (str): The name of the table.
+        column (dict): The column of the registry.
+
+    Returns:
+        str: The encoding, RAW for the leading sort key column.
+    """
+    sortkey = tables[table_name].get('sortkey') or []
+    if sortkey and sortkey[0] == column['name']:
+        return 'RAW'
+    return type_encodings[_base_type(column['type'])]
+
+
+def column_definition(table_name, column, dialect='redshift', encode=True):
+    """
+    Builds the definition of a column in a CREATE TABLE statement.
+
+    Args:
+        table_name (str): The name of the table.
+        column (dict): The column of the registry.
+        dialect (str): "redshift", or "postgres" for the local stand-in.
+        encode (bool): Whether to add the Redshift compression encoding.
+
+    Returns:
+        str: The column definition, e.g. 'CustomerKey INT IDENTITY(1,1) NOT NULL ENCODE AZ64'.
+    """
+    definition = f"{column['name']} {column['type']}"
+    if column['identity']:
+        definition += " IDENTITY(1,1)" if dialect == 'redshift' else " GENERATED BY DEFAULT AS IDENTITY"
+    if column['default'] is not None:
+        definition += f" DEFAULT {column['default']}"
+    if column['not_null']:
+        definition += " NOT NULL"
+    if dialect == 'redshift' and encode:
+        definition += f" ENCODE {column_encoding(table_name, column)}"
+    return definition
+
+
+def column_definitions(table_name):
+    """
+    Returns the column definitions of a table without their encodings.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        list: The definitions, e.g. 'CustomerKey INT IDENTITY(1,1) NOT NULL'.
+    """
+    return [column_definition(table_name, column, encode=False) for column in tables[table_name]['columns']]
+
+
+def table_attributes(table_name):
+    """
+    Builds the distribution and sort key clauses of a table.
+
+    Args:
+        table_name (str): The name of the table.
+
+    Returns:
+        str: The table attributes of a Redshift CREATE TABLE statement.
+    """
+    table = tables[table_name]
+    if table['diststyle'] == 'KEY':
+        attributes = f"DISTSTYLE KEY DISTKEY({table['distkey']})"
+    else:
+        attributes = f"DISTSTYLE {table['diststyle']}"
+    if table.get('sortkey'):
+        attributes += f" SORTKEY({', '.join(table['sortkey'])})"
+    return attributes
+
+
+def build_create_table(table_name, dialect='redshift', if_not_exists=False, temporary=False, relation=None):
+    """
+    Builds the CREATE TABLE statement of a table of the registry.
+
+    Args:
+        table_name (str): The name of the table.
+        dialect (str): "redshift", or "postgres" for the local stand-in, which
+            has no encodings, distribution or sort keys.
+        if_not_exists (bool): Whether to add IF NOT EXISTS.
+        temporary (bool): Whether to create a temporary table.
+        relation (str): The name the table is created under. Defaults to table_name.
+
+    Returns:
+        str: The CREATE TABLE statement.
+    """
+    columns = ",\n          ".join([column_definition(table_name, column, dialect) for column in tables[table_name]['columns']])
+    attributes = f"\n        {table_attributes(table_name)}" if dialect == 'redshift' else ""
+    return f"""
+        CREATE {'TEMP ' if temporary else ''}TABLE {'IF NOT EXISTS ' if if_not_exists else ''}{relation or table_name} (
+          {columns}
+        ){attributes};
+        """
+
+
+def read_physical_design(conn, table_name):
+    """
+    Reads the columns, encodings, distribution and sort keys of a Redshift table.
+
+    The table has to be in a schema of the search path, like every table the
+    jobs use.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+
+    Returns:
+        dict: The columns (by lower-case name, with type and encoding), the
+        distribution style, the distribution key and the sort key columns, or
+        None when the table does not exist.
+    """
+    with conn.cursor() as cur:
+        cur.execute(
+            'SELECT "column", type, encoding, distkey, sortkey FROM pg_table_def WHERE tablename = %s;',
+            (table_name.lower(),)
+        )
+        rows = cur.fetchall()
+        if not rows:
+            return None
+        cur.execute("""
+            SELECT c.reldiststyle
+            FROM pg_class c
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.relname = %s AND n.nspname = current_schema();
+            """, (table_name.lower(),))
+        row = cur.fetchone()
+
+    return {
+        'columns': {column: {'type': data_type, 'encoding': encoding.upper()} for column, data_type, encoding, _, _ in rows},
+        'diststyle': catalog_diststyles.get(row[0], 'AUTO') if row is not None else 'AUTO',
+        'distkey': next((column for column, _, _, distkey, _ in rows if distkey), None),
+        'sortkey': [column for column, _, _, _, position in sorted(rows, key=lambda r: abs(r[4])) if position != 0]
+    }
+
+
+def _catalog_type(data_type):
+    """
+    Spells a registry type the way pg_table_def reports it, e.g. 'character varying(50)'.
+    """
+    match = re.match(r'(\w+)\s*(\(.*\))?', data_type.strip())
+    return catalog_types[match.group(1).upper()] + (match.group(2) or '').replace(' ', '')
+
+
+def _varchar_length(catalog_type):
+    match = re.match(r'character varying\((\d+)\)', catalog_type)
+    return int(match.group(1)) if match else None
+
+
+def build_migration_statements(table_name, current):
+    """
+    Builds the ALTER TABLE statements that bring a table to its registry design.
+
+    Missing columns are added, VARCHAR columns widened, encodings, distribution
+    and sort keys changed in place. Columns unknown to the registry are left
+    alone. Redshift runs these ALTER TABLE forms outside of transactions only.
+
+    Args:
+        table_name (str): The name of the table.
+        current (dict): The current design, see read_physical_design, or None
+            when the table does not exist yet.
+
+    Returns:
+        list: The statements, empty when the table already matches.
+    """
+    if current is None:
+        return [build_create_table(table_name)]
+
+    table = tables[table_name]
+    statements = []
+    for column in table['columns']:
+        existing = current['columns'].get(column['name'].lower())
+        wanted_type = _catalog_type(column['type'])
+        encoding = column_encoding(table_name, column)
+        if existing is None:
+            default = f" DEFAULT {column['default']}" if column['default'] is not None else ""
+            statements.append(f"ALTER TABLE {table_name} ADD COLUMN {column['name']} {column['type']}{default} ENCODE {encoding};")
+            continue
+        if existing['type'] != wanted_type:
+            current_length = _varchar_length(existing['type'])
+            wanted_length = _varchar_length(wanted_type)
+            if current_length is None or wanted_length is None or wanted_length < current_length:
+                raise Exception(f"Column {table_name}.{column['name']} cannot change from {existing['type']} "
+                                f"to {wanted_type} in place; the table needs a deep copy")
+            statements.append(f"ALTER TABLE {table_name} ALTER COLUMN {column['name']} TYPE {column['type']};")
+        # pg_table_def reports RAW as none
+        if existing['encoding'].replace('NONE', 'RAW') != encoding:
+            statements.append(f"ALTER TABLE {table_name} ALTER COLUMN {column['name']} ENCODE {encoding};")
+
+    if table['diststyle'] == 'KEY':
+        if current['diststyle'] != 'KEY' or (current['distkey'] or '').lower() != table['distkey'].lower():
+            statements.append(f"ALTER TABLE {table_name} ALTER DISTKEY {table['distkey']};")
+    elif current['diststyle'] != table['diststyle']:
+        statements.append(f"ALTER TABLE {table_name} ALTER DISTSTYLE {table['diststyle']};")
+
+    sortkey = table.get('sortkey') or []
+    if [column.lower() for column in current['sortkey']] != [column.lower() for column in sortkey]:
+        sortkey_clause = f"({', '.join(sortkey)})" if sortkey else "NONE"
+        statements.append(f"ALTER TABLE {table_name} ALTER SORTKEY {sortkey_clause};")
+    return statements
+
+
+def migrate_schema(conn, table_names=None, apply=False):
+    """
+    Compares the tables of a Redshift database with the registry and migrates them.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_names (list): The tables to migrate. Defaults to every table of
+            the registry except the transient staging tables.
+        apply (bool): Whether to run the statements or only return them.
+
+    Returns:
+        list: The migration statements, in execution order.
+    """
+    if not runtime.is_redshift(conn):
+        raise Exception("Schema migrations read the Redshift catalog and need a Redshift connection")
+    if table_names is None:
+        table_names = [name for name, table in tables.items() if not table.get('transient')]
+
+    statements = []
+    for table_name in table_names:
+        statements += build_migration_statements(table_name, read_physical_design(conn, table_name))
+    conn.rollback()
+
+    if apply and statements:
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for statement in statements:
+                    print(f"SQL: {statement}")
+                    cur.execute(statement)
+        except psycopg2.Error as e:
+            print(f"Schema migration failed: {e}")
+            raise Exception("Schema migration failed")
+        finally:
+            conn.autocommit = False
+    return statements
+
+
+def dialect_of(conn):
+    """
+    Returns the DDL dialect of a connection.
+
+    Args:
+        conn: The psycopg2 connection.
+
+    Returns:
+        str: "redshift", or "postgres" for the local stand-in.
+    """
+    return 'redshift' if runtime.is_redshift(conn) else 'postgres'
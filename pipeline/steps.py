@@ -0,0 +1,192 @@
+import datetime
+import json
+import threading
+import time
+import uuid
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from pipeline import plans, runtime
+
+
+_lock = threading.Lock()
+_run_history = {'table_name': None, 'run_id': None}
+
+
+def set_run_history(table_name, run_id=None):
+    """
+    Sets the table the step metrics of this process are written to.
+
+    Args:
+        table_name (str): The name of the run-history table, or None to only
+            print the metrics.
+        run_id (str): The identifier of the run, e.g. the workflow run ID.
+            A random one is generated when omitted.
+    """
+    with _lock:
+        _run_history['table_name'] = table_name or None
+        _run_history['run_id'] = run_id or uuid.uuid4().hex
+
+
+def configure_from_params(params):
+    """
+    Sets the run history and the plan capture of this process from the
+    workflow properties of a job.
+
+    Args:
+        params (dict): The workflow parameters.
+    """
+    # Step metrics are also written to the run-history table when the workflow names one
+    set_run_history(params.get('run_history_table'), runtime.get_job_args(['WORKFLOW_RUN_ID'])['WORKFLOW_RUN_ID'])
+    # With plan_capture "warn" or "fail", every SQL step is explained and checked for plan regressions first
+    plans.set_plan_capture(params.get('plan_capture', 'off').lower(),
+                           params.get('plan_cost_threshold', plans.DEFAULT_COST_THRESHOLD))
+
+
+def get_run_id():
+    """
+    Returns the identifier of the run the step metrics are recorded under.
+
+    Returns:
+        str: The run ID.
+    """
+    with _lock:
+        if _run_history['run_id'] is None:
+            _run_history['run_id'] = uuid.uuid4().hex
+        return _run_history['run_id']
+
+
+def build_run_history_ddl(table_name):
+    """
+    Builds the DDL of the run-history table.
+
+    Args:
+        table_name (str): The name of the run-history table.
+
+    Returns:
+        str: The CREATE TABLE statement.
+    """
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+          RunId VARCHAR(128) NOT NULL,
+          JobName VARCHAR(128) NOT NULL,
+          StepOrder INT NOT NULL,
+          StepName VARCHAR(128) NOT NULL,
+          Status VARCHAR(16) NOT NULL,
+          StartedAt TIMESTAMP NOT NULL,
+          Seconds DECIMAL(12,3),
+          RowsAffected BIGINT,
+          QueryId BIGINT
+        );
+        """
+
+
+class StepRunner:
+    """
+    Runs the named SQL steps of a job and records how long each took, how many
+    rows it touched and its Redshift query ID. With plan capture on (see
+    pipeline.plans.set_plan_capture), the plan of every step is captured and
+    checked for regressions before the step runs.
+    """
+
+    def __init__(self, conn, job_name):
+        self.conn = conn
+        self.job_name = job_name
+        self.steps = []
+        self.plans = plans.PlanRecorder(conn, job_name, get_run_id())
+
+    def _last_query_id(self, cur):
+        """
+        Returns the Redshift query ID of the statement just run, None on PostgreSQL.
+        """
+        if not runtime.is_redshift(self.conn):
+            return None
+        cur.execute("SELECT pg_last_query_id();")
+        return cur.fetchone()[0]
+
+    def run(self, cur, step_name, statement, params=None):
+        """
+        Runs one step and prints its metrics as JSON.
+
+        Args:
+            cur: The cursor to run the statement with.
+            step_name (str): The name of the step, e.g. 'insert_dimension'.
+            statement (str): The SQL statement.
+            params: The query parameters of the statement.
+
+        Returns:
+            int: The number of rows the statement touched, None for DDL.
+        """
+        metrics = {
+            'job': self.job_name,
+            'step': step_name,
+            'status': 'failed',
+            'started_at': datetime.datetime.utcnow().isoformat(sep=' ', timespec='milliseconds'),
+            'seconds': None,
+            'rows': None,
+            'query_id': None
+        }
+        self.steps.append(metrics)
+        if plans.get_plan_capture()['mode'] != 'off' and plans.is_explainable(statement):
+            try:
+                self.plans.check(cur, step_name, statement, params)
+            except Exception:
+                print(json.dumps(metrics))
+                raise
+        start = time.perf_counter()
+        try:
+            cur.execute(statement, params)
+        except Exception:
+            metrics['seconds'] = round(time.perf_counter() - start, 3)
+            print(json.dumps(metrics))
+            raise
+        metrics['seconds'] = round(time.perf_counter() - start, 3)
+        metrics['rows'] = cur.rowcount if cur.rowcount >= 0 else None
+        metrics['query_id'] = self._last_query_id(cur)
+        metrics['status'] = 'succeeded'
+        print(json.dumps(metrics))
+        return metrics['rows']
+
+    def run_all(self, cur, steps):
+        """
+        Runs (name, statement) steps in order.
+
+        Args:
+            cur: The cursor to run the statements with.
+            steps (list): The steps, as (name, statement) tuples.
+        """
+        for step_name, statement in steps:
+            self.run(cur, step_name, statement)
+
+    def save(self):
+        """
+        Writes the recorded steps to the run-history table, if one is set,
+        and the captured plans to the plan history table.
+
+        Call it after the job's transaction was committed or rolled back. A
+        failure to write the history is printed and does not fail the job.
+        """
+        self.plans.save()
+        with _lock:
+            table_name = _run_history['table_name']
+        if table_name is None or not self.steps:
+            return
+
+        rows = [
+            (get_run_id(), self.job_name, i + 1, step['step'], step['status'], step['started_at'],
+             step['seconds'], step['rows'], step['query_id'])
+            for i, step in enumerate(self.steps)
+        ]
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(build_run_history_ddl(table_name))
+                execute_values(cur, f"""
+                    INSERT INTO {table_name}
+                      (RunId, JobName, StepOrder, StepName, Status, StartedAt, Seconds, RowsAffected, QueryId)
+                    VALUES %s;
+                    """, rows)
+            self.conn.commit()
+        except psycopg2.Error as e:
+            self.conn.rollback()
+            print(f"Failed to write the run history of {self.job_name}: {e}")
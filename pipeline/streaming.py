@@ -0,0 +1,235 @@
+import io
+import json
+import resource
+import threading
+import time
+import tracemalloc
+
+import psycopg2
+
+from pipeline import runtime
+from pipeline.ledger import fingerprint_file, is_loaded, record_load_done, record_load_start, report_skip
+from pipeline.preflight import preflight_csv
+from pipeline.s3_copy import describe_source, open_source
+from pipeline.validation import table_columns, validate_data
+
+
+# Bytes handed to the server per read of the source
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+# Parquet rows converted to CSV at a time
+DEFAULT_BATCH_ROWS = 64 * 1024
+
+# tracemalloc is global to the process, so traced loads run one at a time
+_trace_lock = threading.Lock()
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    Read-only file object over an iterator of byte chunks, holding one chunk at a time.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b''
+        self._offset = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._offset >= len(self._chunk):
+                self._chunk = next(self._chunks, b'')
+                self._offset = 0
+                if not self._chunk:
+                    break
+            end = len(self._chunk) if size < 0 else min(len(self._chunk), self._offset + size)
+            parts.append(self._chunk[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+        return b''.join(parts)
+
+
+def _parquet_source(source, batch_rows):
+    """
+    Converts a Parquet file to CSV one record batch at a time.
+
+    Args:
+        source: A path or binary file object of the Parquet file.
+        batch_rows (int): The number of rows converted at a time.
+
+    Returns:
+        tuple: The column names and a file object streaming the CSV rows, without header.
+    """
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Streaming Parquet files requires the pyarrow package")
+
+    parquet_file = pyarrow.parquet.ParquetFile(source)
+    write_options = pyarrow.csv.WriteOptions(include_header=False)
+
+    def chunks():
+        for batch in parquet_file.iter_batches(batch_size=batch_rows):
+            buffer = io.BytesIO()
+            pyarrow.csv.write_csv(pyarrow.Table.from_batches([batch]), buffer, write_options=write_options)
+            yield buffer.getvalue()
+
+    return parquet_file.schema_arrow.names, _ChunkReader(chunks())
+
+
+def stream_copy(conn, source, table_name, data_format=None, columns=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, batch_rows=DEFAULT_BATCH_ROWS, trace_memory=False):
+    """
+    Streams a CSV or Parquet source into a table through COPY FROM STDIN.
+
+    The source is read in fixed-size chunks, so memory use does not depend on
+    its size. COPY FROM STDIN is served by PostgreSQL-compatible servers such
+    as the local Postgres stand-in; Redshift only loads through S3 COPY.
+
+    Args:
+        conn: The database connection. The caller commits.
+        source: A local path (GZIP/ZSTD compressed CSV is recognised from the
+            extension) or a file object. CSV sources start with a header row.
+        table_name (str): The name of the target table.
+        data_format (str): "csv" or "parquet". Derived from the path when omitted,
+            "csv" for file objects.
+        columns (list): The target columns, in source order. Parquet sources
+            use their own column names when omitted.
+        chunk_size (int): The number of bytes read from the source at a time.
+        batch_rows (int): The number of Parquet rows converted at a time.
+        trace_memory (bool): Also report the peak of Python allocations during
+            this load, measured with tracemalloc, which slows allocations down.
+            tracemalloc traces the whole process: traced loads wait for each
+            other, and the peak includes the allocations of any other thread
+            running meanwhile, so only trace loads running on their own.
+
+    Returns:
+        dict: The number of rows, the duration, the throughput, the peak of
+        Python allocations during the load (None unless traced) and the
+        peak resident memory of the whole process so far.
+    """
+    if data_format is None:
+        data_format = describe_source(source)['data_format'] if isinstance(source, str) else 'csv'
+
+    started_tracing = False
+    if trace_memory:
+        _trace_lock.acquire()
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        if data_format == 'parquet':
+            parquet_columns, reader = _parquet_source(source, batch_rows)
+            columns = columns or parquet_columns
+            options = "FORMAT csv"
+        elif data_format == 'csv':
+            reader = open_source(source) if isinstance(source, str) else source
+            options = "FORMAT csv, HEADER true"
+        else:
+            raise Exception(f"Unsupported data format: {data_format}")
+
+        column_list = f" ({', '.join(columns)})" if columns else ""
+        try:
+            with conn.cursor() as cur:
+                cur.copy_expert(f"COPY {table_name}{column_list} FROM STDIN WITH ({options})", reader, size=chunk_size)
+                row_count = cur.rowcount
+        finally:
+            if isinstance(source, str):
+                reader.close()
+        seconds = time.perf_counter() - start
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        if trace_memory:
+            _trace_lock.release()
+
+    metrics = {
+        'table': table_name,
+        'rows': row_count,
+        'seconds': round(seconds, 3),
+        'rows_per_second': round(row_count / seconds) if seconds > 0 else None,
+        'peak_traced_bytes': peak_traced_bytes,
+        # The high-water mark of the process since it started, not of this load; in kilobytes on Linux
+        'process_peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    }
+    print(json.dumps(metrics))
+    return metrics
+
+
+def stream_data_to_table(source, table_name, redshift_conn=None, data_format=None, columns=None,
+                         chunk_size=DEFAULT_CHUNK_SIZE, preflight='none', force_load=False, trace_memory=False):
+    """
+    Replaces the contents of a source table with a streamed file and validates it.
+
+    This is the client-side counterpart of copy_data_to_redshift for the
+    tables of table_columns.
+
+    Args:
+        source: A local path or a file object, see stream_copy.
+        table_name (str): The name of the table.
+        redshift_conn: The connection to use. A pooled connection is taken when omitted.
+        data_format (str): "csv" or "parquet", see stream_copy.
+        columns (list): The target columns, in source order.
+        chunk_size (int): The number of bytes read from the source at a time.
+        preflight (str): How a CSV path is checked before the table is
+            truncated: "none", the default, or "exact" or "bloom" key tracking
+            (see pipeline.preflight). File objects are not checked, as they can be read only once.
+        force_load (bool): Whether to load a path even when the load ledger
+            shows that the table already holds its content, validated. File
+            objects are always loaded.
+        trace_memory (bool): Whether to measure the peak of Python
+            allocations during the load, see stream_copy. Off by default, as
+            it slows the load down and its peak covers the whole process.
+
+    Returns:
+        dict: The load metrics, see stream_copy, or the metrics of the skip,
+        with 'skipped' set, when the content was already loaded.
+    """
+    if table_name not in table_columns:
+        print("Invalid table name")
+        raise Exception("Table Not Found")
+
+    own_connection = redshift_conn is None
+    if own_connection:
+        redshift_conn = runtime.get_connection()
+    try:
+        # Content with the hash of the table's last validated load is not loaded again
+        fingerprint = None
+        if isinstance(source, str):
+            fingerprint, size = fingerprint_file(source)
+            if not force_load and is_loaded(redshift_conn, table_name, fingerprint):
+                return report_skip(table_name, source, fingerprint)
+
+        if preflight != 'none' and isinstance(source, str) and columns is None:
+            if (data_format or describe_source(source)['data_format']) == 'csv':
+                preflight_csv([source], table_name, preflight)
+
+        with redshift_conn.cursor() as cur:
+            if fingerprint is not None:
+                record_load_start(cur, table_name, source, fingerprint, size)
+            cur.execute(f"TRUNCATE TABLE {table_name};")
+        metrics = stream_copy(redshift_conn, source, table_name, data_format, columns, chunk_size,
+                              trace_memory=trace_memory)
+        redshift_conn.commit()
+        validate_data(redshift_conn, table_name)
+        if fingerprint is not None:
+            record_load_done(redshift_conn, table_name, fingerprint)
+        return metrics
+    except psycopg2.Error as e:
+        print(f"Error streaming data into table {table_name}: {str(e)}")
+        raise Exception("Data loading failed")
+    finally:
+        if own_connection:
+            runtime.release_connection(redshift_conn)
+        else:
+            redshift_conn.rollback()
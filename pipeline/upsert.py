@@ -0,0 +1,325 @@
+import psycopg2
+
+from pipeline import schema
+from pipeline.steps import StepRunner
+
+
+# Source tables that are loaded into an SCD2 dimension
+dimension_tables = ['customers', 'products', 'stores']
+
+# Column lists of the source, dimension and staging tables, from the schema registry
+relational_columns = {table_name.lower(): schema.column_names(table_name) for table_name in schema.source_tables}
+dim_columns = {table_name: schema.column_definitions(f"dim_{table_name}") for table_name in dimension_tables}
+staging_columns = {table_name: schema.column_definitions(f"dim_{table_name}_staging") for table_name in dimension_tables}
+
+
+def _column_names(columns):
+    """
+    Strips the type definitions from a list of column definitions.
+
+    Args:
+        columns (list): The column definitions, e.g. 'CustomerID INT NOT NULL'.
+
+    Returns:
+        list: The column names.
+    """
+    return [column.split(' ')[0] for column in columns]
+
+
+def _row_hash(columns, alias):
+    """
+    Builds the expression hashing the tracked columns of a row.
+
+    Args:
+        columns (list): The tracked column names.
+        alias (str): The table alias the columns are qualified with.
+
+    Returns:
+        str: The MD5 expression. NULLs are replaced by a marker so that they
+        hash differently from empty strings.
+    """
+    parts = [f"COALESCE(CAST({alias}.{column} AS VARCHAR), '<null>')" for column in columns]
+    separator = " || '|' || "
+    return f"MD5({separator.join(parts)})"
+
+
+def build_key_map_ddl(table_name, dialect='redshift'):
+    """
+    Builds the DDL of the map from natural keys to the surrogate keys of the current versions.
+
+    Args:
+        table_name (str): The name of the source table.
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        str: The CREATE TABLE statement.
+    """
+    return schema.build_create_table(f"keymap_{table_name}", dialect, if_not_exists=True)
+
+
+def build_key_map_statements(table_name, dialect='redshift'):
+    """
+    Builds the statements that maintain the key map after an incremental upsert.
+
+    Only the keys classified as new or changed in dim_<table>_changes are
+    replaced. An empty map is first filled from the current dimension versions.
+
+    Args:
+        table_name (str): The name of the source table.
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        list: The steps, as (name, statement) tuples in execution order.
+    """
+    surrogate_key, natural_key = _column_names(dim_columns[table_name][:2])
+    return [
+        ('create_key_map', build_key_map_ddl(table_name, dialect)),
+        ('bootstrap_key_map', f"""
+        INSERT INTO keymap_{table_name} ({natural_key}, {surrogate_key})
+        SELECT {natural_key}, {surrogate_key}
+        FROM dim_{table_name}
+        WHERE EndDate = '9999-12-31'
+          AND NOT EXISTS (SELECT 1 FROM keymap_{table_name});
+        """),
+        ('delete_changed_keys', f"""
+        DELETE FROM keymap_{table_name}
+        WHERE {natural_key} IN (
+          SELECT {natural_key} FROM dim_{table_name}_changes WHERE ChangeType IN ('new', 'changed')
+        );
+        """),
+        ('insert_changed_keys', f"""
+        INSERT INTO keymap_{table_name} ({natural_key}, {surrogate_key})
+        SELECT d.{natural_key}, d.{surrogate_key}
+        FROM dim_{table_name} d
+        JOIN dim_{table_name}_changes c ON d.{natural_key} = c.{natural_key}
+        WHERE c.ChangeType IN ('new', 'changed')
+          AND d.EndDate = '9999-12-31';
+        """)
+    ]
+
+
+def build_full_upsert_statements(table_name, dialect='redshift'):
+    """
+    Builds the steps that expire and re-insert every business key of the source table.
+
+    Args:
+        table_name (str): The name of the source table.
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        list: The steps, as (name, statement) tuples in execution order.
+    """
+    surrogate_key, natural_key = _column_names(dim_columns[table_name][:2])
+    return [
+        # Create the staging table
+        ('create_staging', schema.build_create_table(f"dim_{table_name}_staging", dialect)),
+        # Insert new records into the staging table
+        ('insert_staging', f"""
+            INSERT INTO dim_{table_name}_staging ({', '.join([column.split(' ')[0] for column in staging_columns[table_name][:-1]])})
+            SELECT DISTINCT {', '.join([column.split(' ')[0] for column in staging_columns[table_name][:-1]])}
+            FROM {table_name};
+            """),
+        # Update end dates for existing records
+        ('expire_current', f"""
+            UPDATE dim_{table_name}
+            SET EndDate = current_date - INTERVAL '1 day'
+            WHERE {dim_columns[table_name][1].split(' ')[0]} IN (SELECT {dim_columns[table_name][1].split(' ')[0]} FROM {table_name})
+              AND EndDate = '9999-12-31';
+            """),
+        # Insert new records from the staging table into the dimension table
+        ('insert_dimension', f"""
+            INSERT INTO dim_{table_name} ({', '.join([column.split(' ')[0] for column in dim_columns[table_name][1:]])})
+            SELECT {', '.join([column.split(' ')[0] for column in staging_columns[table_name]])}, '9999-12-31'
+            FROM dim_{table_name}_staging;
+            """),
+        ('drop_staging', f"DROP TABLE dim_{table_name}_staging;"),
+        # Rebuild the natural key to surrogate key map of the current versions
+        ('create_key_map', build_key_map_ddl(table_name, dialect)),
+        ('clear_key_map', f"DELETE FROM keymap_{table_name};"),
+        ('rebuild_key_map', f"""
+            INSERT INTO keymap_{table_name} ({natural_key}, {surrogate_key})
+            SELECT {natural_key}, {surrogate_key}
+            FROM dim_{table_name}
+            WHERE EndDate = '9999-12-31';
+            """)
+    ]
+
+
+def build_incremental_upsert_statements(table_name, use_merge=True, dialect='redshift'):
+    """
+    Builds the statements of the change-detecting SCD2 upsert.
+
+    Source rows are compared with the current dimension version through a hash
+    of the tracked columns from relational_columns. Only new and changed
+    business keys are expired and inserted.
+
+    Args:
+        table_name (str): The name of the source table.
+        use_merge (bool): Whether to expire and insert with a single MERGE.
+        dialect (str): The DDL dialect, see pipeline.schema.build_create_table.
+
+    Returns:
+        list: The steps, as (name, statement) tuples in execution order.
+    """
+    business_key = relational_columns[table_name][0]
+    tracked_columns = relational_columns[table_name][1:]
+    staging_names = _column_names(staging_columns[table_name])
+    source_names = staging_names[:-1]
+    dim_names = _column_names(dim_columns[table_name][1:])
+
+    statements = [
+        ('create_staging', schema.build_create_table(f"dim_{table_name}_staging", dialect, temporary=True)),
+        ('insert_staging', f"""
+        INSERT INTO dim_{table_name}_staging ({', '.join(source_names)})
+        SELECT DISTINCT {', '.join(source_names)}
+        FROM {table_name};
+        """),
+        # Classify every staged row against the current version of its business key
+        ('classify_changes', f"""
+        CREATE TEMP TABLE dim_{table_name}_changes AS
+        SELECT {', '.join([f's.{column}' for column in staging_names])},
+          CASE
+            WHEN d.{business_key} IS NULL THEN 'new'
+            WHEN d.RowHash <> {_row_hash(tracked_columns, 's')} THEN 'changed'
+            ELSE 'unchanged'
+          END AS ChangeType
+        FROM dim_{table_name}_staging s
+        LEFT JOIN (
+          SELECT c.{business_key}, {_row_hash(tracked_columns, 'c')} AS RowHash
+          FROM dim_{table_name} c
+          WHERE c.EndDate = '9999-12-31'
+        ) d ON d.{business_key} = s.{business_key};
+        """)
+    ]
+
+    if use_merge:
+        # Changed keys appear twice in the merge source: once with their key to
+        # expire the current version and once with a NULL key to insert the new one
+        statements += [
+            ('create_merge_source', f"""
+            CREATE TEMP TABLE dim_{table_name}_merge_source AS
+            SELECT {business_key} AS MergeKey, {', '.join(staging_names)}
+            FROM dim_{table_name}_changes
+            WHERE ChangeType = 'changed'
+            UNION ALL
+            SELECT CAST(NULL AS INT) AS MergeKey, {', '.join(staging_names)}
+            FROM dim_{table_name}_changes
+            WHERE ChangeType IN ('new', 'changed');
+            """),
+            ('merge_dimension', f"""
+            MERGE INTO dim_{table_name}
+            USING dim_{table_name}_merge_source src
+            ON dim_{table_name}.{business_key} = src.MergeKey AND dim_{table_name}.EndDate = '9999-12-31'
+            WHEN MATCHED THEN UPDATE SET EndDate = current_date - INTERVAL '1 day'
+            WHEN NOT MATCHED THEN INSERT ({', '.join(dim_names)})
+            VALUES ({', '.join([f'src.{column}' for column in staging_names])}, '9999-12-31');
+            """)
+        ]
+    else:
+        statements += [
+            ('expire_changed', f"""
+            UPDATE dim_{table_name}
+            SET EndDate = current_date - INTERVAL '1 day'
+            FROM dim_{table_name}_changes c
+            WHERE dim_{table_name}.{business_key} = c.{business_key}
+              AND c.ChangeType = 'changed'
+              AND dim_{table_name}.EndDate = '9999-12-31';
+            """),
+            ('insert_dimension', f"""
+            INSERT INTO dim_{table_name} ({', '.join(dim_names)})
+            SELECT {', '.join(staging_names)}, '9999-12-31'
+            FROM dim_{table_name}_changes
+            WHERE ChangeType IN ('new', 'changed');
+            """)
+        ]
+    return statements
+
+
+def incremental_upsert(conn, table_name, use_merge=True):
+    """
+    Runs the change-detecting SCD2 upsert of a dimension and maintains its key map
+    in one transaction.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the source table.
+        use_merge (bool): Whether to expire and insert with a single MERGE.
+
+    Returns:
+        dict: The number of inserted, expired and unchanged business keys.
+    """
+    dialect = schema.dialect_of(conn)
+    steps = StepRunner(conn, f"upsert_{table_name}")
+    with conn.cursor() as cur:
+        try:
+            steps.run_all(cur, build_incremental_upsert_statements(table_name, use_merge, dialect))
+            steps.run_all(cur, build_key_map_statements(table_name, dialect))
+
+            cur.execute(f"SELECT ChangeType, COUNT(*) FROM dim_{table_name}_changes GROUP BY ChangeType;")
+            change_counts = dict(cur.fetchall())
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    # Temporary tables live until the end of the session, so drop them for pooled connections
+    with conn.cursor() as cur:
+        for suffix in ['staging', 'changes', 'merge_source']:
+            cur.execute(f"DROP TABLE IF EXISTS dim_{table_name}_{suffix};")
+        conn.commit()
+
+    new_count = change_counts.get('new', 0)
+    changed_count = change_counts.get('changed', 0)
+    return {
+        'inserted': new_count + changed_count,
+        'expired': changed_count,
+        'unchanged': change_counts.get('unchanged', 0)
+    }
+
+
+def full_upsert(conn, table_name):
+    """
+    Expires and re-inserts every business key of the source table.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the source table.
+
+    Returns:
+        dict: The number of inserted and expired dimension rows.
+    """
+    steps = StepRunner(conn, f"upsert_{table_name}")
+    with conn.cursor() as cur:
+        try:
+            steps.run_all(cur, build_full_upsert_statements(table_name, schema.dialect_of(conn)))
+            conn.commit()
+        except (Exception, psycopg2.DatabaseError):
+            conn.rollback()
+            steps.save()
+            raise
+    steps.save()
+
+    rows = {step['step']: step['rows'] for step in steps.steps}
+    return {'inserted': rows['insert_dimension'], 'expired': rows['expire_current']}
+
+
+def upsert_dimension(conn, table_name, upsert_mode='incremental', use_merge=True):
+    """
+    Loads a source table into its SCD2 dimension.
+
+    Args:
+        conn: The connection to the Redshift database.
+        table_name (str): The name of the source table.
+        upsert_mode (str): "incremental" only versions new and changed keys,
+            "full" re-versions every key of the source.
+        use_merge (bool): Whether the incremental upsert uses a single MERGE.
+
+    Returns:
+        dict: The inserted and expired counts, and the unchanged count of an
+        incremental upsert.
+    """
+    if upsert_mode == 'incremental':
+        return incremental_upsert(conn, table_name, use_merge)
+    return full_upsert(conn, table_name)
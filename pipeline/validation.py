@@ -0,0 +1,319 @@
+import psycopg2
+import json
+from pipeline import runtime, schema
+from pipeline.ledger import fingerprint_s3_source, is_loaded, record_load_done, record_load_start, report_skip
+from pipeline.preflight import preflight_copy_source
+from pipeline.profiling import build_profile_select, parse_profile, record_profile
+from pipeline.s3_copy import build_copy_command, prepare_copy_source
+
+
+# Columns checked by validate_data, the first one being the unique key
+table_columns = {table_name: schema.validated_columns(table_name) for table_name in schema.source_tables}
+
+# Number of offending rows fetched for each failed check
+SAMPLE_ROW_LIMIT = 10
+
+
+def _key_expression(unique_key_columns):
+    """
+    Builds the expression used to count distinct values of the unique key.
+
+    Args:
+        unique_key_columns (list): The columns of the unique key.
+
+    Returns:
+        str: The key expression. Composite keys are concatenated so that a row
+        with a NULL in any key column is left out of both counts.
+    """
+    if len(unique_key_columns) == 1:
+        return unique_key_columns[0]
+    return " || '|' || ".join([f"CAST({column} AS VARCHAR)" for column in unique_key_columns])
+
+
+def build_validation_query(table_name, not_null_columns, unique_key_columns, profile_columns=None, dialect='redshift'):
+    """
+    Builds one aggregate query that evaluates every check of a table in a single scan.
+
+    Args:
+        table_name (str): The name of the table.
+        not_null_columns (list): The columns that must not contain NULL values.
+        unique_key_columns (list): The columns of the unique key.
+        profile_columns (list): The columns whose statistics are gathered in
+            the same scan, see pipeline.profiling.build_profile_select.
+        dialect (str): "redshift" or "postgres".
+
+    Returns:
+        str: The query. It returns the row count, one NULL count per NOT NULL
+        column, the number of duplicate key values and the profile
+        aggregates, in that order.
+    """
+    key_expression = _key_expression(unique_key_columns)
+    select_list = ["COUNT(*)"]
+    select_list += [f"COUNT(*) - COUNT({column})" for column in not_null_columns]
+    select_list.append(f"COUNT({key_expression}) - COUNT(DISTINCT {key_expression})")
+    select_list += build_profile_select(profile_columns or [], dialect)
+    return f"SELECT {', '.join(select_list)} FROM {table_name};"
+
+
+def run_validation(redshift_conn, table_name, relation=None, profile=True):
+    """
+    Runs every NOT NULL and uniqueness check of a table and collects all violations.
+
+    Args:
+        redshift_conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+        relation (str): The table holding the data, e.g. a shadow copy of
+            table_name. Defaults to table_name.
+        profile (bool): Whether to gather the statistics of every column in
+            the same scan.
+
+    Returns:
+        dict: The row count, the list of violations and the column statistics.
+        Each violation holds the check, the columns, the number of offending
+        rows and a sample of them.
+    """
+    if table_name not in table_columns:
+        print("Invalid table name")
+        raise Exception("Table Not Found")
+
+    relation = relation or table_name
+    not_null_columns = table_columns[table_name]
+    unique_key_columns = [table_columns[table_name][0]]
+    profile_columns = schema.column_names(table_name) if profile else []
+    violations = []
+
+    with redshift_conn.cursor() as cur:
+        cur.execute(build_validation_query(relation, not_null_columns, unique_key_columns, profile_columns,
+                                           schema.dialect_of(redshift_conn)))
+        row = cur.fetchone()
+        row_count = row[0]
+        null_counts = row[1:len(not_null_columns) + 1]
+        duplicate_count = row[len(not_null_columns) + 1]
+        column_stats = parse_profile(profile_columns, row_count, row[len(not_null_columns) + 2:])
+        print(f"Validation query executed on table {relation}: {row_count} rows")
+
+        # Sample rows are only fetched for the checks that failed
+        for column, count in zip(not_null_columns, null_counts):
+            if count > 0:
+                cur.execute(f"SELECT * FROM {relation} WHERE {column} IS NULL LIMIT {SAMPLE_ROW_LIMIT};")
+                violations.append({
+                    'check': 'not_null',
+                    'columns': [column],
+                    'count': count,
+                    'sample': cur.fetchall()
+                })
+
+        if duplicate_count > 0:
+            unique_key = ", ".join(unique_key_columns)
+            cur.execute(
+                f"SELECT {unique_key}, COUNT(*) FROM {relation} GROUP BY {unique_key} "
+                f"HAVING COUNT(*) > 1 LIMIT {SAMPLE_ROW_LIMIT};"
+            )
+            violations.append({
+                'check': 'unique',
+                'columns': unique_key_columns,
+                'count': duplicate_count,
+                'sample': cur.fetchall()
+            })
+
+    return {'table': table_name, 'row_count': row_count, 'violations': violations, 'profile': column_stats}
+
+
+def validate_data(redshift_conn, table_name, relation=None, profile=True):
+    """
+    Validates the data in the specified table.
+
+    Args:
+        redshift_conn: The connection to the Redshift database.
+        table_name (str): The name of the table.
+        relation (str): The table holding the data, e.g. a shadow copy of
+            table_name. Defaults to table_name.
+        profile (bool): Whether to store the statistics of every column,
+            gathered in the validation scan, in etl_column_stats and flag
+            volume and cardinality anomalies against the previous load.
+
+    Returns:
+        bool: True if the data is valid. Raises an exception listing every
+        violation otherwise.
+    """
+    print(f"In validate_data function with connection {redshift_conn} and table {table_name}")
+
+    result = run_validation(redshift_conn, table_name, relation, profile)
+    if profile:
+        record_profile(redshift_conn, table_name, result['row_count'], result['profile'], not result['violations'])
+    if result['violations']:
+        messages = []
+        for violation in result['violations']:
+            columns = ", ".join(violation['columns'])
+            if violation['check'] == 'not_null':
+                message = f"{violation['count']} rows with NULL value in column {columns}"
+            else:
+                message = f"{violation['count']} duplicate rows for the unique key {columns}"
+            print(f"Data violation: {message} of table {table_name}. Sample rows: {violation['sample']}")
+            messages.append(message)
+        raise Exception(f"Constraints violation in Table: {table_name}: {'; '.join(messages)}")
+    return True
+
+
+def _rename_swap(redshift_conn, cur, table_name, new_table):
+    """
+    Swaps a table in for the live table by name, in one short transaction.
+    """
+    cur.execute(f"DROP TABLE IF EXISTS {table_name}_old;")
+    cur.execute(f"ALTER TABLE {table_name} RENAME TO {table_name}_old;")
+    cur.execute(f"ALTER TABLE {new_table} RENAME TO {table_name};")
+    redshift_conn.commit()
+    cur.execute(f"DROP TABLE {table_name}_old;")
+    redshift_conn.commit()
+
+
+def swap_tables(redshift_conn, table_name, shadow_table, swap_method='rename'):
+    """
+    Replaces the contents of a live table with those of its validated shadow table.
+
+    Either way the live table keeps its previous contents until the swap
+    commits, and a failed swap leaves it untouched.
+
+    Args:
+        redshift_conn: The connection to the Redshift database.
+        table_name (str): The name of the live table.
+        shadow_table (str): The name of the shadow table.
+        swap_method (str): "rename" swaps the tables by name in one short
+            transaction; grants on the live table have to be granted again
+            afterwards. "append" first moves the blocks of the shadow table
+            with ALTER TABLE APPEND into an empty copy of the live table
+            (CREATE TABLE ... LIKE), which is then swapped in by name, so the
+            new table keeps the live table's column encodings, distribution
+            and sort keys whatever the shadow table was created with.
+    """
+    with redshift_conn.cursor() as cur:
+        if swap_method == 'rename':
+            _rename_swap(redshift_conn, cur, table_name, shadow_table)
+        elif swap_method == 'append':
+            replacement = f"{table_name}_swap"
+            cur.execute(f"DROP TABLE IF EXISTS {replacement};")
+            cur.execute(f"CREATE TABLE {replacement} (LIKE {table_name});")
+            redshift_conn.commit()
+            # ALTER TABLE APPEND cannot run in a transaction; it only touches the shadow and the copy
+            redshift_conn.autocommit = True
+            try:
+                cur.execute(f"ALTER TABLE {replacement} APPEND FROM {shadow_table};")
+                cur.execute(f"DROP TABLE {shadow_table};")
+            except psycopg2.Error:
+                cur.execute(f"DROP TABLE IF EXISTS {replacement};")
+                raise
+            finally:
+                redshift_conn.autocommit = False
+            _rename_swap(redshift_conn, cur, table_name, replacement)
+        else:
+            raise Exception(f"Unsupported swap method: {swap_method}")
+    print(f"Table {shadow_table} swapped into {table_name} with {swap_method}")
+
+
+def copy_data_to_redshift(bucket, key, table_name, redshift_conn=None, load_mode='truncate',
+                          swap_method='rename', preflight='none', force_load=False, **copy_options):
+    """
+    Copies data from an S3 bucket to a Redshift table.
+
+    Args:
+        bucket (str): The name of the S3 bucket.
+        key (str): The key of the file, of a prefix ending with '/' or of a
+            manifest in the S3 bucket.
+        table_name (str): The name of the Redshift table.
+        redshift_conn: The connection to use. A pooled connection is taken when omitted.
+        load_mode (str): "truncate" empties the live table and copies into it.
+            "swap" copies into a shadow table, validates it and only then swaps
+            it in, so the live table stays readable and intact on failure.
+        swap_method (str): How the shadow table is swapped in, see swap_tables.
+        preflight (str): How CSV files are checked before anything is copied:
+            "none", the default, or "exact" or "bloom" key tracking (see
+            pipeline.preflight). The check downloads and parses every file in
+            this process, so it is only worth it where a failed COPY costs more.
+        force_load (bool): Whether to load the objects even when the load
+            ledger shows that the table already holds them, validated.
+        **copy_options: The format, compression, manifest and split options,
+            see pipeline.s3_copy.prepare_copy_source.
+
+    Returns:
+        dict: The result of the data copy operation, with 'skipped' set when
+        the objects were already loaded.
+    """
+    print("Into copy_data_to_redshift function")
+    if table_name not in table_columns:
+        print("Invalid table name")
+        raise Exception("Table Not Found")
+
+    own_connection = redshift_conn is None
+    if own_connection:
+        redshift_conn = runtime.get_connection()
+    
+    with redshift_conn.cursor() as cur:
+        try:
+            # Objects with the ETags and sizes of the table's last validated load are not loaded again
+            source_uri = f"s3://{bucket}/{key}"
+            fingerprint, size = fingerprint_s3_source(bucket, key)
+            if not force_load and is_loaded(redshift_conn, table_name, fingerprint):
+                report_skip(table_name, source_uri, fingerprint)
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('Source already loaded and validated, load skipped'),
+                    'skipped': True
+                }
+
+            if preflight != 'none':
+                # Reject a bad file while the table still holds the previous load
+                preflight_copy_source(bucket, key, table_name, preflight, copy_options.get('data_format'),
+                                      copy_options.get('compression'))
+
+            key, data_format, compression = prepare_copy_source(redshift_conn, bucket, key, **copy_options)
+            if load_mode == 'swap':
+                shadow_table = f"{table_name}_shadow"
+                redshift_copy_command = f"""
+    DROP TABLE IF EXISTS {shadow_table};
+    CREATE TABLE {shadow_table} (LIKE {table_name});
+    {build_copy_command(shadow_table, bucket, key, data_format, compression)}
+    """
+            elif load_mode == 'truncate':
+                shadow_table = None
+                redshift_copy_command = f"""
+    TRUNCATE TABLE {table_name};
+    {build_copy_command(table_name, bucket, key, data_format, compression)}
+    """
+            else:
+                raise Exception(f"Unsupported load mode: {load_mode}")
+            print(f"SQL: {redshift_copy_command}")
+            record_load_start(cur, table_name, source_uri, fingerprint, size)
+            cur.execute(redshift_copy_command)
+            redshift_conn.commit()
+
+            # Validate the data; a failed shadow table is kept for inspection until the next load
+            data_valid = validate_data(redshift_conn, table_name, shadow_table)
+            if data_valid and shadow_table is not None:
+                swap_tables(redshift_conn, table_name, shadow_table, swap_method)
+
+            if data_valid:
+                record_load_done(redshift_conn, table_name, fingerprint)
+                print("Data validation and ingestion completed successfully")
+                return {
+                    'statusCode': 200,
+                    'body': json.dumps('Data validation and ingestion completed successfully')
+                }
+            else:
+                print("Data validation failed")
+                raise Exception("Data validation failed")
+                # return {
+                #     'statusCode': 400,
+                #     'body': json.dumps('Data validation failed')
+                # }
+        except psycopg2.Error as e:
+            print(f"Error loading data into table {table_name}: {str(e)}")
+            raise Exception("Data loading failed")
+            # return {
+            #     'statusCode': 500,
+            #     'body': json.dumps(f"Error loading data into table {table_name}")
+            # }
+        finally:
+            if own_connection:
+                runtime.release_connection(redshift_conn)
+            else:
+                redshift_conn.rollback()
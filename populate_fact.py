@@ -1,152 +1,48 @@
 import psycopg2
-import json
-import boto3
-from botocore.exceptions import ClientError
-from awsglue.utils import getResolvedOptions
-import sys
+from pipeline import runtime, steps
+from pipeline.fact import load_facts
+from pipeline.integrity import check_references
+from pipeline.maintenance import maintain_tables, thresholds_from_params
 
-args = getResolvedOptions(sys.argv, ['SecretName', 'SecretRegionName', 'SecretManagerService'])
 
-# Access the custom parameters
-_secret_name = args['SecretName']
-_region_name = args['SecretRegionName']
-_service_name = args['SecretManagerService']
-
-def get_workflow_params():
+def main():
     """
-    Retrieves the workflow parameters from AWS Glue.
-
-    Returns:
-        dict: The workflow parameters.
+    Populates fact_orders once the order lines of the workflow run are loaded.
     """
-    print("Into get_workflow_params function")
-    try:
-        print("Into get_workflow_params Try")
-        glue_client = boto3.client("glue")
-        print("Glue Client Created")
-        args = getResolvedOptions(sys.argv, ['WORKFLOW_NAME', 'WORKFLOW_RUN_ID'])
-        workflow_name = args['WORKFLOW_NAME']
-        workflow_run_id = args['WORKFLOW_RUN_ID']
+    params = runtime.get_workflow_params()
+    table_name = params['table_name'].lower()
+    steps.configure_from_params(params)
 
-        workflow_params = glue_client.get_workflow_run_properties(Name=workflow_name, RunId=workflow_run_id)["RunProperties"]
-        print("Workflow properties")
-        print(f"{workflow_name}, {workflow_params}")
-        return workflow_params
-    except Exception as exception:
-        print("Failed to get workflow parameters")
-        raise Exception(f"Failed to get workflow parameters")
-        raise
-    
-def get_secret():
-    secret_name = _secret_name
-    region_name = _region_name
-
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name=_service_name,
-        region_name=_region_name
-    )
-
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=secret_name
-        )
-    except ClientError as e:
-        raise Exception("Secret Manager get_secret_value failed")
+    if table_name != "orderdetails":
+        print("Fact Table population required only for orders and orders details")
+        return
 
-    # Decrypt the secret value
-    secret = get_secret_value_response['SecretString']
-    return secret
+    # Establish a connection to Redshift
+    conn = runtime.get_connection()
 
-# Get the secret value
-secret = get_secret()
-credentials = json.loads(secret)
-host = credentials['host']
-port = credentials['port']
-user = credentials['user']
-password = credentials['password']
-database = credentials['database']
-params = get_workflow_params()
-table_name = params['table_name'].lower()
-# Establish a connection to Redshift
+    # "incremental" only loads order lines beyond the watermark, "full" re-joins the whole order history,
+    # "batched" loads the orders in resumable, separately committed batches
+    fact_load_mode = params.get('fact_load_mode', 'incremental').lower()
+    watermark_column = params.get('watermark_column', 'OrderID')
 
-if  table_name=="orderdetails":
-    
-    # Establish a connection to Redshift
-    conn = psycopg2.connect(
-        host=host,
-        port=port,
-        user=user,
-        password=password,
-        database=database
-    )
-    
-    # Create a cursor object
-    cursor = conn.cursor()
-    
-    # SQL statement
-    sql_statement = """
-    
-    BEGIN;
-    
-    -- Create the staging table
-    CREATE TABLE staging_fact_orders (
-      OrderID INT NOT NULL,
-      CustomerID INT NOT NULL,
-      StoreID INT NOT NULL,
-      ProductID INT NOT NULL,
-      Quantity INT NOT NULL,
-      UnitPrice DECIMAL(8,2) NOT NULL,
-      TotalPrice DECIMAL(8,2) NOT NULL,
-      OrderDate DATE NOT NULL
-    );
-    
-    -- Print debugging information
-    SELECT 'Staging table created.' AS debug_info;
-    
-    -- Insert records into the staging table
-    INSERT INTO staging_fact_orders (OrderID, CustomerID, StoreID, ProductID, Quantity, UnitPrice, TotalPrice, OrderDate)
-    SELECT o.OrderID, o.CustomerID, o.StoreID, od.ProductID, od.Quantity, od.Price, od.Price*od.Quantity, o.OrderDate
-    FROM Orders o
-    JOIN OrderDetails od ON o.OrderID = od.OrderID;
-    -- Print debugging information
-    SELECT 'Records inserted into staging table.' AS debug_info;
-    
-    -- Insert records into the fact_orders table
-    INSERT INTO fact_orders (OrderID, CustomerID, StoreID, ProductID, Quantity, UnitPrice, TotalPrice, OrderDateID)
-    SELECT o.OrderID, dc.CustomerKey, ds.StoreKey, dp.ProductKey, o.Quantity, o.UnitPrice, o.TotalPrice, dd.DateKey
-    FROM staging_fact_orders o
-    JOIN dim_customers dc ON o.CustomerID = dc.CustomerID
-    JOIN dim_stores ds ON o.StoreID = ds.StoreID
-    JOIN dim_products dp ON o.ProductID = dp.ProductID
-    JOIN dim_dates dd ON o.OrderDate = dd.Date
-    WHERE dp.EndDate = '9999-12-31' AND dc.EndDate = '9999-12-31' AND ds.EndDate = '9999-12-31';
-    
-    -- Print debugging information
-    SELECT 'Records inserted into fact_orders table.' AS debug_info;
-    
-    -- Drop the staging table
-    DROP TABLE staging_fact_orders;
-    
-    -- Print debugging information
-    SELECT 'Staging table dropped.' AS debug_info;
-    
-    COMMIT;
-    """
-    
     try:
-        # Execute the SQL statement
-        cursor.execute(sql_statement)
-        conn.commit()
-        print("INSERT statement executed successfully!")
+        # Quarantine the order lines the fact joins would drop, or fail on them with orphan_action "fail"
+        if params.get('check_references', 'true').lower() == 'true':
+            check_references(conn, params.get('orphan_action', 'quarantine').lower())
+        result = load_facts(conn, fact_load_mode, watermark_column, params.get('batch_size'),
+                            int(params.get('batch_concurrency', 1)), params.get('batch_load_name'))
+        print(f"Fact load executed successfully: {result}")
+        # Vacuum and analyze the fact table once its appends pass the maintenance thresholds
+        if params.get('maintenance', 'true').lower() == 'true':
+            maintain_tables(conn, ['fact_orders'], thresholds_from_params(params))
     except (Exception, psycopg2.DatabaseError) as error:
-        conn.rollback()
         print("Error executing INSERT statement:", error)
         raise Exception("Populating Fact Table Failed")
-    
+
     # Close the cursor and connection
-    cursor.close()
-    conn.close()
-else:
-    print("Fact Table population required only for orders and orders details")
+    finally:
+        runtime.release_connection(conn)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,23 @@
+from pipeline import runtime, steps
+from pipeline.runner import files_from_params, options_from_params, run_pipeline
+
+
+def main():
+    """
+    Runs every stage of a workflow run in this job, over shared connections.
+    """
+    params = runtime.get_workflow_params()
+    steps.configure_from_params(params)
+    try:
+        results = run_pipeline(files_from_params(params), options_from_params(params))
+    finally:
+        runtime.close_pool()
+
+    failed = [result['stage'] for result in results if result['status'] not in ('succeeded', 'unchanged')]
+    if failed:
+        raise Exception(f"Pipeline stages failed: {', '.join(failed)}")
+    print("Pipeline executed successfully!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import gzip
+
+import pytest
+
+from pipeline import schema
+from pipeline.preflight import _EMPTY, IntKeySet, KeyBloomFilter, preflight_csv
+
+
+def _write_csv(path, rows):
+    columns = schema.column_names('Stores')
+    with open(path, 'w', newline='') as f:
+        f.write(','.join(columns) + '\n')
+        for row in rows:
+            f.write(row + '\n')
+    return str(path)
+
+
+def _store(store_id, name='Store'):
+    return f'{store_id},{name},1 Main St,Springfield,IL,62701'
+
+
+def test_int_key_set_grows_and_keeps_its_keys():
+    keys = IntKeySet(capacity=4)
+    initial_bytes = keys.nbytes
+    values = list(range(-500, 500)) + [2 ** 62, -(2 ** 62)]
+    assert all(keys.add(value) for value in values)
+    assert len(keys) == len(values)
+    assert keys.nbytes > initial_bytes
+    assert not any(keys.add(value) for value in values)
+    assert len(keys) == len(values)
+
+
+def test_int_key_set_stores_the_empty_sentinel_as_a_key():
+    keys = IntKeySet()
+    assert keys.add(_EMPTY)
+    assert not keys.add(_EMPTY)
+    assert keys.add(0)
+    assert keys.add(_EMPTY + 1)
+    assert len(keys) == 3
+
+
+def test_bloom_filter_grows_without_false_negatives():
+    keys = KeyBloomFilter(capacity=1024, error_rate=0.01)
+    initial_bytes = keys.nbytes
+    for value in range(20000):
+        keys.add(value)
+    assert keys.nbytes > initial_bytes
+    assert all(value in keys for value in range(20000))
+    false_positives = sum(value in keys for value in range(100000, 200000))
+    assert false_positives < 100000 * 0.02
+
+
+def test_bloom_mode_confirms_duplicates_across_files(tmp_path):
+    first = _write_csv(tmp_path / 'first.csv', [_store(i) for i in range(1, 200)])
+    second = _write_csv(tmp_path / 'second.csv', [_store(i) for i in range(200, 300)] + [_store(7)])
+    with pytest.raises(Exception, match=r'second\.csv:102: duplicate StoreID 7 \(first at .*first\.csv:8\)'):
+        preflight_csv([first, second], 'Stores', 'bloom')
+
+
+def test_bloom_mode_accepts_unique_keys(tmp_path):
+    path = _write_csv(tmp_path / 'stores.csv', [_store(i) for i in range(1, 2000)])
+    assert preflight_csv([path], 'Stores', 'bloom')['rows'] == 1999
+
+
+def test_exact_mode_reports_duplicates(tmp_path):
+    path = _write_csv(tmp_path / 'stores.csv', [_store(1), _store(2), _store(1)])
+    with pytest.raises(Exception, match=r'stores\.csv:4: duplicate StoreID 1'):
+        preflight_csv([path], 'Stores', 'exact')
+
+
+def test_quoted_empty_fields_are_not_null(tmp_path):
+    path = _write_csv(tmp_path / 'stores.csv', [_store(1, '""'), '2,"Multi\nline, ""quoted""",1 Main St,Springfield,IL,62701', _store(3)])
+    assert preflight_csv([path], 'Stores', 'exact')['rows'] == 3
+
+
+def test_compression_overrides_the_extension(tmp_path):
+    path = _write_csv(tmp_path / 'stores.csv', [_store(1), _store(2)])
+    with open(path, 'rb') as f:
+        data = gzip.compress(f.read())
+    with open(path, 'wb') as f:
+        f.write(data)
+    assert preflight_csv([path], 'Stores', 'exact', compression='gzip')['rows'] == 2
+
+
+def test_unquoted_empty_fields_are_null(tmp_path):
+    path = _write_csv(tmp_path / 'stores.csv', [_store(1), _store(2, '')])
+    with pytest.raises(Exception, match=r'stores\.csv:3: NULL value in column StoreName'):
+        preflight_csv([path], 'Stores', 'exact')